@@ -176,6 +176,41 @@ def sentinel2_ndci(data, b_red_edge, b_red, b_green, b_swir, band_mapper=None):
     return red_delta / red_sum.where(mndwi > 0.1)
 
 
+# Multi-date aggregator markers.
+#
+# Multi-date requests can be rendered one time slice at a time (so only one date of raw data is held
+# in memory) if the aggregator either passes each time slice through unchanged (e.g. for animation),
+# or has a running form that folds one date at a time into an accumulator.
+
+def per_time_slice(undecorated):
+    # Mark an aggregator as applying to each time slice independently.
+    undecorated.per_time_slice = True
+    return undecorated
+
+
+def running_aggregator(step):
+    # Mark an aggregator as having a running form.
+    #
+    # step(accumulated, data, **kwargs) combines the accumulator for the dates so far (None for the first
+    # date) with the data for the next date (without a time dimension).  The value returned for the
+    # last date is the aggregate.  The step function is called with the same args and kwargs as the
+    # aggregator.
+    def decorator(undecorated):
+        undecorated.running_step = step
+        return undecorated
+    return decorator
+
+
+def multi_date_delta_step(accumulated, data, time_direction=-1):
+    if accumulated is None:
+        return data
+    if time_direction >= 0:
+        return accumulated - data
+    else:
+        return data - accumulated
+
+
+@running_aggregator(multi_date_delta_step)
 def multi_date_delta(data, time_direction=-1):
     data1, data2 = (data.sel(time=dt) for dt in data.coords["time"].values)
 
@@ -185,6 +220,7 @@ def multi_date_delta(data, time_direction=-1):
     else:
         return data2 - data1
 
+@per_time_slice
 def multi_date_pass(data):
     return data
 
@@ -7,12 +7,14 @@ import json
 import logging
 import os
 from importlib import import_module
+from threading import Lock
 from typing import (Any, Callable, Iterable, List, Mapping, MutableMapping,
-                    Optional, Sequence, Set, Union, cast)
+                    Optional, Sequence, Set, Tuple, Union, cast)
 from urllib.parse import urlparse
 
 import fsspec
-from datacube.utils.masking import make_mask
+import numpy
+from datacube.utils.masking import create_mask_value, get_flags_def
 from flask_babel import gettext as _
 from xarray import DataArray
 
@@ -838,11 +840,47 @@ class FlagProductBands(OWSConfigEntry):
         return flag_products
 
 
+class FlagMaskCache:
+    """
+    Per-request cache of evaluated flag band bit tests.
+
+    Mask rules (from one or several styles) that test the same bits of the same flag band data
+    share a single evaluation.
+    """
+    def __init__(self) -> None:
+        self._tests: MutableMapping[Tuple[int, int, int], Tuple[numpy.ndarray, numpy.ndarray]] = {}
+
+    def bit_test(self, raw: numpy.ndarray, bitmask: int, expected: int) -> numpy.ndarray:
+        """
+        Evaluate (raw & bitmask) == expected, or return the cached result.
+
+        :param raw: Raw flag band data
+        :param bitmask: The bits to test
+        :param expected: The expected value of the tested bits
+        :return: A boolean array.  Shared between callers, so must not be modified in place.
+        """
+        key = (id(raw), bitmask, expected)
+        if key not in self._tests:
+            # Keep a reference to raw, so its id cannot be reused by other data while cached.
+            self._tests[key] = (raw, (raw & bitmask) == expected)
+        return self._tests[key][1]
+
+
+# Maximum number of flags_definitions a mask rule remembers bit tests for (other than the compiled one).
+MAX_DATA_BIT_TESTS = 16
+
+
 class AbstractMaskRule(OWSConfigEntry):
     def __init__(self, band: str, cfg: CFG_DICT, mapper: Callable[[str], str] = lambda x: x) -> None:
         super().__init__(cfg)
         self.band = mapper(band)
         self.parse_rule_spec(cfg)
+        self.bit_tests: Optional[List[Tuple[int, int]]] = None
+        self.compiled_flags_def: Optional[Mapping[str, RAW_CFG]] = None
+        self.value_array: Optional[numpy.ndarray] = None
+        # Bit tests for flags_definitions other than the compiled one, keyed on id(flags_definition).
+        self._data_bit_tests: MutableMapping[int, Tuple[Any, List[Tuple[int, int]]]] = {}
+        self._data_bit_tests_lock = Lock()
 
     @property
     def context(self) -> str:
@@ -892,31 +930,106 @@ class AbstractMaskRule(OWSConfigEntry):
             raise ConfigException(
                 f"Mask rule in {self.context} has both a 'flags' and a 'values' section - choose one.")
 
-    def create_mask(self, data: DataArray) -> DataArray:
+    def compile(self, flags_def: Optional[Mapping[str, RAW_CFG]] = None) -> None:
         """
-        Create a mask from raw flag band data.
+        Compile the rule to integer tests.
+
+        Flag rules compile to (bitmask, expected) pairs: a value matches if (value & bitmask) == expected
+        for every pair (or for any pair, for "or" rules).  Value rules compile to an array of values.
+
+        :param flags_def: The flags_definition of the rule's band.  If not supplied, flag rules are
+                evaluated with bit tests compiled from the flags_definition of the data.
+        """
+        if self.values:
+            self.value_array = numpy.array(self.values)
+            return
+        if flags_def is None:
+            return
+        self.bit_tests = self.bit_tests_for(flags_def)
+        self.compiled_flags_def = flags_def
+
+    def bit_tests_for(self, flags_def: Mapping[str, RAW_CFG]) -> List[Tuple[int, int]]:
+        """
+        The (bitmask, expected) pairs for a flags rule against a flags_definition.
+
+        :param flags_def: The flags_definition of the rule's band.
+        :return: A list of (bitmask, expected) pairs.
+        """
+        flags = cast(CFG_DICT, self.flags)
+        try:
+            if self.or_flags:
+                return [create_mask_value(flags_def, **{name: val}) for name, val in flags.items()]
+            else:
+                return [create_mask_value(flags_def, **flags)]
+        except ValueError as e:
+            raise ConfigException(f"Mask rule in {self.context} does not match the band's flags_definition: {e}")
+
+    def data_bit_tests(self, data: DataArray) -> List[Tuple[int, int]]:
+        """
+        The bit tests for data whose flags_definition is not the compiled one (or if the rule was not compiled).
+
+        Tests are remembered per flags_definition object, and never replace the compiled tests, so
+        concurrent requests with different flags_definitions cannot see each other's tests.
 
         :param data: Raw flag data, assumed to be for this rule's flag band.
-        :return: A boolean DataArray, True where the data matches this rule
+        :return: A list of (bitmask, expected) pairs.
+        """
+        flags_def = data.attrs.get("flags_definition")
+        key = id(flags_def)
+        with self._data_bit_tests_lock:
+            entry = self._data_bit_tests.get(key)
+        if entry is not None and entry[0] is flags_def:
+            return entry[1]
+        if self.bit_tests is not None and flags_def == self.compiled_flags_def:
+            tests = self.bit_tests
+        else:
+            tests = self.bit_tests_for(get_flags_def(data))
+        with self._data_bit_tests_lock:
+            if len(self._data_bit_tests) >= MAX_DATA_BIT_TESTS:
+                self._data_bit_tests.clear()
+            # The entry holds a reference to flags_def, so its id cannot be reused while cached.
+            self._data_bit_tests[key] = (flags_def, tests)
+        return tests
+
+    def evaluate(self, data: DataArray, cache: Optional[FlagMaskCache] = None) -> numpy.ndarray:
         """
+        Evaluate the rule against raw flag band data.
+
+        If data's flags_definition is not the one the rule was compiled for (e.g. by make_ready),
+        bit tests for it are compiled separately (see data_bit_tests).
+
+        :param data: Raw flag data, assumed to be for this rule's flag band.
+        :param cache: Optional per-request cache of bit tests.
+        :return: A boolean numpy array, True where the data matches this rule.  May be shared with the
+                cache, so must not be modified in place.
+        """
+        raw = data.values
         if self.values:
-            mask: Optional[DataArray] = None
-            for v in cast(List[int], self.values):
-                vmask = data == v
-                if mask is None:
-                    mask = vmask
-                else:
-                    mask |= vmask
-        elif self.or_flags:
-            mask = None
-            for f in cast(CFG_DICT, self.flags).items():
-                f = {f[0]: f[1]}
-                if mask is None:
-                    mask = make_mask(data, **f)
-                else:
-                    mask |= make_mask(data, **f)
+            if self.value_array is None:
+                self.compile()
+            mask = numpy.isin(raw, cast(numpy.ndarray, self.value_array))
         else:
-            mask = make_mask(data, **cast(CFG_DICT, self.flags))
-        if mask is not None and self.invert:
+            flags_def = data.attrs.get("flags_definition")
+            bit_tests = self.bit_tests
+            if bit_tests is None or (flags_def is not None and flags_def is not self.compiled_flags_def):
+                bit_tests = self.data_bit_tests(data)
+            if cache is None:
+                cache = FlagMaskCache()
+            tests = [cache.bit_test(raw, bitmask, expected)
+                     for bitmask, expected in bit_tests]
+            if len(tests) == 1:
+                mask = tests[0]
+            else:
+                mask = numpy.logical_or.reduce(tests)
+        if self.invert:
             mask = ~mask # pylint: disable=invalid-unary-operand-type
         return mask
+
+    def create_mask(self, data: DataArray) -> DataArray:
+        """
+        Create a mask from raw flag band data.
+
+        :param data: Raw flag data, assumed to be for this rule's flag band.
+        :return: A boolean DataArray, True where the data matches this rule
+        """
+        return DataArray(self.evaluate(data), coords=data.coords, dims=data.dims)
@@ -8,9 +8,11 @@ from __future__ import absolute_import
 import json
 import logging
 import re
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import date, datetime, timedelta
-from itertools import chain
+from itertools import chain, islice
 
 import datacube
 import numpy
@@ -26,18 +28,22 @@ from rasterio.io import MemoryFile
 from rasterio.warp import Resampling
 
 from datacube_ows.cube_pool import cube
-from datacube_ows.mv_index import MVSelectOpts, mv_search
+from datacube_ows.mv_index import (MVSelectOpts, footprint_level,
+                                   mv_footprint_extent, mv_lean_datasets,
+                                   mv_search, mv_search_summary)
 from datacube_ows.ogc_exceptions import WMSException
 from datacube_ows.ogc_utils import (ConfigException, dataset_center_time,
                                     solar_date, tz_for_geometry,
-                                    xarray_image_as_png)
+                                    xarray_frames_as_apng, xarray_image_as_png)
 from datacube_ows.ows_configuration import get_config
 from datacube_ows.query_profiler import QueryProfiler
 from datacube_ows.resource_limits import ResourceLimited
+from datacube_ows.solar_correction import SolarZenithGrid
 from datacube_ows.startup_utils import CredentialManager
 from datacube_ows.utils import default_to_utc, log_call
-from datacube_ows.wms_utils import (GetFeatureInfoParameters, GetMapParameters,
-                                    img_coords_to_geopoint, solar_correct_data)
+from datacube_ows.wms_utils import (GetFeatureInfoParameters,
+                                    GetMapBatchParameters, GetMapParameters,
+                                    img_coords_to_geopoint)
 
 _LOG = logging.getLogger(__name__)
 
@@ -123,13 +129,134 @@ class ProductBandQuery:
         return cls(main_products, bands, manual_merge=manual_merge, main=True, fuse_func=fuse_func)
 
 
+class QueryPlan:
+    """
+    Per-request memo of dataset searches against the space_time_view.
+
+    Each distinct (products, times, geometry) search is run against the database as a single SQL
+    statement returning the count (and the matching ids and union extent, if requested).  Later
+    requests for the same search are answered from the stored result, and only query the database
+    again for ids or an extent not already fetched.
+    """
+    def __init__(self):
+        self._summaries = {}
+        self._datasets = {}
+
+    @staticmethod
+    def key(products, times, geom):
+        return (
+            tuple(p.id for p in products),
+            None if times is None else tuple(tuple(t) if isinstance(t, list) else t for t in times),
+            None if geom is None else (str(geom.crs), geom.wkt),
+        )
+
+    def summary(self, index, products, times, geom, with_extent=False, with_ids=True):
+        key = self.key(products, times, geom)
+        summary = self._summaries.get(key)
+        if summary is None or (with_extent and not summary.has_extent) or (with_ids and not summary.has_ids):
+            new_summary = mv_search_summary(index,
+                                            times=times,
+                                            geom=geom,
+                                            products=products,
+                                            with_extent=with_extent,
+                                            with_ids=with_ids)
+            if summary is not None:
+                new_summary.merge(summary)
+            summary = new_summary
+            self._summaries[key] = summary
+        return summary
+
+    def datasets(self, index, products, times, geom, group_by):
+        key = self.key(products, times, geom)
+        if key not in self._datasets:
+            ids = self.summary(index, products, times, geom).ids
+            self._datasets[key] = datacube.Datacube.group_datasets(
+                mv_lean_datasets(index, ids, products), group_by)
+        return self._datasets[key]
+
+
+class MosaicBuffer:
+    """
+    In-place mosaic of the per-dataset reads for a single time slice of a manual_merge layer.
+
+    The first read (with its extent mask applied) becomes the output buffer.  Each later read only
+    fills the output pixels that are still NaN (or nodata), with numpy.copyto, so the mosaic never
+    holds more than the output plus the current read.  Earlier reads take precedence, as with
+    xarray's combine_first.
+    """
+    def __init__(self):
+        self.merged = None
+
+    @staticmethod
+    def _mask_array(mask, band):
+        # Extent mask functions may return DataArrays or bare numpy arrays.
+        if hasattr(mask, "dims"):
+            mask = mask.transpose(*(d for d in band.dims if d in mask.dims)).values
+        return numpy.broadcast_to(mask, band.shape)
+
+    @staticmethod
+    def _missing(values, nodata):
+        if numpy.issubdtype(values.dtype, numpy.floating):
+            missing = numpy.isnan(values)
+            if nodata is not None and not numpy.isnan(nodata):
+                missing |= values == nodata
+            return missing
+        if nodata is None:
+            return None
+        return values == nodata
+
+    def add(self, data, extent_mask=None):
+        """
+        Merge a read into the mosaic.
+
+        :param data: The xarray Dataset read for one dataset, on the same geobox as earlier reads.
+        :param extent_mask: Optional boolean mask of valid pixels in data.
+        """
+        if self.merged is None:
+            if extent_mask is not None:
+                data = data.where(extent_mask)
+            self.merged = data
+            return
+        for name, out in self.merged.data_vars.items():
+            values = out.values
+            missing = self._missing(values, out.attrs.get("nodata"))
+            if missing is None:
+                continue
+            if extent_mask is not None:
+                missing &= self._mask_array(extent_mask, out)
+            src = data[name].transpose(*out.dims).values
+            numpy.copyto(values, src, where=missing)
+
+    def valid(self, bands):
+        """
+        The extent of the mosaic.
+
+        :param bands: The (non-flag) bands that must have data.
+        :return: A boolean DataArray, True where all of bands have been filled with non-NaN data,
+                 or None if there are no bands.
+        """
+        valid = None
+        for band in bands:
+            band_valid = ~numpy.isnan(self.merged[band])
+            if valid is None:
+                valid = band_valid
+            else:
+                valid &= band_valid
+        return valid
+
+
 class DataStacker:
     @log_call
-    def __init__(self, product, geobox, times, resampling=None, style=None, bands=None, **kwargs):
+    def __init__(self, product, geobox, times, resampling=None, style=None, bands=None, dask_chunks=None, **kwargs):
         super(DataStacker, self).__init__(**kwargs)
         self._product = product
         self.cfg = product.global_cfg
         self._geobox = geobox
+        # If set, data is loaded lazily as dask arrays with these chunk sizes (except for manual_merge layers).
+        self._dask_chunks = dask_chunks
+        self._solar_grid = None
+        # Extent mask of the last manual merge, calculated as each time slice is merged.
+        self.merged_extent_mask = None
         self._resampling = resampling if resampling is not None else Resampling.nearest
         self.style = style
         if style:
@@ -153,10 +280,18 @@ class DataStacker:
             ]
         self.group_by = self._product.dataset_groupby()
         self.resource_limited = False
+        self.query_plan = QueryPlan()
 
     def needed_bands(self):
         return self._needed_bands
 
+    @property
+    def solar_grid(self):
+        # Solar zenith grid for the output geobox, shared by all datasets and bands in the request.
+        if self._solar_grid is None:
+            self._solar_grid = SolarZenithGrid(self._geobox)
+        return self._solar_grid
+
     @log_call
     def n_datasets(self, index, all_time=False, point=None):
         return self.datasets(index,
@@ -199,24 +334,45 @@ class DataStacker:
                 qry_times = None
             else:
                 qry_times = times
-            result = mv_search(index,
-                               sel=mode,
-                               times=qry_times,
-                               geom=geom,
-                               products=query.products)
             if mode == MVSelectOpts.DATASETS:
-                result = datacube.Datacube.group_datasets(result, self.group_by)
+                result = self.query_plan.datasets(index, query.products, qry_times, geom, self.group_by)
                 if all_time:
                     return result
                 results.append((query, result))
             elif mode == MVSelectOpts.IDS:
+                result = self.query_plan.summary(index, query.products, qry_times, geom).ids
                 if all_time:
                     return result
                 results.append((query, result))
+            elif mode == MVSelectOpts.COUNT:
+                return self.query_plan.summary(index, query.products, qry_times, geom, with_ids=False).count
+            elif mode == MVSelectOpts.EXTENT:
+                found, extent = self.footprint_extent(index, query.products, all_time=all_time or query.ignore_time)
+                if found:
+                    return extent
+                return self.query_plan.summary(index, query.products, qry_times, geom,
+                                               with_extent=True, with_ids=False).extent
             else:
-                return result
+                return mv_search(index,
+                                 sel=mode,
+                                 times=qry_times,
+                                 geom=geom,
+                                 products=query.products)
         return OrderedDict(results)
 
+    def footprint_extent(self, index, products, all_time=False):
+        # Union extent from the precomputed footprints, where available.
+        # Not used for sub-day or mosaic layers, where request times do not map directly to footprint dates.
+        if self._product.time_resolution.is_subday() or self._product.mosaic_date_func:
+            return False, None
+        if all_time:
+            dates = None
+        else:
+            dates = [t.strftime("%Y-%m-%d") for t in self.raw_times]
+        geom = self._geobox.extent
+        return mv_footprint_extent(index, products, dates, geom,
+                                   level=footprint_level(geom, self._geobox.width, self._geobox.height))
+
     def create_nodata_filled_flag_bands(self, data, pbq):
         var = None
         for var in data.data_vars.variables.keys():
@@ -241,6 +397,7 @@ class DataStacker:
         # pylint: disable=too-many-locals, consider-using-enumerate
         # datasets is an XArray DataArray of datasets grouped by time.
         data = None
+        self.merged_extent_mask = None
         for pbq, datasets in datasets_by_query.items():
             if data is not None and len(data.time) == 0:
                 # No data, so no need for masking data.
@@ -299,38 +456,42 @@ class DataStacker:
             non_flag_bands = bands
             flag_bands = set()
         time_slices = []
-        for dt in datasets.time.values:
-            tds = datasets.sel(time=dt)
-            merged = None
-            for ds in tds.values.item():
-                d = self.read_data_for_single_dataset(ds, measurements, self._geobox, fuse_func=fuse_func)
-                extent_mask = None
-                for band in non_flag_bands:
-                    for f in self._product.extent_mask_func:
-                        if extent_mask is None:
-                            extent_mask = f(d, band)
-                        else:
-                            extent_mask &= f(d, band)
-                if extent_mask is not None:
-                    d = d.where(extent_mask)
-                if self._product.solar_correction and not skip_corrections:
+        slice_masks = []
+        # Read datasets (possibly concurrently), strictly in time slice then fusion order.
+        with closing(self.read_datasets_in_order(
+                [ds for dt in datasets.time.values for ds in datasets.sel(time=dt).values.item()],
+                measurements, fuse_func=fuse_func)) as dataset_reads:
+            for dt in datasets.time.values:
+                tds = datasets.sel(time=dt)
+                mosaic = MosaicBuffer()
+                for ds in tds.values.item():
+                    _, d = next(dataset_reads)
+                    extent_mask = None
                     for band in non_flag_bands:
-                        d[band] = solar_correct_data(d[band], ds)
+                        for f in self._product.extent_mask_func:
+                            if extent_mask is None:
+                                extent_mask = f(d, band)
+                            else:
+                                extent_mask &= f(d, band)
+                    if self._product.solar_correction and not skip_corrections:
+                        self.solar_grid.correct(d, ds, non_flag_bands)
+                    mosaic.add(d, extent_mask)
+                merged = mosaic.merged
                 if merged is None:
-                    merged = d
-                else:
-                    merged = merged.combine_first(d)
-            if merged is None:
-                continue
-            for band in flag_bands:
-                # REVISIT: not sure about type converting one band like this?
-                merged[band] = merged[band].astype('uint16', copy=True)
-                merged[band].attrs = d[band].attrs
-            time_slices.append(merged)
+                    continue
+                if self.style and non_flag_bands:
+                    slice_masks.append(mosaic.valid(non_flag_bands))
+                for band in flag_bands:
+                    # REVISIT: not sure about type converting one band like this?
+                    merged[band] = merged[band].astype('uint16', copy=True)
+                    merged[band].attrs = d[band].attrs
+                time_slices.append(merged)
 
         if not time_slices:
             return None
         result = xarray.concat(time_slices, datasets.time)
+        if slice_masks:
+            self.merged_extent_mask = xarray.concat(slice_masks, datasets.time)
         return result
 
     # Read data for given datasets and measurements per the output_geobox
@@ -343,10 +504,51 @@ class DataStacker:
                     geobox,
                     measurements=measurements,
                     fuse_func=fuse_func,
+                    dask_chunks=self._dask_chunks,
                     patch_url=self._product.patch_url)
         except Exception as e:
             _LOG.error("Error (%s) in load_data: %s", e.__class__.__name__, str(e))
             raise
+
+    def read_datasets_in_order(self, datasets, measurements, fuse_func=None):
+        """
+        Read datasets individually, on a thread pool of the layer's manual_merge_threads size.
+
+        At most manual_merge_threads reads are in progress (or waiting to be consumed) at once.
+
+        :param datasets: A list of datasets
+        :return: A generator of (dataset, data) tuples, in the same order as the datasets.
+        """
+        threads = min(self._product.manual_merge_threads, len(datasets))
+        if threads <= 1:
+            for ds in datasets:
+                yield ds, self.read_data_for_single_dataset(ds, measurements, self._geobox, fuse_func=fuse_func)
+            return
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = deque()
+            ds_iter = iter(datasets)
+
+            def submit(ds):
+                pending.append((
+                    ds,
+                    executor.submit(self.read_data_for_single_dataset, ds, measurements, self._geobox,
+                                    fuse_func=fuse_func)
+                ))
+
+            for ds in islice(ds_iter, threads):
+                submit(ds)
+            try:
+                while pending:
+                    ds, future = pending.popleft()
+                    data = future.result()
+                    next_ds = next(ds_iter, None)
+                    if next_ds is not None:
+                        submit(next_ds)
+                    yield ds, data
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
     # Read data for single datasets and measurements per the output_geobox
     @log_call
     def read_data_for_single_dataset(self, dataset, measurements, geobox, resampling=Resampling.nearest, fuse_func=None):
@@ -503,58 +705,36 @@ def get_map(args):
                         qprof["write_action"] = f"{n_dates} requested, only {len(dss.time)} found - returning empty image"
                         raise EmptyResponse()
                 qprof.end_event("fetch-datasets")
-                _LOG.debug("load start %s %s", datetime.now().time(), args["requestid"])
-                qprof.start_event("load-data")
-                data = stacker.data(datasets)
-                qprof.end_event("load-data")
-                _LOG.debug("load stop %s %s", datetime.now().time(), args["requestid"])
-                qprof.start_event("build-masks")
-                td_masks = []
-                for npdt in data.time.values:
-                    td = data.sel(time=npdt)
-                    td_ext_mask = None
-                    band = ""
-                    for band in params.style.needed_bands:
-                        if band not in params.style.flag_bands:
-                            if params.product.data_manual_merge:
-                                if td_ext_mask is None:
-                                    td_ext_mask = ~numpy.isnan(td[band])
-                                else:
-                                    td_ext_mask &= ~numpy.isnan(td[band])
-                            else:
-                                for f in params.product.extent_mask_func:
-                                    if td_ext_mask is None:
-                                        td_ext_mask = f(td, band)
-                                    else:
-                                        td_ext_mask &= f(td, band)
-                    if params.product.data_manual_merge:
-                        td_ext_mask = xarray.DataArray(td_ext_mask)
-                    if td_ext_mask is None:
-                        td_ext_mask = xarray.DataArray(
-                                            ~numpy.zeros(
-                                                        td[band].values.shape,
-                                                        dtype=numpy.bool_
-                                            ),
-                                            td[band].coords
-                        )
-                    td_masks.append(td_ext_mask)
-                extent_mask = xarray.concat(td_masks, dim=data.time)
-                qprof.end_event("build-masks")
-                if not data:
-                    qprof["write_action"] = "No Data: Write Empty"
-                    raise EmptyResponse()
+                if mdh and mdh.time_sliced and _time_sliceable(datasets, n_dates):
+                    # Load, style and encode one date at a time.
+                    qprof["write_action"] = "Write Data (time sliced)"
+                    qprof.start_event("load-style-write")
+                    body = _write_png_time_sliced(stacker, datasets, params, mdh)
+                    qprof.end_event("load-style-write")
                 else:
-                    qprof["write_action"] = "Write Data"
-                    if mdh and mdh.preserve_user_date_order:
-                        sorter = user_date_sorter(
-                                                  params.product,
-                                                  data.time.values,
-                                                  params.geobox.geographic_extent,
-                                                  params.times)
-                        data = data.sortby(sorter)
-                        extent_mask = extent_mask.sortby(sorter)
-
-                    body = _write_png(data, params.style, extent_mask, qprof)
+                    _LOG.debug("load start %s %s", datetime.now().time(), args["requestid"])
+                    qprof.start_event("load-data")
+                    data = stacker.data(datasets)
+                    qprof.end_event("load-data")
+                    _LOG.debug("load stop %s %s", datetime.now().time(), args["requestid"])
+                    qprof.start_event("build-masks")
+                    extent_mask = _build_extent_mask(data, params.product, params.style, stacker.merged_extent_mask)
+                    qprof.end_event("build-masks")
+                    if not data:
+                        qprof["write_action"] = "No Data: Write Empty"
+                        raise EmptyResponse()
+                    else:
+                        qprof["write_action"] = "Write Data"
+                        if mdh and mdh.preserve_user_date_order:
+                            sorter = user_date_sorter(
+                                                      params.product,
+                                                      data.time.values,
+                                                      params.geobox.geographic_extent,
+                                                      params.times)
+                            data = data.sortby(sorter)
+                            extent_mask = extent_mask.sortby(sorter)
+
+                        body = _write_png(data, params.style, extent_mask, qprof)
         except EmptyResponse:
             qprof.start_event("write")
             body = _write_empty(params.geobox)
@@ -566,6 +746,66 @@ def get_map(args):
         return png_response(body, extra_headers=params.product.resource_limits.wms_cache_rules.cache_headers(n_datasets))
 
 
+@log_call
+def get_map_tiles(args, windows):
+    """
+    Render a batch of map tiles from a single search and data load.
+
+    :param args: GetMap arguments for a single image spanning all the tiles.  The WMS maximum
+                 width and height do not apply.
+    :param windows: A dictionary mapping tile keys to (row slice, column slice) pixel windows
+                 of the spanning image.
+    :return: A dictionary mapping tile keys to PNG response tuples, or None if the spanning request
+             is resource limited (in which case the tiles should be rendered individually).
+    """
+    # pylint: disable=too-many-locals
+    params = GetMapBatchParameters(args)
+    qprof = QueryProfiler(False)
+    n_dates = len(params.times)
+    if n_dates == 1:
+        mdh = None
+    else:
+        mdh = params.style.get_multi_date_handler(n_dates)
+        if mdh is None:
+            raise WMSException("Style %s does not support GetMap requests with %d dates" % (params.style.name, n_dates),
+                               WMSException.INVALID_DIMENSION_VALUE, locator="Time parameter")
+    y_dim, x_dim = params.geobox.dimensions
+    img_data = None
+    with cube() as dc:
+        if not dc:
+            raise WMSException("Database connectivity failure")
+        stacker = DataStacker(params.product, params.geobox, params.times, params.resampling, style=params.style)
+        n_datasets = stacker.datasets(dc.index, mode=MVSelectOpts.COUNT)
+        try:
+            params.product.resource_limits.check_wms(n_datasets, params.zf, params.resources)
+        except ResourceLimited:
+            return None
+        if n_datasets > 0:
+            datasets = stacker.datasets(dc.index)
+            if all(len(dss.time) == n_dates for pbq, dss in datasets.items() if pbq.main):
+                data = stacker.data(datasets)
+                if data:
+                    extent_mask = _build_extent_mask(data, params.product, params.style, stacker.merged_extent_mask)
+                    if mdh and mdh.preserve_user_date_order:
+                        sorter = user_date_sorter(
+                                                  params.product,
+                                                  data.time.values,
+                                                  params.geobox.geographic_extent,
+                                                  params.times)
+                        data = data.sortby(sorter)
+                        extent_mask = extent_mask.sortby(sorter)
+                    img_data = _style_image(data, params.style, extent_mask, qprof)
+    headers = params.product.resource_limits.wms_cache_rules.cache_headers(n_datasets)
+    tiles = {}
+    for key, (rows, cols) in windows.items():
+        if img_data is None:
+            body = _write_empty(params.geobox[rows, cols])
+        else:
+            body = _encode_png(img_data.isel({y_dim: rows, x_dim: cols}), params.style)
+        tiles[key] = png_response(body, extra_headers=headers)
+    return tiles
+
+
 def png_response(body, cfg=None, extra_headers=None):
     if not cfg:
         cfg = get_config()
@@ -577,24 +817,140 @@ def png_response(body, cfg=None, extra_headers=None):
     return body, 200, cfg.response_headers(headers)
 
 
+def _build_extent_mask(data, product, style, merged_mask=None):
+    """
+    Build the extent mask for data: True where every needed (non-flag) band has valid data.
+
+    Extent mask functions are evaluated once per band, vectorised over the whole time-stacked array.
+
+    :param data: Time-stacked raw data
+    :param product: The layer
+    :param style: The style
+    :param merged_mask: The extent mask calculated during manual merge (DataStacker.merged_extent_mask),
+                        if available.  It is used as is.
+    :return: A boolean DataArray with the dimensions of data.
+    """
+    if merged_mask is not None:
+        return merged_mask
+    ext_mask = None
+    band = ""
+    for band in style.needed_bands:
+        if band in style.flag_bands:
+            continue
+        if product.data_manual_merge:
+            band_masks = [~numpy.isnan(data[band])]
+        else:
+            band_masks = (f(data, band) for f in product.extent_mask_func)
+        for band_mask in band_masks:
+            if ext_mask is None:
+                ext_mask = band_mask
+            else:
+                ext_mask &= band_mask
+    if ext_mask is None:
+        ext_mask = xarray.DataArray(
+                            numpy.ones(data[band].shape, dtype=numpy.bool_),
+                            coords=data[band].coords,
+                            dims=data[band].dims
+        )
+    elif not isinstance(ext_mask, xarray.DataArray):
+        ext_mask = xarray.DataArray(ext_mask, coords=data[band].coords, dims=data[band].dims)
+    return ext_mask
+
+
 @log_call
 def _write_png(data, style, extent_mask, qprof):
+    img_data = _style_image(data, style, extent_mask, qprof)
+    qprof.start_event("write")
+    image = _encode_png(img_data, style)
+    qprof.end_event("write")
+    return image
+
+
+def _time_sliceable(datasets, n_dates):
+    # Every time-aware query must have datasets for each date (or none at all) to load one date at a time.
+    return all(
+        pbq.ignore_time or len(dss.time) in (0, n_dates)
+        for pbq, dss in datasets.items()
+    )
+
+
+def _load_time_slices(stacker, datasets, order, product, style):
+    """
+    Load data one date at a time.
+
+    :param stacker: The DataStacker for the request
+    :param datasets: Datasets by query, as returned by DataStacker.datasets()
+    :param order: The time indexes to load, in order.
+    :param product: The layer
+    :param style: The style
+    :return: Iterator over (data, extent mask) pairs, each with a time dimension of length 1.
+    """
+    for idx in order:
+        slice_datasets = {
+            pbq: dss if pbq.ignore_time or len(dss.time) == 0 else dss.isel(time=[idx])
+            for pbq, dss in datasets.items()
+        }
+        data = stacker.data(slice_datasets)
+        if not data:
+            raise EmptyResponse()
+        yield data, _build_extent_mask(data, product, style, stacker.merged_extent_mask)
+
+
+@log_call
+def _write_png_time_sliced(stacker, datasets, params, mdh):
+    """
+    Load, style and encode a multi-date GetMap request one date at a time.
+
+    Only the raw data for one date is held in memory at once: animation frames are rendered
+    as each date is loaded, and running aggregators accumulate one date at a time.
+    """
+    main_dss = next(dss for pbq, dss in datasets.items() if pbq.main)
+    order = range(len(main_dss.time))
+    if mdh.preserve_user_date_order:
+        sorter = user_date_sorter(
+                                  params.product,
+                                  main_dss.time.values,
+                                  params.geobox.geographic_extent,
+                                  params.times)
+        order = numpy.argsort(sorter.values, kind="stable")
+    images = mdh.transform_time_slices(
+        _load_time_slices(stacker, datasets, order, params.product, params.style)
+    )
+    layer = params.style.product
+    opts = {
+        "compress_level": layer.png_compress_level,
+        "compress_type": layer.png_compress_type,
+    }
+    if mdh.per_time_slice:
+        return xarray_frames_as_apng(images, frame_duration=mdh.frame_duration, **opts)
+    return xarray_image_as_png(next(images), **opts)
+
+
+def _style_image(data, style, extent_mask, qprof):
     qprof.start_event("combine-masks")
     mask = style.to_mask(data, extent_mask)
     qprof.end_event("combine-masks")
     qprof.start_event("apply-style")
     img_data = style.transform_data(data, mask)
     qprof.end_event("apply-style")
-    qprof.start_event("write")
+    return img_data
+
+
+def _encode_png(img_data, style):
+    layer = style.product
+    opts = {
+        "compress_level": layer.png_compress_level,
+        "compress_type": layer.png_compress_type,
+    }
     # If time dimension is present animate over it.
     # Verified using : https://docs.dea.ga.gov.au/notebooks/Frequently_used_code/Animated_timeseries.html
     mdh = style.get_multi_date_handler(img_data)
     if mdh:
-        image = xarray_image_as_png(img_data, loop_over='time', animate=True, frame_duration=mdh.frame_duration)
+        return xarray_image_as_png(img_data, loop_over='time', animate=True, frame_duration=mdh.frame_duration,
+                                   **opts)
     else:
-        image = xarray_image_as_png(img_data)
-    qprof.end_event("write")
-    return image
+        palette = style.png_palette() if layer.png_palette else None
+        return xarray_image_as_png(img_data, palette=palette, **opts)
 
 
 @log_call
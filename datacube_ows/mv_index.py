@@ -5,16 +5,25 @@
 # SPDX-License-Identifier: Apache-2.0
 import datetime
 import json
+import math
+from collections import OrderedDict
 from enum import Enum
-from typing import Any, Iterable, Optional, Tuple, Union, cast
+from threading import Lock
+from time import monotonic
+from typing import (Any, Hashable, Iterable, List, MutableMapping, Optional,
+                    Tuple, Union, cast)
 
 import pytz
+from datacube.model import Dataset
 from datacube.utils.geometry import Geometry as ODCGeom
+from datacube.utils.geometry import box, unary_union
 from geoalchemy2 import Geometry
 from psycopg2.extras import DateTimeTZRange
-from sqlalchemy import (SMALLINT, Column, MetaData, Table, and_, or_, select,
-                        text)
-from sqlalchemy.dialects.postgresql import TSTZRANGE, UUID
+from sqlalchemy import (SMALLINT, TEXT, Column, MetaData, Table, and_, or_,
+                        select, text)
+from sqlalchemy.dialects.postgresql import (INTEGER, JSONB, TIMESTAMP,
+                                            TSTZRANGE, UUID)
+from sqlalchemy.exc import ProgrammingError
 from sqlalchemy.sql.functions import count, func
 
 from datacube_ows.utils import default_to_utc
@@ -32,8 +41,29 @@ def get_st_view(meta: MetaData) -> Table:
              Column('spatial_extent', Geometry(from_text='ST_GeomFromGeoJSON', name='geometry')),
              Column('temporal_extent', TSTZRANGE())
                  )
+
+
+def get_dataset_tables(meta: MetaData) -> Tuple[Table, Table]:
+    # The ODC dataset and dataset location tables - only the columns needed for the lean dataset projection.
+    dataset = Table('dataset', meta,
+                    Column('id', UUID()),
+                    Column('dataset_type_ref', SMALLINT()),
+                    Column('metadata', JSONB()),
+                    schema='agdc')
+    location = Table('dataset_location', meta,
+                     Column('id', INTEGER()),
+                     Column('dataset_ref', UUID()),
+                     Column('uri_scheme', TEXT()),
+                     Column('uri_body', TEXT()),
+                     Column('added', TIMESTAMP(timezone=True)),
+                     Column('archived', TIMESTAMP(timezone=True)),
+                     schema='agdc')
+    return dataset, location
+
+
 _meta = MetaData()
 st_view = get_st_view(_meta)
+ds_table, ds_location = get_dataset_tables(_meta)
 
 
 class MVSelectOpts(Enum):
@@ -42,7 +72,7 @@ class MVSelectOpts(Enum):
 
     ALL: return all columns, select *, as result set
     IDS: return list of database_ids only.
-    DATASETS: return list of ODC dataset objects
+    DATASETS: return list of (lean) ODC dataset objects
     COUNT: return a count of matching datasets
     EXTENT: return full extent of query result as a Geometry
     """
@@ -69,36 +99,58 @@ TimeSearchTerm = Union[
     datetime.datetime,
 ]
 
-def mv_search(index: "datacube.index.Index",
-              sel: MVSelectOpts = MVSelectOpts.IDS,
+class MVSearchSummary:
+    """
+    Summary of a space_time_view query, as returned by mv_search_summary.
+
+    ids: list of matching dataset ids (None if not requested)
+    count: number of matching datasets
+    extent: full extent of query result as a Geometry (None if not requested or empty)
+    """
+    def __init__(self, ids: Optional[Iterable[str]], count: int,
+                 extent: Optional[ODCGeom] = None,
+                 has_extent: bool = False) -> None:
+        self.ids = None if ids is None else list(ids)
+        self.count = count
+        self.extent = extent
+        self.has_extent = has_extent
+
+    @property
+    def has_ids(self) -> bool:
+        return self.ids is not None
+
+    def merge(self, other: "MVSearchSummary") -> None:
+        """
+        Fill in the ids and/or extent from another summary of the same search.
+        """
+        if not self.has_ids and other.has_ids:
+            self.ids = other.ids
+        if not self.has_extent and other.has_extent:
+            self.extent = other.extent
+            self.has_extent = True
+
+
+def mv_select(sel_cols: Iterable["sqlalchemy.sql.elements.ClauseElement"],
               times: Optional[Iterable[TimeSearchTerm]] = None,
               geom: Optional[ODCGeom] = None,
-              products: Optional[Iterable["datacube.model.DatasetType"]] = None) -> Union[
-        Iterable[Iterable[Any]],
-        Iterable[str],
-        Iterable["datacube.model.Dataset"],
-        int,
-        None,
-        ODCGeom]:
+              products: Optional[Iterable["datacube.model.DatasetType"]] = None
+              ) -> "sqlalchemy.sql.expression.Select":
     """
-    Perform a dataset query via the space_time_view
-
-    :param products: An iterable of combinable products to search
-    :param index: A datacube index (required)
+    Build a select statement against the space_time_view
 
-    :param sel: Selection mode - a MVSelectOpts enum. Defaults to IDS.
+    :param sel_cols: The columns (or aggregate expressions) to select
     :param times: A list of pairs of datetimes (with time zone)
     :param geom: A datacube.utils.geometry.Geometry object
+    :param products: An iterable of combinable products to search
 
-    :return: See MVSelectOpts doc
+    :return: An SQLAlchemy select statement
     """
-    engine = get_sqlalc_engine(index)
     stv = st_view
     if products is None:
         raise Exception("Must filter by product/layer")
     prod_ids = [p.id for p in products]
 
-    s = select(*sel.sel(stv)).where(stv.c.dataset_type_ref.in_(prod_ids))
+    s = select(*sel_cols).where(stv.c.dataset_type_ref.in_(prod_ids))
     if times is not None:
         or_clauses = []
         for t in times:
@@ -128,13 +180,467 @@ def mv_search(index: "datacube.index.Index",
                     stv.c.temporal_extent.op("&&")(DateTimeTZRange(*t))
                 )
         s = s.where(or_(*or_clauses))
-    orig_crs = None
     if geom is not None:
-        orig_crs = geom.crs
         if str(geom.crs) != "EPSG:4326":
             geom = geom.to_crs("EPSG:4326")
         geom_js = json.dumps(geom.json)
         s = s.where(stv.c.spatial_extent.intersects(geom_js))
+    return s
+
+
+def clip_extent(uniongeom: Optional[ODCGeom], geom: Optional[ODCGeom] = None) -> Optional[ODCGeom]:
+    """
+    Clip an (EPSG:4326) union extent to the search geometry, and return it in the CRS of the
+    search geometry.
+
+    :param uniongeom: The union extent as a Geometry (or None)
+    :param geom: The search geometry (optional)
+    :return: A Geometry, or None if the extent is empty.
+    """
+    if uniongeom is None:
+        return None
+    if geom is None:
+        return uniongeom
+    orig_crs = geom.crs
+    if str(geom.crs) != "EPSG:4326":
+        geom = geom.to_crs("EPSG:4326")
+    intersect = uniongeom.intersection(geom)
+    if intersect.wkt == 'POLYGON EMPTY':
+        return None
+    if orig_crs and orig_crs != "EPSG:4326":
+        intersect = intersect.to_crs(orig_crs)
+    return intersect
+
+
+def extent_from_geojson(geojson: Optional[str], geom: Optional[ODCGeom] = None) -> Optional[ODCGeom]:
+    """
+    Convert a (EPSG:4326) GeoJSON union extent returned by the database into a Geometry,
+    clipped to (and in the CRS of) the search geometry, if supplied.
+
+    :param geojson: GeoJSON string, as returned by ST_AsGeoJSON (or None)
+    :param geom: The search geometry (optional)
+    :return: A Geometry, or None if the extent is empty.
+    """
+    if geojson is None:
+        return None
+    return clip_extent(ODCGeom(json.loads(geojson), crs="EPSG:4326"), geom)
+
+
+def time_search_key(t: TimeSearchTerm) -> Hashable:
+    """
+    Normalise a time search term to a hashable key, per the rules used by mv_select.
+    """
+    if isinstance(t, datetime.datetime):
+        return ("datetime", datetime.datetime(t.year, t.month, t.day, t.hour, t.minute, t.second).isoformat())
+    elif isinstance(t, datetime.date):
+        return ("date", t.isoformat())
+    else:
+        return ("range",) + tuple(default_to_utc(dt).isoformat() for dt in t)
+
+
+def stv_id_text() -> "sqlalchemy.sql.elements.ClauseElement":
+    return st_view.c.id.cast(TEXT)
+
+
+class MVSearchCache:
+    """
+    A bounded, per-process LRU cache of space_time_view search results.
+
+    Entries are keyed on the product ids, the normalised time search terms and the search bounding box
+    snapped (outwards) to a grid of grid_size degrees.  Each entry holds the id and footprint of every
+    dataset in the snapped grid cell, and results are filtered against the actual search geometry
+    when answered from the cache.
+
+    Only searches whose snapped bounding box covers at most max_cells grid cells are cached.  Larger
+    (zoomed out) searches rarely repeat, and are answered more cheaply by the database.
+
+    Entries expire after max_age seconds.  A max_entries of zero disables the cache.
+    """
+    def __init__(self, max_entries: int = 0, max_age: float = 300.0, grid_size: float = 0.1,
+                 max_cells: int = 4) -> None:
+        self._lock = Lock()
+        self._entries: MutableMapping[Hashable, Tuple[float, List[Tuple[str, ODCGeom]]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.metric: Optional[Any] = None
+        self.configure(max_entries, max_age, grid_size, max_cells)
+
+    def configure(self, max_entries: int = 0, max_age: float = 300.0, grid_size: float = 0.1,
+                  max_cells: int = 4) -> None:
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.grid_size = grid_size
+        self.max_cells = max_cells
+        self.clear()
+
+    @property
+    def active(self) -> bool:
+        return self.max_entries > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def grid_cell(self, geom: ODCGeom) -> Tuple[int, int, int, int]:
+        """
+        The search geometry bounding box snapped outwards to the cache grid, in integer grid units.
+        """
+        if str(geom.crs) != "EPSG:4326":
+            geom = geom.to_crs("EPSG:4326")
+        bbox = geom.boundingbox
+        return (
+            math.floor(bbox.left / self.grid_size),
+            math.floor(bbox.bottom / self.grid_size),
+            math.floor(bbox.right / self.grid_size) + 1,
+            math.floor(bbox.top / self.grid_size) + 1,
+        )
+
+    def applies_to(self, geom: Optional[ODCGeom]) -> bool:
+        """
+        True if the cache is active and a search of geom is small enough to be cached.
+        """
+        if not self.active or geom is None:
+            return False
+        left, bottom, right, top = self.grid_cell(geom)
+        return (right - left) * (top - bottom) <= self.max_cells
+
+    def key(self, products: Iterable["datacube.model.DatasetType"],
+            times: Optional[Iterable[TimeSearchTerm]],
+            geom: ODCGeom) -> Hashable:
+        return (
+            tuple(sorted(p.id for p in products)),
+            None if times is None else tuple(time_search_key(t) for t in times),
+            self.grid_cell(geom)
+        )
+
+    def footprints(self, index: "datacube.index.Index",
+                   products: Iterable["datacube.model.DatasetType"],
+                   times: Optional[Iterable[TimeSearchTerm]],
+                   geom: ODCGeom) -> List[Tuple[str, ODCGeom]]:
+        """
+        Return the (id, EPSG:4326 footprint) of every dataset matching the search in the search
+        geometry's grid cell, from the cache if possible.
+        """
+        products = list(products)
+        key = self.key(products, times, geom)
+        now = monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] <= self.max_age:
+                self._entries.move_to_end(key)
+                self._record(hit=True)
+                return entry[1]
+            self._record(hit=False)
+        left, bottom, right, top = key[2]
+        cell = box(left * self.grid_size, bottom * self.grid_size,
+                   right * self.grid_size, top * self.grid_size,
+                   "EPSG:4326")
+        s = mv_select([stv_id_text(), text("ST_AsGeoJSON(spatial_extent)")],
+                      times=times, geom=cell, products=products)
+        with get_sqlalc_engine(index).connect() as conn:
+            fps = [
+                (r[0], ODCGeom(json.loads(r[1]), crs="EPSG:4326"))
+                for r in conn.execute(s)
+            ]
+        with self._lock:
+            self._entries[key] = (now, fps)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return fps
+
+    def summary(self, index: "datacube.index.Index",
+                products: Iterable["datacube.model.DatasetType"],
+                times: Optional[Iterable[TimeSearchTerm]],
+                geom: ODCGeom,
+                with_extent: bool = False) -> "MVSearchSummary":
+        """
+        Answer a search from the cache, filtering the cell footprints against the search geometry.
+
+        Footprints are matched on bounding box overlap (the same test the database applies), so results are
+        identical to an uncached search.
+        """
+        fps = self.footprints(index, products, times, geom)
+        geom_4326 = geom if str(geom.crs) == "EPSG:4326" else geom.to_crs("EPSG:4326")
+        bbox = geom_4326.boundingbox
+        matches = [
+            (dsid, fp)
+            for dsid, fp in fps
+            if (fp.boundingbox.left <= bbox.right and fp.boundingbox.right >= bbox.left
+                and fp.boundingbox.bottom <= bbox.top and fp.boundingbox.top >= bbox.bottom)
+        ]
+        extent = None
+        if with_extent and matches:
+            extent = clip_extent(unary_union(fp for dsid, fp in matches), geom)
+        return MVSearchSummary([dsid for dsid, fp in matches], len(matches),
+                               extent=extent, has_extent=with_extent)
+
+    def clear(self, product_ids: Optional[Iterable[int]] = None) -> None:
+        """
+        Invalidate cache entries.
+
+        :param product_ids: Only invalidate entries for these ODC product ids. (Default: invalidate all entries)
+        """
+        with self._lock:
+            if product_ids is None:
+                self._entries.clear()
+                return
+            product_ids = set(product_ids)
+            for key in list(self._entries.keys()):
+                if product_ids.intersection(key[0]):
+                    del self._entries[key]
+
+    def _record(self, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.metric is not None:
+            self.metric.labels(result="hit" if hit else "miss").inc()
+
+
+# Per-process search cache, configured from the global config section
+mv_search_cache = MVSearchCache()
+
+
+# Simplification tolerances (in degrees) of the precomputed footprint levels.  Level 0 is unsimplified.
+FOOTPRINT_TOLERANCES = (0.0, 0.001, 0.01, 0.1)
+
+# Date key of the footprint over all dates.  Also marks a product as having precomputed footprints.
+FOOTPRINT_ALL_DATES = "all"
+
+
+def footprint_level(geom: ODCGeom, width: int, height: int) -> int:
+    """
+    The coarsest precomputed footprint level with a simplification tolerance no larger than a pixel.
+
+    :param geom: The (geobox) extent to be rendered
+    :param width: The width of the image to be rendered, in pixels
+    :param height: The height of the image to be rendered, in pixels
+    :return: A footprint level (an index into FOOTPRINT_TOLERANCES)
+    """
+    if str(geom.crs) != "EPSG:4326":
+        geom = geom.to_crs("EPSG:4326")
+    bbox = geom.boundingbox
+    pixel_size = min(bbox.width / width, bbox.height / height)
+    level = 0
+    for lvl, tolerance in enumerate(FOOTPRINT_TOLERANCES):
+        if tolerance <= pixel_size:
+            level = lvl
+    return level
+
+
+def mv_footprint_extent(index: "datacube.index.Index",
+                        products: Iterable["datacube.model.DatasetType"],
+                        dates: Optional[Iterable[str]],
+                        geom: ODCGeom,
+                        level: int = 0) -> Tuple[bool, Optional[ODCGeom]]:
+    """
+    Look up the union extent of the requested products and dates from the precomputed
+    footprints (built by datacube-ows-update), instead of calculating it from the space_time_view.
+
+    :param index: A datacube index (required)
+    :param products: An iterable of combinable products
+    :param dates: Date keys, formatted as in the product ranges, or None for all dates
+    :param geom: The search geometry
+    :param level: The footprint level to use (see footprint_level)
+    :return: A (found, extent) tuple.  found is False if footprints have not been built for all the products,
+             in which case the extent should be calculated with mv_search.
+    """
+    prod_ids = [p.id for p in products]
+    if dates is None:
+        dates = [FOOTPRINT_ALL_DATES]
+    else:
+        dates = list(dates)
+    geom_4326 = geom if str(geom.crs) == "EPSG:4326" else geom.to_crs("EPSG:4326")
+    s = text("""
+        SELECT product_id, date, CASE WHEN ST_IsEmpty(fp) THEN NULL ELSE ST_AsGeoJSON(fp) END
+        FROM (
+            SELECT product_id, date,
+                   ST_CollectionExtract(
+                        ST_Intersection(footprint, ST_SetSRID(ST_GeomFromGeoJSON(:geom), 4326)),
+                        3) as fp
+            FROM wms.product_footprints
+            WHERE product_id = ANY(:ids)
+            AND level = :level
+            AND date = ANY(:dates)
+        ) as subq
+    """)
+    try:
+        with get_sqlalc_engine(index).connect() as conn:
+            rows = list(conn.execute(s, {
+                "geom": json.dumps(geom_4326.json),
+                "ids": prod_ids,
+                "level": level,
+                "dates": dates + [FOOTPRINT_ALL_DATES],
+            }))
+    except ProgrammingError:
+        # Footprints table does not exist
+        return False, None
+    if {r[0] for r in rows if r[1] == FOOTPRINT_ALL_DATES} != set(prod_ids):
+        return False, None
+    footprints = [
+        ODCGeom(json.loads(r[2]), crs="EPSG:4326")
+        for r in rows
+        if r[1] in dates and r[2] is not None
+    ]
+    if not footprints:
+        return True, None
+    return True, clip_extent(unary_union(footprints), geom)
+
+
+# Top-level metadata document keys always included in the lean dataset projection.
+LEAN_DATASET_KEYS = ("$schema", "id", "crs", "extent", "grid_spatial", "properties", "driver_data")
+
+
+def lean_dataset_keys(products: Iterable["datacube.model.DatasetType"]) -> List[str]:
+    """
+    The top-level metadata document keys needed to search, group and load datasets of the given products.
+
+    Covers the id, format, grid_spatial and measurements offsets and the search fields (including time)
+    of each product's metadata type.  Lineage (the "sources" offset) is never included.
+
+    :param products: An iterable of ODC products
+    :return: A sorted list of top-level keys
+    """
+    keys = set(LEAN_DATASET_KEYS)
+    exclude = set()
+    for product in products:
+        ds_def = product.metadata_type.definition["dataset"]
+        offsets = [
+            ds_def[name]
+            for name in ("id", "format", "grid_spatial", "measurements")
+            if name in ds_def
+        ]
+        for fld in ds_def.get("search_fields", {}).values():
+            if "offset" in fld:
+                offsets.append(fld["offset"])
+            offsets.extend(fld.get("min_offset", []))
+            offsets.extend(fld.get("max_offset", []))
+        keys.update(offset[0] for offset in offsets if offset)
+        if ds_def.get("sources"):
+            exclude.add(ds_def["sources"][0])
+    return sorted(keys - exclude)
+
+
+def lean_dataset_cols(keys: Iterable[str]) -> List["sqlalchemy.sql.elements.ClauseElement"]:
+    """
+    Select columns for the lean dataset projection: id, product id, active uris (newest first),
+    then one column per top-level metadata key.
+    """
+    uris = select(
+        ds_location.c.uri_scheme + ':' + ds_location.c.uri_body
+    ).where(
+        and_(
+            ds_location.c.dataset_ref == ds_table.c.id,
+            ds_location.c.archived.is_(None),
+        )
+    ).order_by(
+        ds_location.c.added.desc(),
+        ds_location.c.id.desc()
+    ).scalar_subquery()
+    return [
+        ds_table.c.id,
+        ds_table.c.dataset_type_ref,
+        func.array(uris),
+    ] + [ds_table.c.metadata[key] for key in keys]
+
+
+def lean_datasets_from_rows(rows: Iterable[Iterable[Any]],
+                            keys: List[str],
+                            products: Iterable["datacube.model.DatasetType"],
+                            index: Optional["datacube.index.Index"] = None) -> List[Dataset]:
+    """
+    Build ODC Dataset objects from lean dataset projection rows.
+
+    The metadata documents only contain the projected keys, which is sufficient for
+    Datacube.group_datasets and Datacube.load_data.
+    """
+    prod_by_id = {p.id: p for p in products}
+    datasets = []
+    for row in rows:
+        dsid, prod_id, uris = row[0], row[1], row[2]
+        doc = {
+            key: val
+            for key, val in zip(keys, row[3:])
+            if val is not None
+        }
+        product = prod_by_id.get(prod_id)
+        if product is None and index is not None:
+            product = index.products.get(prod_id)
+        datasets.append(Dataset(product, doc, uris=list(uris) if uris else []))
+    return datasets
+
+
+def mv_lean_datasets(index: "datacube.index.Index",
+                     ids: Iterable[str],
+                     products: Iterable["datacube.model.DatasetType"]) -> List[Dataset]:
+    """
+    Fetch lean datasets by id, in a single query.
+
+    A lightweight alternative to index.datasets.bulk_get: only the parts of the metadata document needed
+    to group and load the datasets are fetched (no lineage or other ancillary metadata).
+
+    :param index: A datacube index (required)
+    :param ids: The dataset ids to fetch
+    :param products: The products the datasets belong to
+    :return: A list of datacube.model.Dataset objects
+    """
+    ids = list(ids)
+    if not ids:
+        return []
+    products = list(products)
+    keys = lean_dataset_keys(products)
+    s = select(*lean_dataset_cols(keys)).where(ds_table.c.id.in_(ids))
+    with get_sqlalc_engine(index).connect() as conn:
+        return lean_datasets_from_rows(conn.execute(s), keys, products, index)
+
+
+def mv_search(index: "datacube.index.Index",
+              sel: MVSelectOpts = MVSelectOpts.IDS,
+              times: Optional[Iterable[TimeSearchTerm]] = None,
+              geom: Optional[ODCGeom] = None,
+              products: Optional[Iterable["datacube.model.DatasetType"]] = None) -> Union[
+        Iterable[Iterable[Any]],
+        Iterable[str],
+        Iterable["datacube.model.Dataset"],
+        int,
+        None,
+        ODCGeom]:
+    """
+    Perform a dataset query via the space_time_view
+
+    :param products: An iterable of combinable products to search
+    :param index: A datacube index (required)
+
+    :param sel: Selection mode - a MVSelectOpts enum. Defaults to IDS.
+    :param times: A list of pairs of datetimes (with time zone)
+    :param geom: A datacube.utils.geometry.Geometry object
+
+    :return: See MVSelectOpts doc
+    """
+    if mv_search_cache.applies_to(geom) and sel in (
+            MVSelectOpts.IDS, MVSelectOpts.COUNT, MVSelectOpts.EXTENT, MVSelectOpts.DATASETS):
+        if products is None:
+            raise Exception("Must filter by product/layer")
+        summary = mv_search_cache.summary(index, products, times, geom,
+                                          with_extent=(sel == MVSelectOpts.EXTENT))
+        if sel == MVSelectOpts.IDS:
+            return summary.ids
+        if sel == MVSelectOpts.COUNT:
+            return summary.count
+        if sel == MVSelectOpts.EXTENT:
+            return summary.extent
+        return mv_lean_datasets(index, summary.ids, products)
+    engine = get_sqlalc_engine(index)
+    if sel == MVSelectOpts.DATASETS:
+        # Join the lean dataset projection directly to the search.
+        products = list(products) if products is not None else None
+        keys = lean_dataset_keys(products or [])
+        s = mv_select(lean_dataset_cols(keys), times=times, geom=geom, products=products)
+        s = s.where(ds_table.c.id == st_view.c.id)
+        with engine.connect() as conn:
+            return lean_datasets_from_rows(conn.execute(s), keys, products, index)
+    s = mv_select(sel.sel(st_view), times=times, geom=geom, products=products)
     # print(s) # Print SQL Statement
     with engine.connect() as conn:
         if sel == MVSelectOpts.ALL:
@@ -146,19 +652,43 @@ def mv_search(index: "datacube.index.Index",
                 if sel == MVSelectOpts.COUNT:
                     return r[0]
                 if sel == MVSelectOpts.EXTENT:
-                    geojson = r[0]
-                    if geojson is None:
-                        return None
-                    uniongeom = ODCGeom(json.loads(geojson), crs="EPSG:4326")
-                    if geom:
-                        intersect = uniongeom.intersection(geom)
-                        if intersect.wkt == 'POLYGON EMPTY':
-                            return None
-                        if orig_crs and orig_crs != "EPSG:4326":
-                            intersect = intersect.to_crs(orig_crs)
-                    else:
-                        intersect = uniongeom
-                    return intersect
-        if sel == MVSelectOpts.DATASETS:
-            ids = [r[0] for r in conn.execute(s)]
-            return index.datasets.bulk_get(ids)
+                    return extent_from_geojson(r[0], geom)
+
+
+def mv_search_summary(index: "datacube.index.Index",
+                      times: Optional[Iterable[TimeSearchTerm]] = None,
+                      geom: Optional[ODCGeom] = None,
+                      products: Optional[Iterable["datacube.model.DatasetType"]] = None,
+                      with_extent: bool = False,
+                      with_ids: bool = True) -> MVSearchSummary:
+    """
+    Perform a dataset query via the space_time_view, returning the count and (optionally) the
+    matching ids and the union extent from a single SQL statement.
+
+    :param index: A datacube index (required)
+    :param times: A list of pairs of datetimes (with time zone)
+    :param geom: A datacube.utils.geometry.Geometry object
+    :param products: An iterable of combinable products to search
+    :param with_extent: If true, also calculate the union extent of the matching datasets.
+    :param with_ids: If true (the default), also return the ids of the matching datasets.
+
+    :return: An MVSearchSummary object
+    """
+    if mv_search_cache.applies_to(geom):
+        if products is None:
+            raise Exception("Must filter by product/layer")
+        return mv_search_cache.summary(index, products, times, geom, with_extent=with_extent)
+    engine = get_sqlalc_engine(index)
+    stv = st_view
+    sel_cols = [count(stv.c.id)]
+    if with_extent:
+        sel_cols.extend(MVSelectOpts.EXTENT.sel(stv))
+    if with_ids:
+        sel_cols.append(func.array_agg(stv_id_text()))
+    s = mv_select(sel_cols, times=times, geom=geom, products=products)
+    with engine.connect() as conn:
+        for r in conn.execute(s):
+            ids = (r[-1] or []) if with_ids else None
+            extent = extent_from_geojson(r[1], geom) if with_extent else None
+            return MVSearchSummary(ids, r[0], extent=extent, has_extent=with_extent)
+    return MVSearchSummary([] if with_ids else None, 0, has_extent=with_extent)
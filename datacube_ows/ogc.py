@@ -42,6 +42,7 @@ babel = initialise_babel(cfg, app)
 # Initialisation of external libraries that depend on Flask
 # (controlled by environment variables)
 metrics = initialise_prometheus(app, _LOG)
+initialise_search_cache_metrics(metrics)
 
 # Protocol/Version lookup table
 OWS_SUPPORTED = supported_versions()
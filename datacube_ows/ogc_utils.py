@@ -5,6 +5,7 @@
 # SPDX-License-Identifier: Apache-2.0
 import datetime
 import logging
+from copy import copy
 from importlib import import_module
 from io import BytesIO
 from itertools import chain
@@ -377,6 +378,27 @@ class FunctionWrapper:
 
         return self._func(*calling_args, **calling_kwargs)
 
+    @property
+    def per_time_slice(self) -> bool:
+        """
+        True if the wrapped function is a multi-date aggregator that applies to each time slice independently.
+        """
+        return getattr(self._func, "per_time_slice", False)
+
+    def running_step(self) -> Optional["FunctionWrapper"]:
+        """
+        The running form of a multi-date aggregator, if the wrapped function has one.
+
+        :return: A FunctionWrapper for the step function (called with the same configured args and kwargs
+                as the wrapped function), or None.
+        """
+        step = getattr(self._func, "running_step", None)
+        if step is None:
+            return None
+        wrapper = copy(self)
+        wrapper._func = step
+        return wrapper
+
 
 def cache_control_headers(max_age: int) -> str:
     if max_age <= 0:
@@ -535,7 +557,68 @@ def create_geobox(
     return geometry.GeoBox(width, height, affine, crs)
 
 
-def xarray_image_as_png(img_data, loop_over=None, animate=False, frame_duration=1000):
+def png_save_options(compress_level=None, compress_type=None):
+    """
+    Pillow PNG save options.
+
+    :param compress_level: zlib compression level (0-9).  Default: Pillow's default.
+    :param compress_type: zlib compression strategy (e.g. zlib.Z_RLE).  Default: Pillow's default.
+    """
+    opts = {}
+    if compress_level is not None:
+        opts["compress_level"] = compress_level
+    if compress_type is not None:
+        opts["compress_type"] = compress_type
+    return opts
+
+
+def pillow_image(pillow_data, palette=None):
+    """
+    Wrap a contiguous (height, width, 4) uint8 RGBA array as a Pillow image, without copying.
+
+    :param pillow_data: RGBA image data
+    :param palette: Optional sequence of (up to 256) RGBA tuples.  If supplied, and every pixel
+                is either transparent or one of the palette colours, a palette (P mode) image is returned.
+    :return: A Pillow image
+    """
+    pillow_data = numpy.ascontiguousarray(pillow_data)
+    if palette:
+        im = palette_image(pillow_data, palette)
+        if im is not None:
+            return im
+    height, width = pillow_data.shape[:2]
+    return Image.frombuffer("RGBA", (width, height), pillow_data, "raw", "RGBA", 0, 1)
+
+
+def palette_image(pillow_data, palette):
+    """
+    Convert contiguous RGBA image data to a palette (P mode) image.
+
+    Fully transparent pixels all map to a single transparent palette entry.
+
+    :return: A Pillow P mode image, or None if the image contains colours not in the palette.
+    """
+    colours = [(0, 0, 0, 0)] + [tuple(c) for c in palette if c[3] > 0 and tuple(c) != (0, 0, 0, 0)]
+    colours = list(dict.fromkeys(colours))
+    if len(colours) > 256:
+        return None
+    # Compare pixels as packed 32 bit RGBA values.
+    keys = numpy.array(colours, dtype="uint8").view("<u4").ravel()
+    pixels = pillow_data.view("<u4")[..., 0]
+    pixels = numpy.where(pillow_data[..., 3] == 0, numpy.uint32(0), pixels)
+    order = numpy.argsort(keys)
+    sorted_keys = keys[order]
+    idx = numpy.searchsorted(sorted_keys, pixels)
+    numpy.clip(idx, 0, len(sorted_keys) - 1, out=idx)
+    if not (sorted_keys[idx] == pixels).all():
+        return None
+    im = Image.fromarray(order.astype("uint8")[idx], "P")
+    im.putpalette([band for c in colours for band in c], "RGBA")
+    return im
+
+
+def xarray_image_as_png(img_data, loop_over=None, animate=False, frame_duration=1000,
+                        compress_level=None, compress_type=None, palette=None):
     """
     Render an Xarray image as a PNG.
 
@@ -543,11 +626,16 @@ def xarray_image_as_png(img_data, loop_over=None, animate=False, frame_duration=
     :param loop_over: Optional name of a dimension on img_data.  If set, xarray_image_as_png is called in a loop
                 over all coordinate values for the named dimension.
     :param animate: Optional generate animated PNG
+    :param compress_level: Optional zlib compression level (0-9)
+    :param compress_type: Optional zlib compression strategy (e.g. zlib.Z_RLE)
+    :param palette: Optional sequence of RGBA tuples.  If every pixel of the image is either transparent or
+                one of these colours, a palette PNG is written.
     :return: A list of bytes representing a PNG image file. (Or a list of lists of bytes, if loop_over was set.)
     """
+    save_opts = png_save_options(compress_level, compress_type)
     if loop_over and not animate:
         return [
-            xarray_image_as_png(img_data.sel(**{loop_over: coord}))
+            xarray_image_as_png(img_data.sel(**{loop_over: coord}), palette=palette, **save_opts)
             for coord in img_data.coords[loop_over].values
         ]
     xcoord = None
@@ -566,34 +654,89 @@ def xarray_image_as_png(img_data, loop_over=None, animate=False, frame_duration=
     height = len(img_data.coords[ycoord])
     img_io = BytesIO()
     # Render XArray to APNG via Pillow
-    # https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#apng-sequences
     if loop_over and animate:
-        time_slices_array = [
-            xarray_image_as_png(img_data.sel(**{loop_over: coord}), animate=True)
-            for coord in img_data.coords[loop_over].values
-        ]
-        images = []
-
-        for t_slice in time_slices_array:
-            im = Image.fromarray(t_slice, "RGBA")
-            images.append(im)
-        images[0].save(img_io, "PNG", save_all=True, default_image=True, loop=0, duration=frame_duration, append_images=images)
-        img_io.seek(0)
-        return img_io.read()
+        return xarray_frames_as_apng(
+            (img_data.sel(**{loop_over: coord}) for coord in img_data.coords[loop_over].values),
+            frame_duration=frame_duration,
+            compress_level=compress_level, compress_type=compress_type
+        )
 
     if "time" in img_data.dims:
         img_data = img_data.squeeze(dim="time", drop=True)
 
-    pillow_data = render_frame(img_data.transpose(xcoord, ycoord), width, height)
+    pillow_data = rgba_buffer(img_data)
+    if pillow_data is None or img_data["red"].dims != (ycoord, xcoord):
+        pillow_data = render_frame(img_data.transpose(xcoord, ycoord), width, height)
     if not loop_over and animate:
         return pillow_data
 
     # Change PNG rendering to Pillow
-    im_final = Image.fromarray(pillow_data, "RGBA")
-    im_final.save(img_io, "PNG")
+    im_final = pillow_image(pillow_data, palette)
+    im_final.save(img_io, "PNG", **save_opts)
+    img_io.seek(0)
+    return img_io.read()
+
+def xarray_frames_as_apng(frames, frame_duration=1000, compress_level=None, compress_type=None):
+    """
+    Render a sequence of Xarray images as an animated PNG.
+
+    Frames are converted to Pillow images as they are consumed, so frames may be generated lazily
+    (e.g. one time slice at a time) without holding all the frame datasets in memory.
+
+    :param frames: An iterable of xarray datasets, each as accepted by xarray_image_as_png.
+    :param frame_duration: Frame duration in milliseconds.
+    :param compress_level: Optional zlib compression level (0-9)
+    :param compress_type: Optional zlib compression strategy (e.g. zlib.Z_RLE)
+    :return: Bytes representing an APNG image file.
+    """
+    save_opts = png_save_options(compress_level, compress_type)
+    images = [
+        pillow_image(xarray_image_as_png(frame, animate=True))
+        for frame in frames
+    ]
+    img_io = BytesIO()
+    # https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#apng-sequences
+    images[0].save(img_io, "PNG", save_all=True, default_image=True, loop=0, duration=frame_duration,
+                   append_images=images, **save_opts)
     img_io.seek(0)
     return img_io.read()
 
+
+def rgba_buffer(img_data):
+    """
+    Find the contiguous RGBA buffer backing an image xarray, if there is one.
+
+    Styles that render into a single (..., 4) uint8 buffer (e.g. colour ramps) return the red, green,
+    blue and alpha bands as views into that buffer, which can then be encoded without further copies.
+
+    :param img_data: An xarray dataset containing uint8 variables red, green, blue and alpha.
+    :return: The buffer, with the same shape as the bands plus a trailing channel axis, or None if
+            the bands are not views into a shared contiguous buffer.
+    """
+    if len(img_data.data_vars) != 4:
+        return None
+    try:
+        channels = [img_data[band] for band in ("red", "green", "blue", "alpha")]
+    except KeyError:
+        return None
+    if any(c.dims != channels[0].dims for c in channels):
+        return None
+    arrays = [c.values for c in channels]
+    base = arrays[0]
+    while isinstance(base.base, numpy.ndarray):
+        base = base.base
+    if base.dtype != numpy.uint8 or not base.flags.c_contiguous or base.size != 4 * arrays[0].size:
+        return None
+    buffer = base.reshape(arrays[0].shape + (4,))
+    start = buffer.__array_interface__["data"][0]
+    for i, arr in enumerate(arrays):
+        if (arr.__array_interface__["data"][0] != start + i
+                or arr.shape != buffer.shape[:-1]
+                or arr.strides != buffer.strides[:-1]):
+            return None
+    return buffer
+
+
 def render_frame(img_data, width, height):
     """Render to a 3D numpy array an Xarray RGB(A) input
 
@@ -603,11 +746,9 @@ def render_frame(img_data, width, height):
         height ([type]): Height of the frame to render
 
     Returns:
-        numpy.ndarray: 3D Rendered Xarray as numpy array
+        numpy.ndarray: Contiguous (height, width, 4) uint8 numpy array
     """
-    masked = False
-    last_band = None
-    buffer = numpy.zeros((4, width, height), numpy.uint8)
+    buffer = numpy.zeros((height, width, 4), numpy.uint8)
     band_index = {
         "red": 0,
         "green": 1,
@@ -615,15 +756,8 @@ def render_frame(img_data, width, height):
         "alpha": 3,
     }
     for band in img_data.data_vars:
-        index = band_index[band]
-        band_data = img_data[band].values
-        if band == "alpha":
-            masked = True
-        buffer[index, :, :] = band_data
-        index += 1
-        last_band = band_data
-    if not masked:
-        alpha_mask = numpy.empty(last_band.shape).astype('uint8')
-        alpha_mask.fill(255)
-        buffer[3, :, :] = alpha_mask
-    return buffer.transpose()
+        # img_data is (x, y) - write the transpose.
+        buffer[:, :, band_index[band]] = img_data[band].values.T
+    if "alpha" not in img_data.data_vars:
+        buffer[:, :, 3] = 255
+    return buffer
@@ -16,6 +16,7 @@ import json
 import logging
 import math
 import os
+import zlib
 from collections.abc import Mapping
 from enum import Enum
 from importlib import import_module
@@ -35,17 +36,31 @@ from datacube_ows.config_utils import (FlagProductBands, OWSConfigEntry,
                                        get_file_loc, import_python_obj,
                                        load_json_obj)
 from datacube_ows.cube_pool import ODCInitException, cube, get_cube
+from datacube_ows.mv_index import mv_search_cache
 from datacube_ows.ogc_utils import (ConfigException, FunctionWrapper,
                                     create_geobox, local_solar_date_range)
 from datacube_ows.resource_limits import (OWSResourceManagementRules,
                                           parse_cache_age)
 from datacube_ows.styles import StyleDef
+from datacube_ows.tile_cache import TileCache
 from datacube_ows.tile_matrix_sets import TileMatrixSet
 from datacube_ows.utils import (group_by_begin_datetime, group_by_mosaic,
                                 group_by_solar)
 
 _LOG = logging.getLogger(__name__)
 
+# zlib compression strategies for PNG encoding.
+PNG_STRATEGIES = {
+    "default": zlib.Z_DEFAULT_STRATEGY,
+    "filtered": zlib.Z_FILTERED,
+    "huffman_only": zlib.Z_HUFFMAN_ONLY,
+    "rle": zlib.Z_RLE,
+    "fixed": zlib.Z_FIXED,
+}
+
+# Floating point precisions that style calculations may be performed in.
+RENDER_PRECISIONS = ("float64", "float32")
+
 
 def read_config(path=None):
     cwd = None
@@ -488,6 +503,7 @@ class OWSNamedLayer(OWSExtensibleConfigEntry, OWSLayer):
             self.parse_image_processing(cfg["image_processing"])
         except KeyError as e:
             raise ConfigException(f"Missing required config ({str(e)}) in image processing section for layer {self.name}")
+        self.parse_png_encoding(cfg.get("png_encoding", {}))
         self.identifiers = cfg.get("identifiers", {})
         for auth in self.identifiers.keys():
             if auth not in self.global_cfg.authorities:
@@ -587,11 +603,40 @@ class OWSNamedLayer(OWSExtensibleConfigEntry, OWSLayer):
             raise ConfigException("Solar correction requires manual_merge.")
         if self.data_manual_merge and not self.solar_correction and not self.multi_product:
             _LOG.warning("Manual merge is only recommended where solar correction is required and for multi-product layers.")
+        try:
+            self.manual_merge_threads = int(cfg.get("manual_merge_threads", 1))
+        except ValueError:
+            raise ConfigException(f"manual_merge_threads must be an integer in layer {self.name}")
+        if self.manual_merge_threads < 1:
+            raise ConfigException(f"manual_merge_threads must be at least 1 in layer {self.name}")
 
         if cfg.get("fuse_func"):
             self.fuse_func = FunctionWrapper(self, cfg["fuse_func"])
         else:
             self.fuse_func = None
+        render_precision = cfg.get("render_precision", self.global_cfg.wms_render_precision)
+        if render_precision not in RENDER_PRECISIONS:
+            raise ConfigException(
+                f"Invalid render_precision {render_precision} in layer {self.name}: "
+                f"must be one of {', '.join(RENDER_PRECISIONS)}")
+        self.render_precision = numpy.dtype(render_precision)
+
+    # pylint: disable=attribute-defined-outside-init
+    def parse_png_encoding(self, cfg):
+        self.png_compress_level = cfg.get("compress_level")
+        if self.png_compress_level is not None:
+            if not isinstance(self.png_compress_level, int) or not 0 <= self.png_compress_level <= 9:
+                raise ConfigException(f"png_encoding compress_level must be an integer from 0 to 9 in layer {self.name}")
+        strategy = cfg.get("strategy")
+        if strategy is None:
+            self.png_compress_type = None
+        elif strategy in PNG_STRATEGIES:
+            self.png_compress_type = PNG_STRATEGIES[strategy]
+        else:
+            raise ConfigException(
+                f"Invalid png_encoding strategy {strategy} in layer {self.name}: "
+                f"must be one of {', '.join(PNG_STRATEGIES.keys())}")
+        self.png_palette = bool(cfg.get("palette", False))
 
     # pylint: disable=attribute-defined-outside-init
     def ready_image_processing(self, dc):
@@ -843,12 +888,20 @@ class OWSNamedLayer(OWSExtensibleConfigEntry, OWSLayer):
         else:
             dc = get_cube()
         self.hide = False
+        old_ranges = self._ranges if self.ready else None
         self._ranges = None
         try:
             from datacube_ows.product_ranges import get_ranges
             self._ranges = get_ranges(dc, self)
             if self._ranges is None:
                 raise Exception("Null product range")
+            if old_ranges is not None and (old_ranges["times"] != self._ranges["times"]
+                                           or old_ranges["bboxes"] != self._ranges["bboxes"]):
+                mv_search_cache.clear(p.id for p in self.products)
+                if self.global_cfg.tile_cache:
+                    self.global_cfg.tile_cache.invalidate(
+                        self.name,
+                        set(old_ranges["times"]).symmetric_difference(self._ranges["times"]))
             self.bboxes = self.extract_bboxes()
             if self.default_time_rule == DEF_TIME_EARLIEST:
                 self.default_time = self._ranges["start_time"]
@@ -1255,6 +1308,7 @@ class OWSConfig(OWSMetadataConfig):
         else:
             self.msg_file_name = cfg.get("message_file")
         self.parse_metadata(cfg)
+        self.parse_search_cache(cfg.get("search_cache", {}))
         self.allowed_urls = cfg["allowed_urls"]
         self.info_url = cfg["info_url"]
         self.contact_info = ContactInfo.parse(cfg.get("contact_info"), self)
@@ -1313,6 +1367,26 @@ class OWSConfig(OWSMetadataConfig):
             self.published_CRSs[alias]["gml_name"] = make_gml_name(alias)
             self.published_CRSs[alias]["alias_of"] = target_crs
 
+    def parse_search_cache(self, cfg):
+        self.search_cache_max_entries = cfg.get("max_entries", 0)
+        self.search_cache_max_age = cfg.get("max_age", 300)
+        self.search_cache_grid_size = cfg.get("grid_size", 0.1)
+        self.search_cache_max_cells = cfg.get("max_cells", 4)
+        if not isinstance(self.search_cache_max_entries, int) or self.search_cache_max_entries < 0:
+            raise ConfigException("search_cache max_entries must be a non-negative integer")
+        if self.search_cache_max_age <= 0:
+            raise ConfigException("search_cache max_age must be positive")
+        if self.search_cache_grid_size <= 0:
+            raise ConfigException("search_cache grid_size must be positive")
+        if not isinstance(self.search_cache_max_cells, int) or self.search_cache_max_cells < 1:
+            raise ConfigException("search_cache max_cells must be a positive integer")
+        mv_search_cache.configure(
+            max_entries=self.search_cache_max_entries,
+            max_age=self.search_cache_max_age,
+            grid_size=self.search_cache_grid_size,
+            max_cells=self.search_cache_max_cells,
+        )
+
     def parse_wms(self, cfg):
         if not self.wms and not self.wmts:
             cfg = {}
@@ -1332,6 +1406,11 @@ class OWSConfig(OWSMetadataConfig):
             )
         self.authorities = cfg.get("authorities", {})
         self.user_band_math_extension = cfg.get("user_band_math_extension", False)
+        self.wms_render_precision = cfg.get("render_precision", "float64")
+        if self.wms_render_precision not in RENDER_PRECISIONS:
+            raise ConfigException(
+                f"Invalid render_precision {self.wms_render_precision} in wms section: "
+                f"must be one of {', '.join(RENDER_PRECISIONS)}")
         self.wms_cap_cache_age = parse_cache_age(cfg, "caps_cache_maxage", "wms")
         if "attribution" in cfg:
             _LOG.warning("Attribution entry in top level 'wms' section will be ignored. Attribution should be moved to the 'global' section")
@@ -1356,6 +1435,14 @@ class OWSConfig(OWSMetadataConfig):
             if self.native_wcs_format not in self.wcs_formats_by_name:
                 raise ConfigException(f"Configured native WCS format ({self.native_wcs_format}) not a supported format.")
             self.wcs_tiff_statistics = cfg.get("calculate_tiff_statistics", True)
+            self.wcs_dask_chunk_size = cfg.get("dask_chunk_size")
+            if self.wcs_dask_chunk_size is not None:
+                try:
+                    self.wcs_dask_chunk_size = int(self.wcs_dask_chunk_size)
+                except ValueError:
+                    raise ConfigException(f"dask_chunk_size in wcs section must be an integer: {self.wcs_dask_chunk_size}")
+                if self.wcs_dask_chunk_size < 1:
+                    raise ConfigException(f"dask_chunk_size in wcs section must be positive: {self.wcs_dask_chunk_size}")
             self.wcs_cap_cache_age = parse_cache_age(cfg, "caps_cache_maxage", "wcs")
             self.wcs_default_descov_age = parse_cache_age(cfg, "default_desc_cache_maxage", "wcs")
         else:
@@ -1364,10 +1451,18 @@ class OWSConfig(OWSMetadataConfig):
             self.wcs_formats_by_mime = {}
             self.native_wcs_format = None
             self.wcs_tiff_statistics = False
+            self.wcs_dask_chunk_size = None
             self.wcs_cap_cache_age = 0
             self.wcs_default_descov_age = 0
 
     def parse_wmts(self, cfg):
+        try:
+            self.wmts_max_batch_tiles = int(cfg.get("max_batch_tiles", 0))
+        except ValueError:
+            raise ConfigException(f"max_batch_tiles in wmts section must be an integer: {cfg.get('max_batch_tiles')}")
+        if self.wmts_max_batch_tiles < 0:
+            raise ConfigException(f"max_batch_tiles in wmts section cannot be negative: {self.wmts_max_batch_tiles}")
+        self.tile_cache = TileCache.from_cfg(cfg.get("tile_cache"))
         tms_cfgs = TileMatrixSet.default_tm_sets.copy()
         if "tile_matrix_sets" in cfg:
             for identifier, tms in cfg["tile_matrix_sets"].items():
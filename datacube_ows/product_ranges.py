@@ -6,13 +6,16 @@
 
 #pylint: skip-file
 
+import hashlib
 import math
 from datetime import datetime
 
 import datacube
 from psycopg2.extras import Json
 from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
 
+from datacube_ows.mv_index import FOOTPRINT_ALL_DATES, FOOTPRINT_TOLERANCES
 from datacube_ows.ows_configuration import get_config
 from datacube_ows.utils import get_sqlconn
 
@@ -265,6 +268,140 @@ def create_range_entry(dc, product, crses, time_resolution):
   conn.close()
 
 
+def invalidate_tile_cache(ows_layers):
+  # The data for any date may have changed, so discard all cached tiles for the layers.
+  tile_cache = get_config().tile_cache
+  if tile_cache is None:
+      return
+  for layer in ows_layers:
+      if layer:
+          tile_cache.invalidate(layer.name)
+
+
+def create_footprint_entries(dc, product, time_resolution):
+  print("Updating footprints for ODC product %s..." % product.name)
+  # NB. product is an ODC product
+  conn = get_sqlconn(dc)
+  txn = conn.begin()
+  prodid = product.id
+
+  conn.execute(text("""set timezone to 'Etc/UTC'"""))
+
+  if time_resolution.is_subday():
+      date_formatter = lambda d: d.isoformat()
+  else:
+      date_formatter = lambda d: d.strftime("%Y-%m-%d")
+
+  # Group dataset ids by date, as for the product ranges.
+  date_ids = {}
+  date_extent_hashes = {}
+  results = conn.execute(text(
+      """
+      select
+            id,
+            lower(temporal_extent), upper(temporal_extent),
+            ST_X(ST_Centroid(spatial_extent)),
+            md5(ST_AsBinary(spatial_extent))
+      from public.space_time_view
+      WHERE dataset_type_ref = :p_id
+      """),
+      {"p_id": prodid})
+  for result in results:
+      dsid, dt1, dt2, lon, ext_hash = result
+      if time_resolution.is_solar():
+          dt = dt1 + (dt2 - dt1) / 2
+          date = datacube.api.query._convert_to_solar_time(dt, lon).date()
+      else:
+          date = dt1
+      date_ids.setdefault(date_formatter(date), []).append(dsid)
+      date_extent_hashes.setdefault(date_formatter(date), []).append(f"{dsid}:{ext_hash}")
+
+  # Hash of the dataset ids and extents for each date, to detect which dates have changed since the last update.
+  date_hashes = {
+      date: hashlib.md5(",".join(sorted(ext_hashes)).encode("utf-8")).hexdigest()
+      for date, ext_hashes in date_extent_hashes.items()
+  }
+
+  try:
+      results = conn.execute(text("""
+        SELECT date, datasets_hash
+        FROM wms.product_footprints
+        WHERE product_id = :p_id
+        AND level = 0
+        """),
+        {"p_id": prodid})
+  except ProgrammingError:
+      print("Footprints table missing - run with the --schema option to create it. Skipping footprints.")
+      txn.rollback()
+      conn.close()
+      return
+  old_hashes = {date: dhash for date, dhash in results}
+  has_all_dates = FOOTPRINT_ALL_DATES in old_hashes
+  old_hashes.pop(FOOTPRINT_ALL_DATES, None)
+
+  changed = [date for date, dhash in date_hashes.items() if old_hashes.get(date) != dhash]
+  removed = [date for date in old_hashes if date not in date_hashes]
+  if not changed and not removed and has_all_dates:
+      print("Footprints for ODC product %s are up to date." % product.name)
+      txn.rollback()
+      conn.close()
+      return
+
+  # Only dates whose datasets have changed are rebuilt.
+  conn.execute(text("""
+    DELETE FROM wms.product_footprints
+    WHERE product_id = :p_id
+    AND date = ANY(CAST(:dates AS varchar[]))
+    """),
+    {"p_id": prodid, "dates": changed + removed + [FOOTPRINT_ALL_DATES]})
+
+  levels = list(range(len(FOOTPRINT_TOLERANCES)))
+  for date in changed:
+      conn.execute(text("""
+        INSERT INTO wms.product_footprints
+        (product_id, date, level, datasets_hash, footprint)
+        SELECT :p_id, :date, lvl.level, :dhash,
+               CASE WHEN lvl.tolerance > 0
+                    THEN ST_SimplifyPreserveTopology(fp.footprint, lvl.tolerance)
+                    ELSE fp.footprint
+               END
+        FROM (
+            SELECT ST_Union(spatial_extent) as footprint
+            FROM public.space_time_view
+            WHERE id = ANY(CAST(:ids AS uuid[]))
+        ) as fp,
+        unnest(CAST(:levels AS smallint[]), CAST(:tolerances AS float8[])) as lvl(level, tolerance)
+        """),
+        {"p_id": prodid, "date": date, "dhash": date_hashes[date],
+         "ids": [str(i) for i in date_ids[date]],
+         "levels": levels, "tolerances": list(FOOTPRINT_TOLERANCES)})
+
+  # Footprint over all dates - also marks the product as having footprints.
+  # Each level is the union of the (already simplified) per-date footprints at that level.
+  conn.execute(text("""
+    INSERT INTO wms.product_footprints
+    (product_id, date, level, footprint)
+    SELECT :p_id, :all_dates, lvl.level,
+           CASE WHEN lvl.tolerance > 0
+                THEN ST_SimplifyPreserveTopology(fp.footprint, lvl.tolerance)
+                ELSE fp.footprint
+           END
+    FROM unnest(CAST(:levels AS smallint[]), CAST(:tolerances AS float8[])) as lvl(level, tolerance)
+    CROSS JOIN LATERAL (
+        SELECT ST_Union(footprint) as footprint
+        FROM wms.product_footprints
+        WHERE product_id = :p_id
+        AND level = lvl.level
+        AND date != :all_dates
+    ) as fp
+    """),
+    {"p_id": prodid, "all_dates": FOOTPRINT_ALL_DATES,
+     "levels": levels, "tolerances": list(FOOTPRINT_TOLERANCES)})
+
+  txn.commit()
+  conn.close()
+
+
 def bbox_projections(starting_box, crses):
    result = {}
    for crsid, crs in crses.items():
@@ -371,12 +508,15 @@ def add_ranges(dc, product_names, merge_only=False):
                         time_resolution = new_tr
                 if time_resolution is not None:
                     create_range_entry(dc, dc_product, get_crses(), time_resolution)
+                    create_footprint_entries(dc, dc_product, time_resolution)
+                    invalidate_tile_cache(ows_prods["ows"])
                 else:
                     print("Could not determine time_resolution for product: ", pname)
             else:
                 print("Could not find any datasets for: ", pname)
     for mp in ows_multiproducts:
         create_multiprod_range_entry(dc, mp, get_crses())
+        invalidate_tile_cache([mp])
 
     print("Done.")
     return errors
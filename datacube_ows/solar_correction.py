@@ -0,0 +1,109 @@
+# This file is part of datacube-ows, part of the Open Data Cube project.
+# See https://opendatacube.org for more information.
+#
+# Copyright (c) 2017-2021 OWS Contributors
+# SPDX-License-Identifier: Apache-2.0
+import math
+from datetime import datetime
+from typing import Iterable, Optional
+
+import numpy
+import xarray
+from datacube.utils import geometry
+from pytz import utc
+
+# The solar zenith angle is calculated once per block of SOLAR_GRID_BLOCK_SIZE x SOLAR_GRID_BLOCK_SIZE pixels.
+SOLAR_GRID_BLOCK_SIZE = 32
+
+
+# Solar angle correction functions
+def declination_rad(dt: datetime) -> float:
+    # Estimate solar declination from a datetime.  (value returned in radians).
+    # Formula taken from https://en.wikipedia.org/wiki/Position_of_the_Sun#Declination_of_the_Sun_as_seen_from_Earth
+    timedel = dt - datetime(dt.year, 1, 1, 0, 0, 0, tzinfo=utc)
+    day_count = timedel.days + timedel.seconds / (60.0 * 60.0 * 24.0)
+    return -1.0 * math.radians(23.44) * math.cos(2 * math.pi / 365 * (day_count + 10))
+
+
+def cosine_of_solar_zenith(lat, lon, utc_dt: datetime):
+    # Estimate cosine of solar zenith angle
+    # (angle between sun and local zenith) at requested latitude, longitude and datetime.
+    # lat and lon may be scalars or numpy arrays (in degrees).
+    # Formula taken from https://en.wikipedia.org/wiki/Solar_zenith_angle
+    utc_seconds_since_midnight = ((utc_dt.hour * 60) + utc_dt.minute) * 60 + utc_dt.second
+    utc_hour_deg_angle = (utc_seconds_since_midnight / (60 * 60 * 24) * 360.0) - 180.0
+    local_hour_angle_rad = numpy.radians(utc_hour_deg_angle + lon)
+    latitude_rad = numpy.radians(lat)
+    solar_decl_rad = declination_rad(utc_dt)
+    return numpy.sin(latitude_rad) * math.sin(solar_decl_rad) \
+        + numpy.cos(latitude_rad) * math.cos(solar_decl_rad) * numpy.cos(local_hour_angle_rad)
+
+
+def block_centres(size: int, block_size: int) -> numpy.ndarray:
+    # Pixel coordinates of the centres of the blocks covering size pixels.
+    starts = numpy.arange(0, size, block_size)
+    ends = numpy.minimum(starts + block_size, size)
+    return (starts + ends) / 2.0
+
+
+class SolarZenithGrid:
+    """
+    Vectorised solar angle correction over the pixels of a geobox.
+
+    The latitude and longitude of the centre of each block of pixels is calculated once per geobox,
+    so the zenith cosine for a dataset is a handful of numpy operations over the (coarse) block grid,
+    shared by all bands of the dataset.
+    """
+    def __init__(self, geobox: geometry.GeoBox, block_size: int = SOLAR_GRID_BLOCK_SIZE) -> None:
+        self.geobox = geobox
+        self.block_size = block_size
+        height, width = geobox.shape
+        cols, rows = numpy.meshgrid(block_centres(width, block_size), block_centres(height, block_size))
+        aff = geobox.affine
+        x = aff.a * cols + aff.b * rows + aff.c
+        y = aff.d * cols + aff.e * rows + aff.f
+        to_geo = geobox.crs.transformer_to_crs(geometry.CRS("EPSG:4326"))
+        self.lon, self.lat = to_geo(x, y)
+
+    def cosine(self, utc_dt: datetime) -> numpy.ndarray:
+        """
+        The cosine of the solar zenith angle at a given time, for every pixel of the geobox.
+
+        :param utc_dt: A timezone-aware datetime
+        :return: A float32 array of the geobox's shape.
+        """
+        csz = cosine_of_solar_zenith(self.lat, self.lon, utc_dt.astimezone(utc)).astype(numpy.float32)
+        height, width = self.geobox.shape
+        csz = numpy.repeat(csz, self.block_size, axis=0)[:height]
+        return numpy.repeat(csz, self.block_size, axis=1)[:, :width]
+
+    def correct(self, data: xarray.Dataset, dataset, bands: Iterable[str],
+                utc_dt: Optional[datetime] = None) -> xarray.Dataset:
+        """
+        Apply solar angle correction to bands of data loaded for a dataset on the geobox.
+
+        Bands are converted to float32 (if necessary) and corrected in place.  Nodata pixels are
+        left unchanged.
+
+        :param data: An xarray Dataset loaded on the geobox
+        :param dataset: The ODC dataset the data was loaded from
+        :param bands: The bands to correct
+        :param utc_dt: The time to correct for.  Defaults to the dataset's center_time.
+        :return: data
+        """
+        csz = self.cosine(utc_dt or dataset.center_time)
+        spatial_dims = tuple(self.geobox.dimensions)
+        for band in bands:
+            arr = data[band]
+            if arr.dims[-2:] != spatial_dims:
+                arr = arr.transpose(..., *spatial_dims)
+            if arr.dtype != numpy.float32:
+                arr = arr.astype(numpy.float32)
+            values = arr.values
+            nodata = arr.attrs.get("nodata")
+            if nodata is None or numpy.isnan(nodata):
+                numpy.divide(values, csz, out=values)
+            else:
+                numpy.divide(values, csz, out=values, where=(values != numpy.float32(nodata)))
+            data[band] = arr
+        return data
@@ -0,0 +1,9 @@
+-- Checking the PostGIS extension is installed
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'postgis') THEN
+        RAISE EXCEPTION 'The PostGIS extension is not installed in this database. It must be installed (with "create extension postgis") by a superuser or the database owner before running datacube-ows-update --schema';
+    END IF;
+END
+$$
@@ -0,0 +1,12 @@
+-- Creating/replacing product footprints table
+
+create table if not exists wms.product_footprints (
+    product_id smallint not null references agdc.dataset_type (id),
+    date varchar(32) not null,
+    level smallint not null,
+    datasets_hash varchar(32),
+
+    footprint geometry(Geometry, 4326),
+
+    constraint pk_product_footprints primary key (product_id, date, level)
+);
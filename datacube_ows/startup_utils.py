@@ -26,6 +26,7 @@ __all__ = [
     'parse_config_file',
     'initialise_flask',
     'initialise_prometheus',
+    'initialise_search_cache_metrics',
     'CredentialManager',
 ]
 
@@ -211,6 +212,21 @@ def initialise_prometheus(app, log=None):
         return metrics
     return FakeMetrics()
 
+def initialise_search_cache_metrics(metrics):
+    # Hit/miss counters for the dataset search cache
+    if isinstance(metrics, FakeMetrics):
+        return None
+    from prometheus_client import Counter
+
+    from datacube_ows.mv_index import mv_search_cache
+    mv_search_cache.metric = Counter(
+        "ows_search_cache",
+        "Dataset search cache lookups, by result (hit or miss)",
+        ["result"],
+        registry=metrics.registry
+    )
+    return mv_search_cache.metric
+
 def request_extractor():
     qreq = request.args.get('request')
     return qreq
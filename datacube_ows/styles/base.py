@@ -5,8 +5,8 @@
 # SPDX-License-Identifier: Apache-2.0
 import io
 import logging
-from typing import (Any, Iterable, List, Mapping, MutableMapping, Optional,
-                    Set, Sized, Tuple, Type, Union, cast)
+from typing import (Any, Iterable, Iterator, List, Mapping, MutableMapping,
+                    Optional, Set, Sized, Tuple, Type, Union, cast)
 
 import datacube.model
 import numpy as np
@@ -16,15 +16,17 @@ from PIL import Image
 
 import datacube_ows.band_utils
 from datacube_ows.config_utils import (CFG_DICT, RAW_CFG, AbstractMaskRule,
-                                       FlagBand, FlagProductBands,
-                                       OWSConfigEntry, OWSEntryNotFound,
+                                       FlagBand, FlagMaskCache,
+                                       FlagProductBands, OWSConfigEntry,
+                                       OWSEntryNotFound,
                                        OWSExtensibleConfigEntry,
                                        OWSFlagBandStandalone,
                                        OWSIndexedConfigEntry,
                                        OWSMetadataConfig)
 from datacube_ows.legend_utils import get_image_from_url
 from datacube_ows.ogc_exceptions import WMSException
-from datacube_ows.ogc_utils import ConfigException, FunctionWrapper
+from datacube_ows.ogc_utils import (ConfigException, FunctionWrapper,
+                                    rgba_buffer)
 
 _LOG: logging.Logger = logging.getLogger(__name__)
 
@@ -253,6 +255,9 @@ class StyleDefBase(OWSExtensibleConfigEntry, OWSMetadataConfig):
                 self.flag_bands.add(band)
         for fp in self.flag_products:
             fp.make_ready(dc)
+        for mask in self.masks:
+            # Compile to bit tests.  (Stand-alone flag bands have no flags_definition until data is supplied.)
+            mask.compile(getattr(mask.flag_band, "flags_def", None))
         if not self.stand_alone:
             # TODO: Should be able to remove this pyre-ignore after ows_configuration is typed.
             # pyre-ignore[16]
@@ -294,24 +299,29 @@ class StyleDefBase(OWSExtensibleConfigEntry, OWSMetadataConfig):
         :return: A spatial mask with same dimensions and coordinates as data (including time).
         """
 
-        def render_mask(data: xr.Dataset, mask: StyleMask) -> xr.DataArray:
-            """
-            Calculate a style mask.
-            :param data: Raw Data
-            :param mask: A StyleMask object to calculate
-            :return: A DataArray boolean mask with no time dimension
-            """
-            pq_data = getattr(data, mask.band)
-            odc_mask = mask.create_mask(pq_data)
-            return odc_mask
-
-        result = extra_mask
+        # All masks are evaluated as compiled bit tests directly on the flag band arrays, sharing
+        # any tests repeated between masks, and only wrapped as a DataArray once.
+        cache = FlagMaskCache()
+        template: Optional[xr.DataArray] = None
+        style_mask: Optional[np.ndarray] = None
         for mask in self.masks:
-            mask_data = render_mask(data, mask)
+            pq_data = data[mask.band]
+            if template is None:
+                template = pq_data
+            elif pq_data.dims != template.dims:
+                pq_data = pq_data.transpose(*template.dims)
+            mask_data = mask.evaluate(pq_data, cache)
+            if style_mask is None:
+                style_mask = mask_data
+            else:
+                style_mask = style_mask & mask_data
+        result = extra_mask
+        if template is not None:
+            mask_da = xr.DataArray(style_mask, coords=template.coords, dims=template.dims)
             if result is None:
-                result = mask_data
+                result = mask_da
             else:
-                result = result & mask_data
+                result = result & mask_da
         return result
 
     def apply_mask_to_image(self, img_data: xr.Dataset, mask: Optional[xr.DataArray],
@@ -338,15 +348,23 @@ class StyleDefBase(OWSExtensibleConfigEntry, OWSMetadataConfig):
             alpha = img_data.alpha
         if mask is not None:
             if output_date_count == 1 and input_date_count > 1:
-                flat_mask: Optional[xr.DataArray] = None
-                for coord in mask.coords["time"].values:
-                    mask_slice = mask.sel(time=coord)
-                    if flat_mask is None:
-                        flat_mask = mask_slice
-                    else:
-                        flat_mask &= mask_slice
-                mask = cast(xr.DataArray, flat_mask)
-            alpha = alpha.where(mask, other=0)
+                # Valid only where valid for every date: a single all-reduction over the time axis.
+                mask = mask.all(dim="time")
+            masked_alpha = alpha.where(mask, other=0)
+            extra_dims = [d for d in masked_alpha.dims if d not in alpha.dims]
+            if (masked_alpha.size == alpha.size
+                    and all(masked_alpha.sizes[d] == 1 for d in extra_dims)
+                    and rgba_buffer(img_data) is not None):
+                # Write back into the shared RGBA buffer, so it can still be encoded without copying.
+                np.copyto(alpha.values,
+                          masked_alpha.squeeze(dim=extra_dims).transpose(*alpha.dims).values,
+                          casting="unsafe")
+                if extra_dims:
+                    alpha = alpha.expand_dims(
+                        {d: masked_alpha.coords[d].values for d in extra_dims}
+                    ).transpose(*masked_alpha.dims)
+            else:
+                alpha = masked_alpha
         img_data = img_data.assign({"alpha": alpha})
         return img_data
 
@@ -360,6 +378,7 @@ class StyleDefBase(OWSExtensibleConfigEntry, OWSMetadataConfig):
         """
         input_date_count = self.count_dates(data)
         mdh = self.get_multi_date_handler(input_date_count)
+        data = self.prepare_render_data(data)
         if mdh is None:
             img_data = self.transform_single_date_data(data)
         else:
@@ -373,6 +392,31 @@ class StyleDefBase(OWSExtensibleConfigEntry, OWSMetadataConfig):
         img_data = self.apply_mask_to_image(img_data, mask, input_date_count, output_date_count)
         return img_data
 
+    def prepare_render_data(self, data: xr.Dataset) -> xr.Dataset:
+        """
+        Convert raw data to the layer's render precision before styling.
+
+        If the layer's render_precision is float32, integer and float64 data bands are converted
+        to float32, so style calculations are carried out in float32.  Flag bands are left unchanged.
+
+        :param data: Raw data, all bands.
+        :return: Data, with data bands in the render precision.
+        """
+        precision = getattr(self.product, "render_precision", None)
+        if precision != np.float32:
+            return data
+        converted = {
+            band: arr.astype(precision)
+            for band, arr in data.data_vars.items()
+            if band not in self.flag_bands
+            and "flags_definition" not in arr.attrs
+            and arr.dtype.kind in "fiu"
+            and arr.dtype != precision
+        }
+        if not converted:
+            return data
+        return data.assign(converted)
+
     def transform_single_date_data(self, data: xr.Dataset) -> xr.Dataset:
         """
         Apply style to raw data to make an RGBA image xarray (single time slice only)
@@ -383,6 +427,16 @@ class StyleDefBase(OWSExtensibleConfigEntry, OWSMetadataConfig):
         """
         raise NotImplementedError()
 
+    def png_palette(self) -> Optional[List[Tuple[int, int, int, int]]]:
+        """
+        The RGBA colours this style can render, for palette PNG encoding.
+
+        Over-ridden by subclasses that render a small fixed set of colours.
+
+        :return: A list of RGBA tuples, or None.
+        """
+        return None
+
     def render_legend(self, dates: Union[int, List[Any]]) -> Optional["PIL.Image.Image"]:
         """
         Render legend, if possible
@@ -492,6 +546,9 @@ class StyleDefBase(OWSExtensibleConfigEntry, OWSMetadataConfig):
 
         non_animate_requires_aggregator = True
 
+        # Subclasses that implement aggregation_input() and render_aggregate() may apply running aggregators.
+        supports_running_aggregation: bool = False
+
         def __init__(self, style: "StyleDefBase", cfg: CFG_DICT) -> None:
             """
             First stage initialisation
@@ -517,7 +574,8 @@ class StyleDefBase(OWSExtensibleConfigEntry, OWSMetadataConfig):
                                                   cast(CFG_DICT, cfg["aggregator_function"]),
                                                                              stand_alone=self.style.stand_alone)
             elif self.animate:
-                self.aggregator = FunctionWrapper(style.product, lambda x: x, stand_alone=True)
+                self.aggregator = FunctionWrapper(style.product, datacube_ows.band_utils.multi_date_pass,
+                                                  stand_alone=True)
                 self.frame_duration = cast(int, cfg.get("frame_duration", 1000))
             else:
                 self.aggregator = None
@@ -525,6 +583,17 @@ class StyleDefBase(OWSExtensibleConfigEntry, OWSMetadataConfig):
                     raise ConfigException("Aggregator function is required for non-animated multi-date handlers.")
             self.legend_cfg = self.Legend(self, raw_cfg.get("legend", {}))
             self.preserve_user_date_order = cast(bool, cfg.get("preserve_user_date_order", False))
+            self.per_time_slice = bool(self.animate and self.aggregator and self.aggregator.per_time_slice)
+            self.running_aggregator: Optional[FunctionWrapper] = None
+            if self.aggregator and self.supports_running_aggregation:
+                self.running_aggregator = self.aggregator.running_step()
+
+        @property
+        def time_sliced(self) -> bool:
+            """
+            Can requests be rendered one time slice at a time?  (See transform_time_slices)
+            """
+            return self.per_time_slice or self.running_aggregator is not None
 
         def applies_to(self, count: int) -> bool:
             """Does this multidate handler apply to a request with this number of dates?"""
@@ -549,6 +618,63 @@ class StyleDefBase(OWSExtensibleConfigEntry, OWSMetadataConfig):
             """
             return self.style.transform_single_date_data(data)
 
+        def aggregation_input(self, data: xr.Dataset) -> Union[xr.Dataset, xr.DataArray]:
+            """
+            Convert raw data to the values passed to the aggregator.
+
+            :param data: Raw data
+            :return: Aggregator input.  (Raw data by default.)
+            """
+            return data
+
+        def render_aggregate(self, agg: Union[xr.Dataset, xr.DataArray]) -> xr.Dataset:
+            """
+            Render the output of the aggregator as an image.
+
+            For implementation by subclasses that support running aggregation.
+
+            :param agg: Aggregator output
+            :return: RGBA image xarray.
+            """
+            raise NotImplementedError()
+
+        def transform_time_slices(self, slices: Iterable[Tuple[xr.Dataset, Optional[xr.DataArray]]]
+                                  ) -> Iterator[xr.Dataset]:
+            """
+            Apply image transformation and masking one time slice at a time.
+
+            Only one time slice of raw data need be held in memory at once: animation frames are
+            rendered as each slice is consumed, and running aggregators fold each slice into an
+            accumulator.  Only supported if time_sliced is True.
+
+            :param slices: Iterable of (raw data, extent mask) pairs, one per date, each with a time
+                    dimension of length 1.  Slices are consumed one at a time, so may be loaded lazily.
+            :return: Iterator over masked RGBA image xarrays - one frame per date for animations,
+                    or a single image for aggregators.
+            """
+            style = self.style
+            agg = None
+            flat_mask: Optional[xr.DataArray] = None
+            for data, extent_mask in slices:
+                mask = style.to_mask(data, extent_mask)
+                if mask is not None and "time" in mask.dims:
+                    mask = mask.squeeze(dim="time", drop=True)
+                data = style.prepare_render_data(data)
+                if self.per_time_slice:
+                    img_data = self.transform_data(data)
+                    if "time" in img_data.dims:
+                        img_data = img_data.squeeze(dim="time", drop=True)
+                    yield style.apply_mask_to_image(img_data, mask, 1, 1)
+                    continue
+                if mask is not None:
+                    flat_mask = mask if flat_mask is None else flat_mask & mask
+                values = self.aggregation_input(data)
+                if "time" in values.dims:
+                    values = values.squeeze(dim="time", drop=True)
+                agg = cast(FunctionWrapper, self.running_aggregator)(agg, values)
+            if not self.per_time_slice:
+                yield style.apply_mask_to_image(self.render_aggregate(agg), flat_mask, 1, 1)
+
         # pylint: disable=abstract-method
         class Legend(LegendBase):
             """
@@ -635,5 +761,6 @@ class GlobalCfgProxy:
 
 class StandaloneProductProxy:
     name = "standalone"
+    render_precision = np.dtype("float64")
     global_cfg = GlobalCfgProxy()
     band_idx = BandIdxProxy()
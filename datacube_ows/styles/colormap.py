@@ -4,9 +4,11 @@
 # Copyright (c) 2017-2021 OWS Contributors
 # SPDX-License-Identifier: Apache-2.0
 import io
+import json
 import logging
 from datetime import datetime
-from typing import Callable, List, MutableMapping, Optional, Union, cast
+from typing import (Callable, List, Mapping, MutableMapping, Optional, Tuple,
+                    Union, cast)
 
 import numpy
 import xarray
@@ -178,46 +180,48 @@ class MultiDateValueMapRule(AbstractValueMapRule):
         :param data: Multi-date Raw flag data, assumed to be for this rule's flag band.
         :return: A boolean dateless DataArray, True where the data matches this rule
         """
-        date_slices = (data.sel(time=dt) for dt in data.coords["time"].values)
-        mask: Optional[DataArray] = None
+        data = data.transpose("time", ...)
+        raw = data.values
         if self.values:
-            for d_slice, vals, invert in zip(date_slices, self.values, self.invert):
-                d_mask: Optional[DataArray] = None
-                if len(vals) == 0:
-                    d_mask = d_slice == d_slice
-                else:
-                    for v in cast(List[int], vals):
-                        vmask = d_slice == v
-                        if d_mask is None:
-                            d_mask = vmask
-                        else:
-                            d_mask |= vmask
-                if d_mask is not None and invert:
-                    d_mask = ~d_mask # pylint: disable=invalid-unary-operand-type
-                if mask is None:
-                    mask = d_mask
-                else:
-                    mask &= d_mask
+            date_rules = cast(List[List[int]], self.values)
         else:
-            for d_slice, flags, or_flags, invert in zip(date_slices, self.flags, self.or_flags, self.invert):
-                d_mask: Optional[DataArray] = None
-                if not flags:
-                    d_mask = d_slice == d_slice
-                elif or_flags:
-                    for f in cast(CFG_DICT, flags).items():
-                        f = {f[0]: f[1]}
-                        if d_mask is None:
-                            d_mask = make_mask(d_slice, **f)
-                        else:
-                            d_mask |= make_mask(d_slice, **f)
-                else:
-                    d_mask = make_mask(d_slice, **cast(CFG_DICT, flags))
-                if invert:
-                    d_mask = ~d_mask # pylint: disable=invalid-unary-operand-type
-                if mask is None:
-                    mask = d_mask
+            date_rules = cast(List[CFG_DICT], self.flags)
+        date_count = min(len(raw), len(date_rules), len(self.invert))
+        # One boolean layer per date, reduced over the time axis in a single pass.
+        date_masks = numpy.empty((date_count,) + raw.shape[1:], dtype=numpy.bool_)
+        for idx in range(date_count):
+            d_raw = raw[idx]
+            if self.values:
+                vals = date_rules[idx]
+                if len(vals) == 0:
+                    date_masks[idx] = d_raw == d_raw
                 else:
-                    mask &= d_mask
+                    date_masks[idx] = numpy.isin(d_raw, vals)
+            else:
+                date_masks[idx] = self.flag_mask(data[idx], date_rules[idx], cast(List[bool], self.or_flags)[idx])
+        # Inverted dates are flipped with one broadcast xor.
+        invert = numpy.array(self.invert[:date_count], dtype=numpy.bool_)
+        date_masks ^= invert.reshape((date_count,) + (1,) * (date_masks.ndim - 1))
+        template = data.isel(time=0, drop=True)
+        return DataArray(date_masks.all(axis=0), coords=template.coords, dims=template.dims)
+
+    @staticmethod
+    def flag_mask(d_slice: DataArray, flags: CFG_DICT, or_flags: bool) -> numpy.ndarray:
+        """
+        Match a single date of raw flag data against the flag rules for that date.
+
+        :param d_slice: Raw flag data for one date
+        :param flags: The flag rules for the date
+        :param or_flags: True if any flag may match, False if all flags must match
+        :return: A boolean numpy array
+        """
+        if not flags:
+            return (d_slice == d_slice).values
+        if not or_flags:
+            return make_mask(d_slice, **flags).values
+        mask = numpy.zeros(d_slice.shape, dtype=numpy.bool_)
+        for name, val in flags.items():
+            mask |= make_mask(d_slice, **{name: val}).values
         return mask
 
 
@@ -227,14 +231,126 @@ def convert_to_uint8(fval):
     return clipped
 
 
+# Integer bands with more possible values than this are only compiled to a lookup table
+# for the values 0 to VALUE_MAP_LUT_MAX_SIZE-1, and data outside that range falls back to the rule loop.
+VALUE_MAP_LUT_MAX_SIZE = 65536
+
+
+class ValueMapLUT:
+    """
+    A (single-date) value map rule list compiled to an RGBA lookup table for an integer band.
+
+    Rules are evaluated once against every possible band value, so rendering is a single numpy take
+    instead of a mask and four xarray.where calls per rule.
+    """
+    def __init__(self, rules: List[AbstractValueMapRule], dtype: numpy.dtype,
+                 flags_def: Optional[Mapping] = None) -> None:
+        """
+        Compile a rule list.
+
+        :param rules: The value map rules for the band, in config (priority) order
+        :param dtype: The integer dtype of the band data
+        :param flags_def: The flags_definition of the band (required for flag-based rules)
+        """
+        self.dtype = numpy.dtype(dtype)
+        if self.dtype.itemsize <= 2:
+            # Every possible value fits in the table.  Negative values of signed types
+            # wrap around to the top of the table, which is how numpy.take indexes them.
+            size = 2 ** (8 * self.dtype.itemsize)
+            values = numpy.arange(size, dtype=f"u{self.dtype.itemsize}").view(self.dtype)
+            self.range_checked = False
+        else:
+            size = VALUE_MAP_LUT_MAX_SIZE
+            values = numpy.arange(size).astype(self.dtype)
+            self.range_checked = True
+        self.size = size
+        lut_data = DataArray(values, dims=["value"], attrs={"flags_definition": flags_def or {}})
+        self.rgba = numpy.zeros((size, 4), dtype="uint8")
+        self.matched = numpy.zeros(size, dtype="bool")
+        for rule in reversed(rules):
+            mask = rule.create_mask(lut_data).values
+            self.rgba[mask] = [
+                convert_to_uint8(rule.rgb.red),
+                convert_to_uint8(rule.rgb.green),
+                convert_to_uint8(rule.rgb.blue),
+                convert_to_uint8(rule.alpha),
+            ]
+            self.matched |= mask
+
+    @classmethod
+    def compile(cls, rules: List[AbstractValueMapRule], dtype: numpy.dtype,
+                flags_def: Optional[Mapping] = None) -> Optional["ValueMapLUT"]:
+        """
+        Compile a rule list, if possible.
+
+        :return: A ValueMapLUT, or None if the rules must be applied with the rule loop
+                (non-integer dtypes, multi-date rules, or rules that cannot be evaluated on the raw values.)
+        """
+        dtype = numpy.dtype(dtype)
+        if dtype.kind not in ("u", "i"):
+            return None
+        if any(isinstance(rule, MultiDateValueMapRule) for rule in rules):
+            return None
+        try:
+            return cls(rules, dtype, flags_def)
+        except Exception as e:  # pylint: disable=broad-except
+            _LOG.debug("Could not compile value map to lookup table: %s", str(e))
+            return None
+
+    def lookup(self, data: DataArray) -> Optional[Tuple[numpy.ndarray, numpy.ndarray]]:
+        """
+        Look up band data in the table.
+
+        :param data: Raw band data, of the compiled dtype
+        :return: A tuple of an RGBA uint8 array (with a trailing channel axis), and a boolean array,
+                True where any rule matched.  None if the data is outside the range of the table.
+        """
+        idx = data.values
+        if self.range_checked and idx.size and (idx.min() < 0 or idx.max() >= self.size):
+            return None
+        return numpy.take(self.rgba, idx, axis=0), numpy.take(self.matched, idx)
+
+
+ValueMapLUTCache = MutableMapping[Tuple[str, str, str], Optional[ValueMapLUT]]
+
+
+def value_map_lut_key(band: str, dtype: numpy.dtype, flags_def: Optional[Mapping] = None) -> Tuple[str, str, str]:
+    """
+    The lookup table cache key for a band, dtype and flags definition.
+
+    Flag-based rules compile to different tables for different flags definitions, so the
+    definition is part of the key (in canonical JSON form, as equal definitions may be distinct objects.)
+    """
+    flags_key = json.dumps(flags_def, sort_keys=True, default=str) if flags_def else ""
+    return (band, numpy.dtype(dtype).str, flags_key)
+
+
+def value_map_lut(luts: ValueMapLUTCache, band: str, rules: List[AbstractValueMapRule],
+                  dtype: numpy.dtype, flags_def: Optional[Mapping] = None) -> Optional[ValueMapLUT]:
+    """
+    Return the compiled lookup table for a band's rules, dtype and flags definition, compiling it on first use.
+
+    Flag-based rules cannot be compiled for data with no flags definition.  None is returned
+    without being cached, so a later call with the definition can still compile the table.
+    """
+    if not flags_def and any(rule.flags for rule in rules):
+        return None
+    key = value_map_lut_key(band, dtype, flags_def)
+    if key not in luts:
+        luts[key] = ValueMapLUT.compile(rules, dtype, flags_def)
+    return luts[key]
+
+
 def apply_value_map(value_map: MutableMapping[str, List[AbstractValueMapRule]],
                     data: Dataset,
-                    band_mapper: Callable[[str], str]) -> Dataset:
+                    band_mapper: Callable[[str], str],
+                    luts: Optional[ValueMapLUTCache] = None) -> Dataset:
     imgdata = Dataset(coords={k: v for k, v in data.coords.items() if k != "time"})
     shape = list(imgdata.dims.values())
     for channel in ("red", "green", "blue", "alpha"):
         c = numpy.full(shape, 0, dtype="uint8")
         imgdata[channel] = DataArray(c, coords=imgdata.coords)
+    first_band = True
     for cfg_band, rules in value_map.items():
         # Run through each item
         band = band_mapper(cfg_band)
@@ -242,15 +358,34 @@ def apply_value_map(value_map: MutableMapping[str, List[AbstractValueMapRule]],
         if bdata.dtype.kind == 'f':
             # Convert back to int for bitmasking
             bdata = ColorMapStyleDef.reint(bdata)
-        for rule in reversed(rules):
-            mask = rule.create_mask(bdata)
-            if mask.data.any():
-                for channel in ("red", "green", "blue", "alpha"):
-                    if channel == "alpha":
-                        val = convert_to_uint8(rule.alpha)
-                    else:
-                        val = convert_to_uint8(getattr(rule.rgb, channel))
-                    imgdata[channel] = xarray.where(mask, val, imgdata[channel])
+        looked_up = None
+        if luts is not None:
+            lut = value_map_lut(luts, band, rules, bdata.dtype, bdata.attrs.get("flags_definition"))
+            if lut is not None:
+                looked_up = lut.lookup(bdata)
+        if looked_up is not None:
+            rgba, matched = looked_up
+            for i, channel in enumerate(("red", "green", "blue", "alpha")):
+                channel_data = DataArray(rgba[..., i], dims=bdata.dims, coords=bdata.coords)
+                if first_band:
+                    # Unmatched table entries are zero, the same as the blank image.
+                    imgdata[channel] = channel_data
+                else:
+                    imgdata[channel] = xarray.where(
+                        DataArray(matched, dims=bdata.dims, coords=bdata.coords),
+                        channel_data, imgdata[channel]
+                    ).astype("uint8")
+        else:
+            for rule in reversed(rules):
+                mask = rule.create_mask(bdata)
+                if mask.data.any():
+                    for channel in ("red", "green", "blue", "alpha"):
+                        if channel == "alpha":
+                            val = convert_to_uint8(rule.alpha)
+                        else:
+                            val = convert_to_uint8(getattr(rule.rgb, channel))
+                        imgdata[channel] = xarray.where(mask, val, imgdata[channel])
+        first_band = False
     return imgdata
 
 
@@ -336,6 +471,52 @@ class ColorMapStyleDef(StyleDefBase):
             mdh.legend_cfg.register_value_map(mdh.value_map)
         for band in self.value_map.keys():
             self.raw_needed_bands.add(band)
+        self.value_map_luts: ValueMapLUTCache = {}
+
+    def make_ready(self, dc, *args, **kwargs) -> None:
+        """
+        Second-phase (db aware) initialisation
+
+        Precompiles the value map to lookup tables for the native dtype of each band.
+        (Lookup tables for other dtypes, and for stand-alone styles, are compiled on first use.)
+
+        :param dc: A datacube object
+        """
+        super().make_ready(dc, *args, **kwargs)
+        if self.stand_alone:
+            return
+        for cfg_band, rules in self.value_map.items():
+            band = self.local_band(cfg_band)
+            meas = self.product.band_idx.measurements.get(band)
+            if meas is None:
+                continue
+            for rule in rules:
+                rule.compile(meas.get("flags_definition"))
+            value_map_lut(self.value_map_luts, band, rules, numpy.dtype(meas.dtype),
+                          meas.get("flags_definition"))
+
+    def png_palette(self) -> Optional[List[Tuple[int, int, int, int]]]:
+        """
+        The RGBA colours of all value map rules of the style and its multi-date handlers.
+        """
+        value_maps = [self.value_map] + [mdh.value_map for mdh in self.multi_date_handlers]
+        return list(dict.fromkeys(
+            (
+                convert_to_uint8(rule.rgb.red),
+                convert_to_uint8(rule.rgb.green),
+                convert_to_uint8(rule.rgb.blue),
+                convert_to_uint8(rule.alpha),
+            )
+            for value_map in value_maps
+            for rules in value_map.values()
+            for rule in rules
+        ))
+
+    def prepare_render_data(self, data: Dataset) -> Dataset:
+        """
+        Value maps are applied to the native band values, regardless of render precision.
+        """
+        return data
 
     @staticmethod
     def reint(data: DataArray) -> DataArray:
@@ -380,7 +561,7 @@ class ColorMapStyleDef(StyleDefBase):
         #            data[band] = data[band].where(extent_mask, other=data[band].attrs['nodata'])
         #        except AttributeError:
         #            data[band] = data[band].where(extent_mask)
-        return apply_value_map(self.value_map, data, self.product.band_idx.band)
+        return apply_value_map(self.value_map, data, self.product.band_idx.band, self.value_map_luts)
 
     class Legend(ColorMapLegendBase):
         pass
@@ -388,6 +569,7 @@ class ColorMapStyleDef(StyleDefBase):
     class MultiDateHandler(StyleDefBase.MultiDateHandler):
         auto_legend = True
         non_animate_requires_aggregator = False
+        supports_running_aggregation = True
 
         def __init__(self, style: "ColorMapStyleDef", cfg: CFG_DICT) -> None:
             """
@@ -404,6 +586,7 @@ class ColorMapStyleDef(StyleDefBase):
             else:
                 self._value_map = AbstractValueMapRule.value_map_from_config(self,
                                                         cast(CFG_DICT, self._raw_cfg["value_map"]))
+            self.value_map_luts: ValueMapLUTCache = {}
 
         @property
         def value_map(self):
@@ -419,10 +602,14 @@ class ColorMapStyleDef(StyleDefBase):
             :return: RGBA image xarray.  May have a time dimension
             """
             if self.aggregator is None:
-                return apply_value_map(self.value_map, data, self.style.product.band_idx.band)
+                return apply_value_map(self.value_map, data, self.style.product.band_idx.band,
+                                       self.value_map_luts)
             else:
-                agg = self.aggregator(data)
-                return apply_value_map(self.value_map, agg, self.style.product.band_idx.band)
+                return self.render_aggregate(self.aggregator(data))
+
+        def render_aggregate(self, agg: "xarray.Dataset") -> "xarray.Dataset":
+            return apply_value_map(self.value_map, agg, self.style.product.band_idx.band,
+                                   self.value_map_luts)
 
         class Legend(ColorMapLegendBase):
             pass
@@ -4,7 +4,7 @@
 # Copyright (c) 2017-2021 OWS Contributors
 # SPDX-License-Identifier: Apache-2.0
 from typing import (Any, Callable, Hashable, List, MutableMapping, Optional,
-                    Union, cast)
+                    Set, Tuple, Union, cast)
 
 import numpy as np
 from xarray import DataArray, Dataset
@@ -17,6 +17,9 @@ from datacube_ows.styles.base import StyleDefBase
 
 LINEAR_COMP_DICT = MutableMapping[str, Union[float, List[float]]]
 
+# Integer band data of at most this many bytes per pixel is rendered through a lookup table.
+CHANNEL_LUT_MAX_ITEMSIZE = 2
+
 
 class ComponentStyleDef(StyleDefBase):
     """
@@ -98,6 +101,22 @@ class ComponentStyleDef(StyleDefBase):
                 self.rgb_components[band] = component
             else:
                 self.rgb_components[band] = self.dealias_components(component)
+        self.lut_channels: MutableMapping[str, Tuple[str, float]] = {}
+        float_bands: Set[str] = set()
+        for imgband, components in self.rgb_components.items():
+            if not components or callable(components):
+                continue
+            bands = [band for band in components if band != "scale_range"]
+            sc_range = self.component_scale_ranges.get(imgband, {})
+            if (imgband != "alpha" and len(bands) == 1
+                    and isinstance(components[bands[0]], (int, float))
+                    and sc_range.get("min") is not None and sc_range.get("max") is not None):
+                self.lut_channels[imgband] = (bands[0], cast(float, components[bands[0]]))
+            else:
+                float_bands.update(bands)
+        # Bands only read by lookup table channels are kept in their native types.
+        self.lut_bands: Set[str] = set(band for band, _ in self.lut_channels.values()) - float_bands
+        self.channel_luts: MutableMapping[Tuple[str, str], np.ndarray] = {}
         super().make_ready(dc, *args, **kwargs)
 
 
@@ -135,6 +154,60 @@ class ComponentStyleDef(StyleDefBase):
         return normalized * 255
 
 
+    def channel_lut(self, component_name: str, dtype: np.dtype) -> np.ndarray:
+        """
+        Lookup table from raw integer band values to a uint8 component.
+
+        Only used for components consisting of a single band with a constant intensity.  The table
+        is built by applying the intensity and compress_band to every possible value of the dtype,
+        so the output is identical to the general calculation.  Tables are indexed by the unsigned
+        bit pattern of the raw value, and are cached per component and dtype.
+
+        :param component_name: The name of the component ('red', 'green' or 'blue')
+        :param dtype: An integer dtype of at most CHANNEL_LUT_MAX_ITEMSIZE bytes
+        :return: A uint8 lookup table with one entry per possible value.
+        """
+        key = (component_name, dtype.str)
+        lut = self.channel_luts.get(key)
+        if lut is None:
+            _, intensity = self.lut_channels[component_name]
+            values = np.arange(256 ** dtype.itemsize, dtype=f"uint{8 * dtype.itemsize}").view(dtype)
+            lut = np.asarray(self.compress_band(component_name, values * intensity)).astype("uint8")
+            self.channel_luts[key] = lut
+        return lut
+
+    @staticmethod
+    def lut_applicable(band_data: "xarray.DataArray") -> bool:
+        """True if band data is of an integer type that can be rendered with a lookup table."""
+        return band_data.dtype.kind in "iu" and band_data.dtype.itemsize <= CHANNEL_LUT_MAX_ITEMSIZE
+
+    def apply_channel_lut(self, component_name: str, band_data: "xarray.DataArray") -> "xarray.DataArray":
+        """
+        Calculate a uint8 component directly from integer band data with a lookup table.
+
+        :param component_name: The name of the component ('red', 'green' or 'blue')
+        :param band_data: The raw integer band data
+        :return: uint8 component DataArray
+        """
+        raw = np.asarray(band_data.values)
+        lut = self.channel_lut(component_name, raw.dtype)
+        indices = raw.view(f"uint{8 * raw.dtype.itemsize}")
+        return DataArray(np.take(lut, indices), dims=band_data.dims, coords=band_data.coords)
+
+    def prepare_render_data(self, data: "xarray.Dataset") -> "xarray.Dataset":
+        """
+        See superclass.  Bands only used by lookup table components keep their native type.
+        """
+        native = {
+            band: data[band]
+            for band in self.lut_bands
+            if band in data.data_vars and self.lut_applicable(data[band])
+        }
+        prepared = super().prepare_render_data(data)
+        if native and prepared is not data:
+            prepared = prepared.assign(native)
+        return prepared
+
     def transform_single_date_data(self, data: "xarray.Dataset") -> "xarray.Dataset":
         """
         Apply style to raw data to make an RGBA image xarray (single time slice only)
@@ -144,6 +217,11 @@ class ComponentStyleDef(StyleDefBase):
         """
         imgdata = cast(MutableMapping[Hashable, Any], {})
         for imgband, components in self.rgb_components.items():
+            if imgband in self.lut_channels:
+                band_data = data[self.lut_channels[imgband][0]]
+                if self.lut_applicable(band_data):
+                    imgdata[imgband] = self.apply_channel_lut(imgband, band_data)
+                    continue
             if callable(components):
                 imgband_data = components(data)
                 imgband_data = imgband_data.astype('uint8')
@@ -3,10 +3,18 @@
 #
 # Copyright (c) 2017-2021 OWS Contributors
 # SPDX-License-Identifier: Apache-2.0
-from typing import Any, Type, cast
+import operator
+from typing import Any, List, Mapping, Optional, Tuple, Type, Union, cast
 
 import lark
+import numpy
 from datacube.virtual.expr import formula_parser
+from xarray import DataArray
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 
 from datacube_ows.ogc_utils import ConfigException
 
@@ -72,6 +80,229 @@ class BandListEvaluator(ExpressionEvaluator):
         return set([self.ows_style.local_band(key.value)])
 
 
+### Expression compiler - compiles an expression tree to a linear evaluation plan
+
+# Operand of an evaluation plan step: ("band", band_name), ("const", value) or ("step", step_index)
+PlanOperand = Tuple[str, Any]
+
+
+class PlanStep:
+    """
+    A single step in a compiled expression plan: a numpy ufunc applied to some operands.
+    """
+    def __init__(self, op_name: str, operands: List[PlanOperand]) -> None:
+        self.op_name = op_name
+        self.ufunc = PLAN_UFUNCS[op_name]
+        self.operands = operands
+        # Indexes of earlier steps whose results are no longer needed after this step.
+        self.releases: List[int] = []
+
+
+PLAN_UFUNCS = {
+    "add": numpy.add,
+    "sub": numpy.subtract,
+    "mul": numpy.multiply,
+    "truediv": numpy.true_divide,
+    "floordiv": numpy.floor_divide,
+    "mod": numpy.remainder,
+    "pow": numpy.power,
+    "neg": numpy.negative,
+    "pos": numpy.positive,
+}
+
+# Operators supported by numexpr, as format strings.
+NUMEXPR_FORMATS = {
+    "add": "({} + {})",
+    "sub": "({} - {})",
+    "mul": "({} * {})",
+    "truediv": "({} / {})",
+    "mod": "({} % {})",
+    "pow": "({} ** {})",
+    "neg": "(-{})",
+    "pos": "{}",
+}
+
+
+class ExpressionPlanUnsupported(Exception):
+    """
+    Raised while compiling an expression that cannot be compiled to a plan.
+    """
+
+
+def plan_op(op_name: str):
+    def impl(comp, *args):
+        return comp.add_step(op_name, list(args))
+    return impl
+
+
+def plan_not_supported(comp, *args):
+    raise ExpressionPlanUnsupported()
+
+
+@lark.v_args(inline=True)
+class ExpressionCompiler(lark.Transformer):
+    """
+    Compiles an expression tree into a list of PlanSteps.
+
+    Sub-expressions that only involve literals are evaluated at compile time, with the same
+    (Python) semantics the ExpressionEvaluator uses for them.
+    """
+    add = plan_op("add")
+    sub = plan_op("sub")
+    mul = plan_op("mul")
+    truediv = plan_op("truediv")
+    floordiv = plan_op("floordiv")
+    mod = plan_op("mod")
+    pow = plan_op("pow")
+    neg = plan_op("neg")
+    pos = plan_op("pos")
+    not_ = inv = or_ = and_ = xor = plan_not_supported
+    eq = ne = le = ge = lt = gt = plan_not_supported
+    lshift = rshift = plan_not_supported
+
+    def __init__(self, style, user_defined: bool = False, *args, **kwargs) -> None:
+        self.ows_style = style
+        self.user_defined = user_defined
+        self.steps: List[PlanStep] = []
+        super().__init__(*args, **kwargs)
+
+    def float_literal(self, val) -> PlanOperand:
+        return ("const", float(val))
+
+    def int_literal(self, val) -> PlanOperand:
+        return ("const", int(val))
+
+    def var_name(self, key) -> PlanOperand:
+        return ("band", self.ows_style.local_band(key.value))
+
+    def add_step(self, op_name: str, operands: List[PlanOperand]) -> PlanOperand:
+        if op_name == "pow" and self.user_defined:
+            raise ExpressionPlanUnsupported()
+        if all(kind == "const" for kind, _ in operands):
+            return ("const", getattr(operator, op_name)(*(val for _, val in operands)))
+        self.steps.append(PlanStep(op_name, operands))
+        return ("step", len(self.steps) - 1)
+
+
+class ExpressionPlan:
+    """
+    An expression compiled to a linear sequence of numpy ufunc calls.
+
+    Evaluation works on raw ndarrays.  Intermediate results are written into scratch buffers that are
+    reused once the intermediate result is no longer needed, so an expression like NDVI allocates at
+    most one array per distinct intermediate dtype.
+    """
+    def __init__(self, steps: List[PlanStep], result: PlanOperand) -> None:
+        self.steps = steps
+        self.result = result
+        last_use = {}
+        for i, step in enumerate(steps):
+            for kind, val in step.operands:
+                if kind == "step":
+                    last_use[val] = i
+        for idx, i in last_use.items():
+            steps[i].releases.append(idx)
+        self.bands = set()
+        for step in steps:
+            for kind, val in step.operands:
+                if kind == "band":
+                    self.bands.add(val)
+        if result[0] == "band":
+            self.bands.add(result[1])
+        self.numexpr_str: Optional[str] = None
+        self.numexpr_bands: List[str] = []
+        if numexpr is not None:
+            self.numexpr_str = self.to_numexpr(result)
+
+    @classmethod
+    def compile(cls, style, tree: lark.Tree, user_defined: bool = False) -> Optional["ExpressionPlan"]:
+        """
+        Compile a parsed expression.
+
+        :return: An ExpressionPlan, or None if the expression uses operators that are not supported by plans.
+        """
+        compiler = ExpressionCompiler(style, user_defined)
+        try:
+            result = compiler.transform(tree)
+        except lark.exceptions.VisitError as e:
+            if isinstance(e.orig_exc, ExpressionPlanUnsupported):
+                return None
+            raise
+        if result[0] == "const":
+            return None
+        return cls(compiler.steps, result)
+
+    def to_numexpr(self, operand: PlanOperand) -> Optional[str]:
+        kind, val = operand
+        if kind == "const":
+            return repr(val)
+        if kind == "band":
+            if val not in self.numexpr_bands:
+                self.numexpr_bands.append(val)
+            return f"b{self.numexpr_bands.index(val)}"
+        step = self.steps[val]
+        fmt = NUMEXPR_FORMATS.get(step.op_name)
+        if fmt is None:
+            return None
+        args = [self.to_numexpr(o) for o in step.operands]
+        if any(a is None for a in args):
+            return None
+        return fmt.format(*args)
+
+    def evaluate(self, arrays: Mapping[str, numpy.ndarray]) -> numpy.ndarray:
+        """
+        Evaluate the plan.
+
+        :param arrays: Band name to ndarray mapping.  All arrays must have the same shape.
+        :return: The result as an ndarray, with the same dtype numpy arithmetic on the arrays would give.
+        """
+        if self.result[0] == "band":
+            return arrays[self.result[1]]
+        if self.numexpr_str is not None and all(arrays[b].dtype.kind == "f" for b in self.numexpr_bands):
+            dtype = self.evaluate_steps({b: a.reshape(-1)[:0] for b, a in arrays.items()}).dtype
+            result = numexpr.evaluate(self.numexpr_str,
+                                      local_dict={f"b{i}": arrays[b] for i, b in enumerate(self.numexpr_bands)})
+            return result.astype(dtype, copy=False)
+        return self.evaluate_steps(arrays)
+
+    def evaluate_steps(self, arrays: Mapping[str, numpy.ndarray]) -> numpy.ndarray:
+        results: List[Optional[numpy.ndarray]] = [None] * len(self.steps)
+        scratch: List[numpy.ndarray] = []
+
+        def resolve(operand: PlanOperand) -> Union[numpy.ndarray, int, float]:
+            kind, val = operand
+            if kind == "band":
+                return arrays[val]
+            elif kind == "step":
+                return cast(numpy.ndarray, results[val])
+            return val
+
+        for i, step in enumerate(self.steps):
+            args = [resolve(o) for o in step.operands]
+            dtype = step.ufunc(*(
+                a.reshape(-1)[:0] if isinstance(a, numpy.ndarray) else a
+                for a in args
+            )).dtype
+            shape = next(a.shape for a in args if isinstance(a, numpy.ndarray))
+            out = None
+            for j, buf in enumerate(scratch):
+                if buf.dtype == dtype and buf.shape == shape:
+                    out = scratch.pop(j)
+                    break
+            # Operand buffers released here can be written in place.
+            for idx in step.releases:
+                released = cast(numpy.ndarray, results[idx])
+                if out is None and released.dtype == dtype and released.shape == shape:
+                    out = released
+                else:
+                    scratch.append(released)
+                results[idx] = None
+            if out is None:
+                out = numpy.empty(shape, dtype=dtype)
+            results[i] = step.ufunc(*args, out=out)
+        return cast(numpy.ndarray, results[-1])
+
+
 ### Expression wrapper - callable wrapper for a configurable expression
 
 class ExpressionException(ConfigException):
@@ -103,6 +334,7 @@ class Expression:
             raise ExpressionException(f"Unrecognised band '{e}' in {expr_str}")
         if len(self.needed_bands) == 0:
             raise ExpressionException(f"Expression references no bands: {self.expr_str}")
+        self.plan = ExpressionPlan.compile(self.style, self.tree, user_defined=self.style.user_defined)
 
     def eval_cls(self, data: "xarray.Dataset") -> ExpressionEvaluator:
         """"
@@ -122,5 +354,13 @@ class Expression:
         return cast(ExpressionEvaluator, ExpressionDataEvaluator(self.style))
 
     def __call__(self, data: "xarray.Dataset") -> Any:
+        if self.plan is not None:
+            bands = [data[b] for b in self.plan.bands]
+            template = bands[0]
+            if all(isinstance(b.data, numpy.ndarray) and b.dims == template.dims and b.shape == template.shape
+                   for b in bands):
+                result = self.plan.evaluate({b: data[b].data for b in self.plan.bands})
+                return DataArray(result, dims=template.dims, coords=template.coords)
+        # Dask-backed or mis-matched bands: evaluate the expression tree with xarray.
         evaluator: ExpressionEvaluator = self.eval_cls(data)
         return evaluator.transform(self.tree)
@@ -40,6 +40,12 @@ class HybridStyleDef(ColorRampDef, ComponentStyleDef):
         if self.component_ratio < 0.0 or self.component_ratio > 1.0:
             raise ConfigException("Component ratio must be a floating point number between 0 and 1")
 
+    def prepare_render_data(self, data: "xarray.Dataset") -> "xarray.Dataset":
+        """
+        See StyleDefBase.  Hybrid styles do not use component lookup tables.
+        """
+        return StyleDefBase.prepare_render_data(self, data)
+
     def transform_single_date_data(self, data: "xarray.Dataset") -> "xarray.Dataset":
         """
         Apply style to raw data to make an RGBA image xarray (single time slice only)
@@ -163,6 +163,11 @@ def read_mpl_ramp(mpl_ramp: str) -> RAMP_SPEC:
     return unscaled_cmap
 
 
+# Number of lookup table entries per colour ramp segment.  (Enough for 8 bit output
+# to be within one step of the exactly interpolated value.)
+RAMP_LUT_SEGMENT_STEPS = 256
+
+
 class ColorRamp:
     """
     Represents a colour ramp for image and legend rendering purposes
@@ -248,6 +253,24 @@ class ColorRamp:
             "blue": b,
             "alpha": a
         }
+        self.build_lut()
+
+    def build_lut(self) -> None:
+        """
+        Quantise the ramp into an RGBA lookup table.
+
+        Each segment of the ramp (between two consecutive values) gets RAMP_LUT_SEGMENT_STEPS entries,
+        so ramp values fall exactly on a table entry.  A final transparent entry is used for NaN data.
+        """
+        nvals = len(self.values)
+        self.values_float32 = numpy.array(self.values, dtype="float32")
+        self.lut_positions = numpy.arange(nvals, dtype="float64") * RAMP_LUT_SEGMENT_STEPS
+        positions = numpy.arange((nvals - 1) * RAMP_LUT_SEGMENT_STEPS + 1) / RAMP_LUT_SEGMENT_STEPS
+        self.lut = numpy.zeros((len(positions) + 1, 4), dtype="uint8")
+        for i, band in enumerate(("red", "green", "blue", "alpha")):
+            component = numpy.interp(positions, numpy.arange(nvals), self.components[band])
+            self.lut[:-1, i] = component * 255
+        self.lut_nan_index = len(positions)
 
     def get_value(self, data: Union[float, "xarray.DataArray"], band: str) -> NDArray:
         return numpy.interp(data, self.values, self.components[band])
@@ -257,10 +280,54 @@ class ColorRamp:
         val = cast(NDArray, val * 255)
         return val.astype("uint8")
 
+    def lut_indices_float32(self, data: NDArray) -> NDArray:
+        """
+        Lookup table indices for float32 index values, without converting to float64.
+
+        Equivalent to the numpy.interp calculation in apply(): each value is located in its ramp
+        segment, and the fraction of the way through the segment is calculated in float32.
+
+        :param data: float32 index values
+        :return: Lookup table indices, the same shape as data.
+        """
+        values = self.values_float32
+        nans = numpy.isnan(data)
+        segment = numpy.searchsorted(values, data, side="right") - 1
+        numpy.clip(segment, 0, len(values) - 2, out=segment)
+        low = values[segment]
+        width = values[segment + 1] - low
+        fraction = numpy.subtract(data, low, out=low)
+        numpy.divide(fraction, width, out=fraction, where=width > 0)
+        fraction[width <= 0] = 0.0
+        fraction[nans] = 0.0
+        numpy.clip(fraction, 0.0, 1.0, out=fraction)
+        fraction *= RAMP_LUT_SEGMENT_STEPS
+        numpy.rint(fraction, out=fraction)
+        segment *= RAMP_LUT_SEGMENT_STEPS
+        segment += fraction.astype("intp")
+        segment[nans] = self.lut_nan_index
+        return segment
+
     def apply(self, data: "xarray.DataArray") -> "xarray.Dataset":
+        """
+        Apply the colour ramp to index data.
+
+        :param data: Index values
+        :return: A Dataset of uint8 red, green, blue and alpha bands.  The bands are views of a
+                single contiguous RGBA buffer (see ogc_utils.rgba_buffer)
+        """
+        if data.dtype == numpy.float32 and len(self.values) > 1:
+            indices = self.lut_indices_float32(numpy.asarray(data))
+        else:
+            positions = numpy.interp(data, self.values, self.lut_positions)
+            numpy.rint(positions, out=positions)
+            positions[numpy.isnan(positions)] = self.lut_nan_index
+            indices = positions.astype("intp")
+        rgba = numpy.empty(indices.shape + (4,), dtype="uint8")
+        numpy.take(self.lut, indices, axis=0, out=rgba)
         imgdata = cast(MutableMapping[Hashable, Any], {})
-        for band in self.components:
-            imgdata[band] = (data.dims, self.get_8bit_value(data, band))
+        for i, band in enumerate(self.components):
+            imgdata[band] = (data.dims, rgba[..., i])
         imgdataset = Dataset(imgdata, coords=data.coords)
         return imgdataset
 
@@ -562,6 +629,7 @@ class ColorRampDef(StyleDefBase):
 
     class MultiDateHandler(StyleDefBase.MultiDateHandler):
         auto_legend = True
+        supports_running_aggregation = True
 
         def __init__(self, style: "ColorRampDef", cfg: CFG_DICT) -> None:
             """
@@ -585,8 +653,13 @@ class ColorRampDef(StyleDefBase):
             :param data: Raw data
             :return: RGBA image xarray.  May have a time dimension
             """
-            xformed_data = cast("ColorRampDef", self.style).apply_index(data)
-            agg = self.aggregator(xformed_data)
+            agg = self.aggregator(self.aggregation_input(data))
+            return self.render_aggregate(agg)
+
+        def aggregation_input(self, data: "xarray.Dataset") -> "xarray.DataArray":
+            return cast("ColorRampDef", self.style).apply_index(data)
+
+        def render_aggregate(self, agg: "xarray.DataArray") -> "xarray.Dataset":
             return self.color_ramp.apply(agg)
 
         class Legend(RampLegendBase):
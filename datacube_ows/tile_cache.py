@@ -0,0 +1,363 @@
+# This file is part of datacube-ows, part of the Open Data Cube project.
+# See https://opendatacube.org for more information.
+#
+# Copyright (c) 2017-2021 OWS Contributors
+# SPDX-License-Identifier: Apache-2.0
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from typing import (Any, Iterable, Mapping, MutableMapping, NamedTuple,
+                    Optional, Tuple, Union)
+from urllib.parse import quote
+
+from datacube_ows.ogc_utils import ConfigException
+from datacube_ows.resource_limits import parse_cache_age
+
+_LOG = logging.getLogger(__name__)
+
+# The disk cache directory is rescanned for its true size after this many writes, or this many seconds,
+# as it is shared with other processes.
+DISK_RESCAN_PUTS = 100
+DISK_RESCAN_SECONDS = 60
+
+# Temporary files older than this (in seconds) are left over from failed writes, and are removed on rescan.
+DISK_STALE_TMP_SECONDS = 3600
+
+# Time key of tiles requested without a time (i.e. for the layer's default time)
+DEFAULT_TIME_KEY = "default"
+
+# Default max_age (in seconds) of memory-cached tiles.
+DEFAULT_MEMORY_TILE_MAX_AGE = 300
+
+TileResponse = Tuple[bytes, int, Mapping[str, str]]
+
+
+class TileKey(NamedTuple):
+    layer: str
+    style: str
+    format: str
+    tile_matrix_set: str
+    tile_matrix: str
+    row: str
+    col: str
+    time: str
+
+    @classmethod
+    def from_args(cls, args: Mapping[str, Any]) -> "TileKey":
+        """
+        Build a tile key from (lower-cased) WMTS GetTile arguments.
+        """
+        return cls(
+            layer=args.get("layer", ""),
+            style=args.get("style", "") or "",
+            format=args.get("format", "").lower(),
+            tile_matrix_set=args.get("tilematrixset", ""),
+            tile_matrix=str(args.get("tilematrix", "")),
+            row=str(args.get("tilerow", "")),
+            col=str(args.get("tilecol", "")),
+            time=args.get("time", "") or DEFAULT_TIME_KEY,
+        )
+
+    @property
+    def date_key(self) -> str:
+        # The date part of the time key, for per-date invalidation.
+        return self.time.split("T")[0]
+
+    @property
+    def digest(self) -> str:
+        return hashlib.sha1("\x00".join(self).encode("utf-8")).hexdigest()
+
+
+def date_keys(dates: Optional[Iterable[Union[datetime.date, str]]]) -> Optional[set]:
+    """
+    Convert dates (or datetimes) to the set of date keys to invalidate.  Tiles for the layer's
+    default time are always included, as the default time may depend on the available dates.
+    """
+    if dates is None:
+        return None
+    keys = {DEFAULT_TIME_KEY}
+    for d in dates:
+        if isinstance(d, (datetime.date, datetime.datetime)):
+            keys.add(d.strftime("%Y-%m-%d"))
+        else:
+            keys.add(str(d).split("T")[0])
+    return keys
+
+
+class TileCache:
+    """
+    Abstract base class for rendered tile caches.
+
+    Only successful responses are cached.  Entries older than max_age seconds are treated as misses.
+    """
+    def __init__(self, max_bytes: int, max_age: int = 0) -> None:
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_cfg(cls, cfg: Optional[Mapping[str, Any]]) -> Optional["TileCache"]:
+        """
+        Create a tile cache from the "tile_cache" entry of the wmts config section.
+
+        :param cfg: The tile_cache config entry (or None)
+        :return: A TileCache, or None if tile caching is not configured.
+        """
+        if not cfg:
+            return None
+        backend = cfg.get("backend", "memory")
+        try:
+            max_bytes = int(float(cfg.get("max_size_mb", 256)) * 1024 * 1024)
+        except ValueError:
+            raise ConfigException(f"max_size_mb in tile_cache must be a number: {cfg['max_size_mb']}")
+        if max_bytes <= 0:
+            raise ConfigException(f"max_size_mb in tile_cache must be positive: {cfg['max_size_mb']}")
+        if backend == "memory":
+            # Memory caches cannot be invalidated by datacube-ows-update, so must expire.
+            max_age = parse_cache_age(cfg, "max_age", "tile_cache", DEFAULT_MEMORY_TILE_MAX_AGE)
+            if max_age == 0:
+                raise ConfigException("max_age in tile_cache must be positive for the memory backend")
+            return MemoryTileCache(max_bytes, max_age)
+        elif backend == "disk":
+            if "path" not in cfg:
+                raise ConfigException("Disk tile_cache requires a path")
+            max_age = parse_cache_age(cfg, "max_age", "tile_cache", 0)
+            return DiskTileCache(cfg["path"], max_bytes, max_age)
+        raise ConfigException(f"Unknown tile_cache backend: {backend} (must be 'memory' or 'disk')")
+
+    def get(self, key: TileKey) -> Optional[TileResponse]:
+        resp = self._get(key)
+        if resp is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return resp
+
+    def put(self, key: TileKey, resp: TileResponse) -> None:
+        body, status, headers = resp
+        if status != 200:
+            return
+        self._put(key, body, dict(headers))
+
+    def expired(self, created: float) -> bool:
+        return bool(self.max_age) and time() - created > self.max_age
+
+    def _get(self, key: TileKey) -> Optional[TileResponse]:
+        raise NotImplementedError()
+
+    def _put(self, key: TileKey, body: bytes, headers: MutableMapping[str, str]) -> None:
+        raise NotImplementedError()
+
+    def invalidate(self, layer: str, dates: Optional[Iterable[Union[datetime.date, str]]] = None) -> None:
+        """
+        Discard cached tiles for a layer.
+
+        :param layer: The layer name
+        :param dates: Only discard tiles for these dates (plus tiles for the default time).
+                      Default: discard all tiles for the layer.
+        """
+        raise NotImplementedError()
+
+    def clear(self) -> None:
+        raise NotImplementedError()
+
+
+class MemoryTileCache(TileCache):
+    """
+    Per-process in-memory tile cache, with LRU eviction once max_bytes is exceeded.
+    """
+    def __init__(self, max_bytes: int, max_age: int = 0) -> None:
+        super().__init__(max_bytes, max_age)
+        self._lock = Lock()
+        self._entries: MutableMapping[TileKey, Tuple[float, bytes, Mapping[str, str]]] = OrderedDict()
+        self.size = 0
+
+    def _get(self, key: TileKey) -> Optional[TileResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created, body, headers = entry
+            if self.expired(created):
+                self._discard(key)
+                return None
+            self._entries.move_to_end(key)
+            return body, 200, headers
+
+    def _put(self, key: TileKey, body: bytes, headers: MutableMapping[str, str]) -> None:
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (time(), body, headers)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+
+    def _discard(self, key: TileKey) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def invalidate(self, layer: str, dates: Optional[Iterable[Union[datetime.date, str]]] = None) -> None:
+        keys = date_keys(dates)
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if key.layer == layer and (keys is None or key.date_key in keys):
+                    self._discard(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class DiskTileCache(TileCache):
+    """
+    Local disk tile cache, shared by all processes using the same path.
+
+    Tiles are stored as <path>/<layer>/<date>/<digest>.tile, with a JSON header line (creation time
+    and response headers) before the image.  Files are touched on each hit and the least recently used
+    files are evicted once the cache exceeds max_bytes.
+
+    Each process tracks the size of the cache from its own writes, and rescans the directory every
+    DISK_RESCAN_PUTS writes or DISK_RESCAN_SECONDS seconds to pick up writes by other processes.
+    """
+    def __init__(self, path: str, max_bytes: int, max_age: int = 0) -> None:
+        super().__init__(max_bytes, max_age)
+        self.path = path
+        self._lock = Lock()
+        self._size: Optional[int] = None
+        self._puts_since_scan = 0
+        self._scan_time = 0.0
+
+    def _layer_dir(self, layer: str) -> str:
+        return os.path.join(self.path, quote(layer, safe=""))
+
+    def _file(self, key: TileKey) -> str:
+        return os.path.join(self._layer_dir(key.layer), quote(key.date_key, safe=""), key.digest + ".tile")
+
+    def _get(self, key: TileKey) -> Optional[TileResponse]:
+        fname = self._file(key)
+        try:
+            with open(fname, "rb") as fp:
+                header = json.loads(fp.readline())
+                body = fp.read()
+        except (OSError, ValueError):
+            return None
+        if self.expired(header["created"]):
+            self._remove(fname)
+            return None
+        try:
+            os.utime(fname)
+        except OSError:
+            pass
+        return body, 200, header["headers"]
+
+    def _put(self, key: TileKey, body: bytes, headers: MutableMapping[str, str]) -> None:
+        fname = self._file(key)
+        dirname = os.path.dirname(fname)
+        os.makedirs(dirname, exist_ok=True)
+        header = json.dumps({"created": time(), "headers": headers}).encode("utf-8")
+        try:
+            replaced_size = os.stat(fname).st_size
+        except OSError:
+            replaced_size = 0
+        # Write to a temporary file and rename, so readers never see a partial tile.
+        fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(header + b"\n")
+                fp.write(body)
+            os.replace(tmpname, fname)
+        except OSError as e:
+            self._remove(tmpname)
+            _LOG.warning("Could not write tile to disk cache: %s", e)
+            return
+        except BaseException:
+            self._remove(tmpname)
+            raise
+        with self._lock:
+            self._puts_since_scan += 1
+            if (self._size is None or self._puts_since_scan >= DISK_RESCAN_PUTS
+                    or time() - self._scan_time > DISK_RESCAN_SECONDS):
+                self._rescan()
+            else:
+                self._size += len(header) + 1 + len(body) - replaced_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _files(self, root: Optional[str] = None) -> Iterable[Tuple[str, int, float]]:
+        for dirpath, _, filenames in os.walk(root or self.path):
+            for f in filenames:
+                if not f.endswith(".tile"):
+                    continue
+                fname = os.path.join(dirpath, f)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                yield fname, st.st_size, st.st_mtime
+
+    def _rescan(self) -> None:
+        # Recalculate the size of the cache, and remove temporary files left over from failed writes.
+        now = time()
+        for dirpath, _, filenames in os.walk(self.path):
+            for f in filenames:
+                if not f.endswith(".tmp"):
+                    continue
+                fname = os.path.join(dirpath, f)
+                try:
+                    if now - os.stat(fname).st_mtime > DISK_STALE_TMP_SECONDS:
+                        self._remove(fname)
+                except OSError:
+                    continue
+        self._size = sum(size for _, size, _ in self._files())
+        self._puts_since_scan = 0
+        self._scan_time = now
+
+    def _evict(self) -> None:
+        # Rescan (other processes share the cache) and evict least recently used tiles
+        # down to 90% of the maximum size.
+        files = sorted(self._files(), key=lambda f: f[2])
+        size = sum(f[1] for f in files)
+        target = self.max_bytes * 0.9
+        for fname, fsize, _ in files:
+            if size <= target:
+                break
+            self._remove(fname)
+            size -= fsize
+        self._size = size
+
+    def _remove(self, fname: str) -> None:
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+
+    def invalidate(self, layer: str, dates: Optional[Iterable[Union[datetime.date, str]]] = None) -> None:
+        keys = date_keys(dates)
+        layer_dir = self._layer_dir(layer)
+        if keys is None:
+            dirs = [layer_dir]
+        else:
+            dirs = [os.path.join(layer_dir, quote(k, safe="")) for k in keys]
+        for d in dirs:
+            for fname, _, _ in list(self._files(d)):
+                self._remove(fname)
+        with self._lock:
+            self._size = None
+
+    def clear(self) -> None:
+        for fname, _, _ in list(self._files()):
+            self._remove(fname)
+        with self._lock:
+            self._size = 0
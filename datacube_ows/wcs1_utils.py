@@ -7,12 +7,12 @@ from __future__ import absolute_import, division, print_function
 
 import numpy
 import pytz
+import rasterio
 import xarray
 from affine import Affine
 from datacube.utils import geometry
 from dateutil.parser import parse
 from ows.util import Version
-from rasterio import MemoryFile
 
 from datacube_ows.cube_pool import cube
 from datacube_ows.data import DataStacker
@@ -21,7 +21,10 @@ from datacube_ows.ogc_exceptions import WCS1Exception
 from datacube_ows.ogc_utils import ConfigException
 from datacube_ows.ows_configuration import get_config
 from datacube_ows.resource_limits import ResourceLimited
-from datacube_ows.wcs_utils import get_bands_from_styles
+from datacube_ows.wcs_utils import (CoverageFile, clean_coverage_attrs,
+                                    gdal_num_threads, get_bands_from_styles,
+                                    netcdf_response, wcs_dask_chunks,
+                                    write_band, write_cog, zarr_response)
 
 
 class WCS1GetCoverageRequest():
@@ -314,7 +317,8 @@ def get_coverage_data(req, qprof):
         stacker = DataStacker(req.product,
                               req.geobox,
                               req.times,
-                              bands=req.bands)
+                              bands=req.bands,
+                              dask_chunks=wcs_dask_chunks(get_config(), req.geobox))
         qprof.start_event("count-datasets")
         n_datasets = stacker.datasets(dc.index, mode=MVSelectOpts.COUNT)
         qprof.end_event("count-datasets")
@@ -404,8 +408,12 @@ def get_coverage_data(req, qprof):
         return n_datasets, output
 
 
-def get_tiff(req, data):
-    """Uses rasterio MemoryFiles in order to return a streamable GeoTiff response"""
+def write_tiff(fname, req, data, **creation_options):
+    """
+    Write coverage data to a GeoTiff file.
+
+    Keyword arguments override the default GeoTiff creation options.
+    """
     # Does not support multi-time dimension data - is this even possible in GeoTiff?
     supported_dtype_map = {
         'uint8': 1,
@@ -432,42 +440,73 @@ def get_tiff(req, data):
     nodata = 0
     for band in data.data_vars:
         nodata = req.product.band_idx.nodata_val(band)
-    with MemoryFile() as memfile:
-        # pylint: disable=protected-access, bad-continuation
-        with memfile.open(
-            driver="GTiff",
-            width=data.dims[xname],
-            height=data.dims[yname],
-            count=len(data.data_vars),
-            transform=req.affine,
-            crs=req.response_crsid,
-            nodata=nodata,
-            tiled=True,
-            compress="lzw",
-            interleave="band",
-            dtype=dtype) as dst:
-            for idx, band in enumerate(data.data_vars, start=1):
-                dst.write(data[band].values, idx)
-                dst.set_band_description(idx, req.product.band_idx.band_label(band))
-                if cfg.wcs_tiff_statistics:
-                    dst.update_tags(idx, STATISTICS_MINIMUM=data[band].values.min())
-                    dst.update_tags(idx, STATISTICS_MAXIMUM=data[band].values.max())
-                    dst.update_tags(idx, STATISTICS_MEAN=data[band].values.mean())
-                    dst.update_tags(idx, STATISTICS_STDDEV=data[band].values.std())
-        return memfile.read()
-
-
-def get_netcdf(req, data):
+    options = {
+        "tiled": True,
+        "compress": "lzw",
+        "interleave": "band",
+    }
+    options.update(creation_options)
+    # pylint: disable=protected-access, bad-continuation
+    with rasterio.open(
+        fname, "w",
+        driver="GTiff",
+        width=data.dims[xname],
+        height=data.dims[yname],
+        count=len(data.data_vars),
+        transform=req.affine,
+        crs=req.response_crsid,
+        nodata=nodata,
+        dtype=dtype,
+        **options) as dst:
+        for idx, band in enumerate(data.data_vars, start=1):
+            write_band(dst, idx, data[band], nodata=req.product.band_idx.nodata_val(band),
+                       statistics=cfg.wcs_tiff_statistics)
+            dst.set_band_description(idx, req.product.band_idx.band_label(band))
+
+
+def get_tiff(req, data, num_threads=None):
+    """
+    Writes the GeoTiff to a temporary file, which is streamed back as the response
+
+    num_threads (a positive integer or "ALL_CPUS") enables multithreaded GDAL compression, and may be
+    set with the renderer's kwargs in the format config.
+    """
+    options = {}
+    threads = gdal_num_threads(num_threads)
+    if threads:
+        options["num_threads"] = threads
+    with CoverageFile(".tif") as covfile:
+        write_tiff(covfile.name, req, data, **options)
+    return covfile.response()
+
+
+def get_cog(req, data, **cog_options):
+    """
+    Writes a Cloud Optimized GeoTiff to a temporary file, which is streamed back as the response.
+
+    Keyword arguments (overview_levels, blocksize, compression, overview_resampling and num_threads)
+    are passed through to wcs_utils.write_cog, and may be set with the renderer's kwargs in the
+    format config.
+    """
+    with CoverageFile(".tif") as covfile:
+        write_cog(lambda fname, **opts: write_tiff(fname, req, data, **opts),
+                  covfile.name, req.width, req.height, **cog_options)
+    return covfile.response()
+
+
+def get_netcdf(req, data, **netcdf_options):
     # Cleanup dataset attributes for NetCDF export
-    data.attrs["crs"] = req.response_crsid # geometry.CRS(response_crs)
-    for k, v in data.data_vars.items():
-        v.attrs["crs"] = req.response_crsid
-        if "spectral_definition" in v.attrs:
-            del v.attrs["spectral_definition"]
-        if "flags_definition" in v.attrs:
-            del v.attrs["flags_definition"]
-    if "time" in data and "units" in data["time"].attrs:
-        del data["time"].attrs["units"]
-
-    # And export to NetCDF
-    return data.to_netcdf()
+    clean_coverage_attrs(data, req.response_crsid)
+
+    # And export to compressed NetCDF4.  Keyword arguments (complevel, shuffle, chunk_size)
+    # may be set with the renderer's kwargs in the format config.
+    return netcdf_response(data, **netcdf_options)
+
+
+def get_zarr(req, data, **zarr_options):
+    # Cleanup dataset attributes for Zarr export
+    clean_coverage_attrs(data, req.response_crsid)
+
+    # And export to a zipped Zarr store, one time slice at a time.  Keyword arguments (chunk_size)
+    # may be set with the renderer's kwargs in the format config.
+    return zarr_response(data, **zarr_options)
@@ -8,10 +8,10 @@ from __future__ import absolute_import, division, print_function
 import collections
 import logging
 
+import rasterio
 from datacube.utils import geometry
 from dateutil.parser import parse
 from ows.wcs.v20 import ScaleAxis, ScaleExtent, ScaleSize, Slice, Trim
-from rasterio import MemoryFile
 
 from datacube_ows.cube_pool import cube
 from datacube_ows.data import DataStacker
@@ -21,6 +21,10 @@ from datacube_ows.ows_configuration import get_config
 from datacube_ows.resource_limits import ResourceLimited
 from datacube_ows.utils import default_to_utc
 from datacube_ows.wcs_scaler import WCSScaler, WCSScalerUnknownDimension
+from datacube_ows.wcs_utils import (COG_MIME, CoverageFile,
+                                    clean_coverage_attrs, gdal_num_threads,
+                                    netcdf_response, wcs_dask_chunks,
+                                    write_band, write_cog, zarr_response)
 
 # from datacube_ows.wcs_utils import get_bands_from_styles
 
@@ -261,7 +265,8 @@ def get_coverage_data(request, styles, qprof):
         stacker = DataStacker(layer,
                               geobox,
                               times,
-                              bands=bands)
+                              bands=bands,
+                              dask_chunks=wcs_dask_chunks(cfg, geobox))
         qprof.end_event("setup")
         qprof.start_event("count-datasets")
         n_datasets = stacker.datasets(dc.index, mode=MVSelectOpts.COUNT)
@@ -306,7 +311,7 @@ def get_coverage_data(request, styles, qprof):
     #
     # TODO: configurable
     #
-    if fmt.mime == 'image/geotiff':
+    if fmt.mime in ('image/geotiff', COG_MIME):
         output = fmt.renderer(request.version)(request, output, output_crs,
                               layer, scaler.size.x, scaler.size.y, affine)
 
@@ -321,8 +326,12 @@ def get_coverage_data(request, styles, qprof):
     return output, headers
 
 
-def get_tiff(request, data, crs, product, width, height, affine):
-    """Uses rasterio MemoryFiles in order to return a streamable GeoTiff response"""
+def write_tiff(fname, request, data, crs, product, width, height, affine, **creation_options):
+    """
+    Write coverage data to a GeoTiff file.
+
+    Keyword arguments override the creation options from the request's GeoTiff encoding parameters.
+    """
     # Does not support multi-time dimension data - is this even possible in GeoTiff?
     supported_dtype_map = {
         'uint8': 1,
@@ -352,60 +361,87 @@ def get_tiff(request, data, crs, product, width, height, affine):
     nodata = 0
     for band in data.data_vars:
         nodata = product.band_idx.nodata_val(band)
-    with MemoryFile() as memfile:
-        # pylint: disable=protected-access, bad-continuation
-
-        kwargs = {}
-        if gtiff.tile_width is not None:
-            kwargs['blockxsize'] = gtiff.tile_width
-        if gtiff.tile_height is not None:
-            kwargs['blockysize'] = gtiff.tile_height
-
-        if gtiff.predictor:
-            predictor = gtiff.predictor.lower()
-            if predictor == 'horizontal':
-                kwargs['predictor'] = 2
-            elif predictor == 'floatingpoint':
-                kwargs['predictor'] = 3
-        elif dtype == "float64":
-                kwargs["predictor"] = 3
-        else:
-            kwargs["predictor"] = 2
-
-        with memfile.open(
-            driver="GTiff",
-            width=width,
-            height=height,
-            count=len(data.data_vars),
-            transform=affine,
-            crs=crs,
-            nodata=nodata,
-            tiled=gtiff.tiling if gtiff.tiling is not None else True,
-            compress=gtiff.compression.lower() if gtiff.compression else "lzw",
-            interleave=gtiff.interleave or "band",
-            dtype=dtype, **kwargs) as dst:
-            for idx, band in enumerate(data.data_vars, start=1):
-                dst.write(data[band].values, idx)
-                dst.set_band_description(idx, product.band_idx.band_label(band))
-                if cfg.wcs_tiff_statistics:
-                    dst.update_tags(idx, STATISTICS_MINIMUM=data[band].values.min())
-                    dst.update_tags(idx, STATISTICS_MAXIMUM=data[band].values.max())
-                    dst.update_tags(idx, STATISTICS_MEAN=data[band].values.mean())
-                    dst.update_tags(idx, STATISTICS_STDDEV=data[band].values.std())
-        return memfile.read()
-
-
-def get_netcdf(request, data, crs):
+    # pylint: disable=protected-access, bad-continuation
+    kwargs = {}
+    if gtiff.tile_width is not None:
+        kwargs['blockxsize'] = gtiff.tile_width
+    if gtiff.tile_height is not None:
+        kwargs['blockysize'] = gtiff.tile_height
+
+    if gtiff.predictor:
+        predictor = gtiff.predictor.lower()
+        if predictor == 'horizontal':
+            kwargs['predictor'] = 2
+        elif predictor == 'floatingpoint':
+            kwargs['predictor'] = 3
+    elif dtype == "float64":
+            kwargs["predictor"] = 3
+    else:
+        kwargs["predictor"] = 2
+    kwargs["tiled"] = gtiff.tiling if gtiff.tiling is not None else True
+    kwargs["compress"] = gtiff.compression.lower() if gtiff.compression else "lzw"
+    kwargs["interleave"] = gtiff.interleave or "band"
+    kwargs.update(creation_options)
+
+    with rasterio.open(
+        fname, "w",
+        driver="GTiff",
+        width=width,
+        height=height,
+        count=len(data.data_vars),
+        transform=affine,
+        crs=crs,
+        nodata=nodata,
+        dtype=dtype, **kwargs) as dst:
+        for idx, band in enumerate(data.data_vars, start=1):
+            write_band(dst, idx, data[band], nodata=product.band_idx.nodata_val(band),
+                       statistics=cfg.wcs_tiff_statistics)
+            dst.set_band_description(idx, product.band_idx.band_label(band))
+
+
+def get_tiff(request, data, crs, product, width, height, affine, num_threads=None):
+    """
+    Writes the GeoTiff to a temporary file, which is streamed back as the response
+
+    num_threads (a positive integer or "ALL_CPUS") enables multithreaded GDAL compression, and may be
+    set with the renderer's kwargs in the format config.
+    """
+    options = {}
+    threads = gdal_num_threads(num_threads)
+    if threads:
+        options["num_threads"] = threads
+    with CoverageFile(".tif") as covfile:
+        write_tiff(covfile.name, request, data, crs, product, width, height, affine, **options)
+    return covfile.response()
+
+
+def get_cog(request, data, crs, product, width, height, affine, **cog_options):
+    """
+    Writes a Cloud Optimized GeoTiff to a temporary file, which is streamed back as the response.
+
+    Keyword arguments (overview_levels, blocksize, compression, overview_resampling and num_threads)
+    are passed through to wcs_utils.write_cog, and may be set with the renderer's kwargs in the
+    format config.
+    """
+    with CoverageFile(".tif") as covfile:
+        write_cog(lambda fname, **opts: write_tiff(fname, request, data, crs, product, width, height, affine, **opts),
+                  covfile.name, width, height, **cog_options)
+    return covfile.response()
+
+
+def get_netcdf(request, data, crs, **netcdf_options):
     # Cleanup dataset attributes for NetCDF export
-    data.attrs["crs"] = crs # geometry.CRS(response_crs)
-    for v in data.data_vars.values():
-        v.attrs["crs"] = crs
-        if "spectral_definition" in v.attrs:
-            del v.attrs["spectral_definition"]
-        if "flags_definition" in v.attrs:
-            del v.attrs["flags_definition"]
-    if "time" in data and "units" in data["time"].attrs:
-        del data["time"].attrs["units"]
-
-    # And export to NetCDF
-    return data.to_netcdf()
+    clean_coverage_attrs(data, crs)
+
+    # And export to compressed NetCDF4.  Keyword arguments (complevel, shuffle, chunk_size)
+    # may be set with the renderer's kwargs in the format config.
+    return netcdf_response(data, **netcdf_options)
+
+
+def get_zarr(request, data, crs, **zarr_options):
+    # Cleanup dataset attributes for Zarr export
+    clean_coverage_attrs(data, crs)
+
+    # And export to a zipped Zarr store, one time slice at a time.  Keyword arguments (chunk_size)
+    # may be set with the renderer's kwargs in the format config.
+    return zarr_response(data, **zarr_options)
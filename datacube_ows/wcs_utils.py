@@ -3,7 +3,30 @@
 #
 # Copyright (c) 2017-2021 OWS Contributors
 # SPDX-License-Identifier: Apache-2.0
+import math
+import os
+import tempfile
+import zipfile
+from typing import (Any, Callable, Iterator, List, Mapping, Optional,
+                    Sequence)
+
+import numpy
+import rasterio
+from flask import Response
+from rasterio.enums import Resampling
+from rasterio.shutil import copy
+from rasterio.windows import Window
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
 from datacube_ows.ogc_exceptions import WCS1Exception, WCS2Exception
+from datacube_ows.ogc_utils import ConfigException
+
+# Coverage files are streamed back to the client in chunks of this size.
+COVERAGE_STREAM_CHUNK_SIZE = 1024 * 1024
 
 
 def get_bands_from_styles(styles, layer, version=1):
@@ -20,3 +43,377 @@ def get_bands_from_styles(styles, layer, version=1):
             if b not in style.flag_bands:
                 bands.add(b)
     return bands
+
+
+def wcs_dask_chunks(cfg, geobox):
+    """
+    The dask chunks to load WCS coverage data with.
+
+    :param cfg: The global OWS config
+    :param geobox: The geobox of the requested coverage
+    :return: A dask chunks dictionary, or None if WCS data is to be loaded eagerly.
+    """
+    if cfg.wcs_dask_chunk_size is None:
+        return None
+    chunks = {"time": 1}
+    for dim in geobox.dimensions:
+        chunks[dim] = cfg.wcs_dask_chunk_size
+    return chunks
+
+
+def band_blocks(band):
+    """
+    Iterate over a (y, x) band of coverage data, one dask chunk at a time.
+
+    Only one chunk of a lazily loaded band is computed (and held in memory) at a time.
+    Bands that are not dask arrays are returned as a single block.
+
+    :param band: A two dimensional xarray DataArray
+    :return: A generator of (window, block) tuples, where window is a rasterio Window (or None
+             for the whole band) and block is a numpy array.
+    """
+    if band.chunks is None:
+        yield None, band.values
+        return
+    y_chunks, x_chunks = band.chunks
+    y_off = 0
+    for height in y_chunks:
+        x_off = 0
+        for width in x_chunks:
+            yield Window(x_off, y_off, width, height), band[y_off:y_off + height, x_off:x_off + width].values
+            x_off += width
+        y_off += height
+
+
+class BandStatistics:
+    """
+    Single-pass GeoTIFF band statistics (minimum, maximum, mean and standard deviation).
+
+    Blocks of a band are added as they are written, so the band is only read once.  Nodata and NaN
+    pixels are ignored.  Per-block counts, means and sums of squared deviations are combined with
+    Chan et al's parallel variance algorithm, which is numerically stable over many blocks.
+    """
+    def __init__(self, nodata=None) -> None:
+        self.nodata = nodata
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, block: numpy.ndarray) -> None:
+        valid = None
+        if numpy.issubdtype(block.dtype, numpy.floating):
+            valid = ~numpy.isnan(block)
+        if self.nodata is not None and not numpy.isnan(self.nodata):
+            if valid is None:
+                valid = block != self.nodata
+            else:
+                valid &= block != self.nodata
+        values = block if valid is None else block[valid]
+        count = values.size
+        if not count:
+            return
+        minimum, maximum = values.min(), values.max()
+        mean = values.mean(dtype=numpy.float64)
+        m2 = numpy.square(values - mean, dtype=numpy.float64).sum()
+        if self.count:
+            total = self.count + count
+            delta = mean - self.mean
+            self.mean += delta * count / total
+            self.m2 += m2 + delta * delta * self.count * count / total
+            self.count = total
+            self.minimum = min(self.minimum, minimum)
+            self.maximum = max(self.maximum, maximum)
+        else:
+            self.count, self.mean, self.m2 = count, float(mean), float(m2)
+            self.minimum, self.maximum = minimum, maximum
+
+    @property
+    def stddev(self) -> float:
+        return math.sqrt(self.m2 / self.count) if self.count else math.nan
+
+    def tags(self) -> Mapping[str, Any]:
+        """
+        :return: GDAL statistics tags (empty if the band has no valid pixels)
+        """
+        if not self.count:
+            return {}
+        return {
+            "STATISTICS_MINIMUM": self.minimum,
+            "STATISTICS_MAXIMUM": self.maximum,
+            "STATISTICS_MEAN": self.mean,
+            "STATISTICS_STDDEV": self.stddev,
+        }
+
+
+def write_band(dst, idx: int, band, nodata=None, statistics: bool = False) -> None:
+    """
+    Write a band to an open rasterio dataset one block at a time, optionally
+    calculating and tagging band statistics in the same pass.
+
+    :param dst: A rasterio dataset open for writing
+    :param idx: The (1-based) band index to write to
+    :param band: A (y, x) xarray DataArray
+    :param nodata: The nodata value, excluded from statistics
+    :param statistics: If true, write GDAL band statistics tags
+    """
+    stats = BandStatistics(nodata) if statistics else None
+    for window, block in band_blocks(band):
+        dst.write(block, idx, window=window)
+        if stats is not None:
+            stats.add(block)
+    if stats is not None:
+        dst.update_tags(idx, **stats.tags())
+
+
+def gdal_num_threads(num_threads) -> Optional[str]:
+    """
+    Validate a GeoTIFF renderer num_threads option, as the GDAL NUM_THREADS creation option.
+
+    :param num_threads: None (single-threaded compression), a positive integer or "ALL_CPUS"
+    :return: The NUM_THREADS creation option value, or None
+    """
+    if num_threads is None:
+        return None
+    if isinstance(num_threads, str) and num_threads.upper() == "ALL_CPUS":
+        return "ALL_CPUS"
+    try:
+        threads = int(num_threads)
+    except ValueError:
+        raise ConfigException(f"num_threads must be a positive integer or ALL_CPUS: {num_threads}")
+    if threads < 1:
+        raise ConfigException(f"num_threads must be a positive integer or ALL_CPUS: {num_threads}")
+    return str(threads)
+
+
+class CoverageFile:
+    """
+    A temporary file to write a coverage response to, which is then streamed back to the client.
+
+    Used in place of a rasterio MemoryFile, so the encoded coverage is never held in memory in full.
+    The file is deleted once the response has been sent (or if writing it fails).
+
+    Usage:
+        with CoverageFile(".tif") as covfile:
+            with rasterio.open(covfile.name, "w", ...) as dst:
+                ...
+        return covfile.response()
+    """
+    def __init__(self, suffix: str = "") -> None:
+        self.fp = tempfile.NamedTemporaryFile(suffix=suffix, prefix="ows_coverage_")
+        self.name = self.fp.name
+
+    def __enter__(self) -> "CoverageFile":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is not None:
+            self.fp.close()
+
+    def chunks(self) -> Iterator[bytes]:
+        try:
+            self.fp.seek(0)
+            while True:
+                chunk = self.fp.read(COVERAGE_STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.fp.close()
+
+    def response(self) -> Response:
+        """
+        :return: A streamed Flask response of the file contents
+        """
+        size = os.fstat(self.fp.fileno()).st_size
+        return Response(self.chunks(), headers={"Content-Length": str(size)}, direct_passthrough=True)
+
+
+# Media type of Cloud Optimized GeoTIFF coverages.
+COG_MIME = "image/tiff; application=geotiff; profile=cloud-optimized"
+
+COG_COMPRESSIONS = ("deflate", "zstd", "lerc", "lzw", "none")
+
+
+def cog_overview_levels(width: int, height: int, blocksize: int) -> List[int]:
+    """
+    Default COG overview decimation factors: halve the resolution until the image fits in a single block.
+    """
+    levels = []
+    factor = 2
+    while math.ceil(max(width, height) / (factor // 2)) > blocksize:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def write_cog(write_tiff: Callable[..., None], dst_name: str, width: int, height: int,
+              overview_levels: Optional[Sequence[int]] = None,
+              blocksize: int = 512,
+              compression: str = "deflate",
+              overview_resampling: str = "nearest",
+              num_threads=None) -> None:
+    """
+    Write a Cloud Optimized GeoTIFF, with internal overviews.
+
+    The coverage data is written once, uncompressed, to an intermediate tiled GeoTIFF.  All overview
+    levels are then built from it in a single decimation pass and the result is copied into COG layout
+    (overviews after the full resolution image, compressed with the requested codec).
+
+    :param write_tiff: Function that writes the full resolution GeoTIFF to a filename, passing any
+            keyword arguments through as creation options.
+    :param dst_name: Filename to write the COG to
+    :param width: Width of the coverage in pixels
+    :param height: Height of the coverage in pixels
+    :param overview_levels: Overview decimation factors (default: halve until the image fits in one block)
+    :param blocksize: Internal tile size
+    :param compression: One of deflate, zstd, lerc, lzw or none
+    :param overview_resampling: Resampling method used to build the overviews
+    :param num_threads: Number of threads to compress with (a positive integer or "ALL_CPUS")
+    """
+    compression = compression.lower()
+    if compression not in COG_COMPRESSIONS:
+        raise ConfigException(f"Unsupported COG compression: {compression} (must be one of {', '.join(COG_COMPRESSIONS)})")
+    try:
+        resampling = Resampling[overview_resampling]
+    except KeyError:
+        raise ConfigException(f"Unsupported COG overview resampling method: {overview_resampling}")
+    if overview_levels is None:
+        overview_levels = cog_overview_levels(width, height, blocksize)
+    threads = gdal_num_threads(num_threads)
+    extra_options = {"NUM_THREADS": threads} if threads else {}
+    with tempfile.NamedTemporaryFile(suffix=".tif", prefix="ows_cog_") as tmp:
+        write_tiff(tmp.name, tiled=True, blockxsize=blocksize, blockysize=blocksize,
+                   compress="none", predictor=1)
+        if overview_levels:
+            with rasterio.open(tmp.name, "r+") as src:
+                src.build_overviews(list(overview_levels), resampling)
+        copy(tmp.name, dst_name, driver="COG",
+             BLOCKSIZE=blocksize,
+             COMPRESS=compression.upper(),
+             PREDICTOR="YES" if compression in ("deflate", "zstd", "lzw") else "NO",
+             OVERVIEWS="FORCE_USE_EXISTING" if overview_levels else "NONE",
+             **extra_options)
+
+
+def aligned_chunk_size(size: int, target: int) -> int:
+    """
+    The chunk size closest to target that divides a dimension of size pixels into equal(ish) chunks.
+    """
+    n_chunks = math.ceil(size / target)
+    return math.ceil(size / n_chunks)
+
+
+def netcdf_encoding(data, complevel: int = 4, shuffle: bool = True,
+                    chunk_size: int = 512) -> Mapping[str, Mapping[str, Any]]:
+    """
+    NetCDF4 encoding for each variable of a coverage: zlib compressed, and chunked
+    one time slice at a time, with spatial chunks evenly dividing the requested grid.
+
+    :param data: An xarray Dataset
+    :param complevel: zlib compression level (0 for no compression)
+    :param shuffle: Whether to apply the HDF5 byte shuffle filter
+    :param chunk_size: Target spatial chunk size
+    """
+    if complevel not in range(10):
+        raise ConfigException(f"NetCDF complevel must be between 0 and 9: {complevel}")
+    if chunk_size < 1:
+        raise ConfigException(f"NetCDF chunk_size must be positive: {chunk_size}")
+    encoding = {}
+    for name, var in data.data_vars.items():
+        var_enc = {
+            "zlib": complevel > 0,
+            "shuffle": shuffle and complevel > 0,
+        }
+        if complevel:
+            var_enc["complevel"] = complevel
+        if var.ndim and 0 not in var.shape:
+            var_enc["chunksizes"] = tuple(
+                1 if dim == "time" else aligned_chunk_size(size, chunk_size)
+                for dim, size in zip(var.dims, var.shape)
+            )
+        encoding[name] = var_enc
+    return encoding
+
+
+def netcdf_response(data, **netcdf_options) -> Response:
+    """
+    Write a coverage to a compressed, chunked NetCDF4 temporary file and stream it back.
+
+    :param data: An xarray Dataset (possibly dask backed - written chunk by chunk)
+    :param netcdf_options: Passed through to netcdf_encoding
+    :return: A streamed Flask response
+    """
+    with CoverageFile(".nc") as covfile:
+        data.to_netcdf(covfile.name, format="NETCDF4", engine="netcdf4",
+                       encoding=netcdf_encoding(data, **netcdf_options))
+    return covfile.response()
+
+
+def clean_coverage_attrs(data, crs: str) -> None:
+    """
+    Cleanup dataset attributes for export to self-describing formats (NetCDF, Zarr).
+
+    :param data: An xarray Dataset (modified in place)
+    :param crs: The CRS of the coverage
+    """
+    data.attrs["crs"] = crs
+    for v in data.data_vars.values():
+        v.attrs["crs"] = crs
+        if "spectral_definition" in v.attrs:
+            del v.attrs["spectral_definition"]
+        if "flags_definition" in v.attrs:
+            del v.attrs["flags_definition"]
+    if "time" in data and "units" in data["time"].attrs:
+        del data["time"].attrs["units"]
+
+
+def zarr_response(data, chunk_size: int = 512) -> Response:
+    """
+    Write a coverage to a zipped Zarr store and stream it back.
+
+    Each time slice is written (appended to the store) in turn, so dask backed coverages are only
+    loaded one time slice at a time.  Arrays are chunked one time slice at a time, with spatial chunks
+    evenly dividing the requested grid (or matching the dask chunks), and compressed with the Zarr
+    default compressor.
+
+    :param data: An xarray Dataset
+    :param chunk_size: Target spatial chunk size
+    :return: A streamed Flask response
+    """
+    if zarr is None:
+        raise ConfigException("Zarr coverage output requires the zarr package")
+    if chunk_size < 1:
+        raise ConfigException(f"Zarr chunk_size must be positive: {chunk_size}")
+    encoding = {}
+    for name, var in data.data_vars.items():
+        if var.chunks:
+            # Zarr chunks must not straddle dask chunks, so dask backed variables keep their chunking.
+            chunk_sizes = [dim_chunks[0] for dim_chunks in var.chunks]
+        else:
+            chunk_sizes = [aligned_chunk_size(size, chunk_size) for size in var.shape]
+        encoding[name] = {
+            "chunks": tuple(
+                1 if dim == "time" else chunk
+                for dim, chunk in zip(var.dims, chunk_sizes)
+            )
+        }
+    with tempfile.TemporaryDirectory(prefix="ows_zarr_") as store:
+        if "time" in data.dims and data.sizes["time"] > 1:
+            for i in range(data.sizes["time"]):
+                time_slice = data.isel(time=slice(i, i + 1))
+                if i == 0:
+                    time_slice.to_zarr(store, mode="w", encoding=encoding)
+                else:
+                    time_slice.to_zarr(store, append_dim="time")
+        else:
+            data.to_zarr(store, mode="w", encoding=encoding)
+        # Chunks are already compressed, so are stored in the zip file as-is.
+        with CoverageFile(".zarr.zip") as covfile:
+            with zipfile.ZipFile(covfile.name, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+                for dirpath, _, filenames in os.walk(store):
+                    for fname in sorted(filenames):
+                        path = os.path.join(dirpath, fname)
+                        zf.write(path, os.path.relpath(path, store))
+    return covfile.response()
@@ -22,6 +22,7 @@ from datacube_ows.ogc_exceptions import WMSException
 from datacube_ows.ogc_utils import ConfigException, create_geobox
 from datacube_ows.ows_configuration import get_config
 from datacube_ows.resource_limits import RequestScale
+from datacube_ows.solar_correction import cosine_of_solar_zenith
 from datacube_ows.styles import StyleDef
 from datacube_ows.styles.expression import ExpressionException
 from datacube_ows.utils import default_to_utc, find_matching_date
@@ -400,6 +401,9 @@ class GetLegendGraphicParameters():
 
 
 class GetMapParameters(GetParameters):
+    # Enforce the wms max_width/max_height
+    size_limited = True
+
     def method_specific_init(self, args):
         # Validate Format parameter
         self.format = get_arg(args, "format", "image format",
@@ -409,10 +413,10 @@ class GetMapParameters(GetParameters):
 
         self.style = single_style_from_args(self.product, args)
         cfg = get_config()
-        if self.geobox.width > cfg.wms_max_width:
+        if self.size_limited and self.geobox.width > cfg.wms_max_width:
             raise WMSException(f"Width {self.geobox.width} exceeds supported maximum {self.cfg.wms_max_width}.",
                                locator="Width parameter")
-        if self.geobox.height > cfg.wms_max_height:
+        if self.size_limited and self.geobox.height > cfg.wms_max_height:
             raise WMSException(f"Width {self.geobox.height} exceeds supported maximum {self.cfg.wms_max_height}.",
                                locator="Height parameter")
 
@@ -433,6 +437,12 @@ class GetMapParameters(GetParameters):
         )
 
 
+class GetMapBatchParameters(GetMapParameters):
+    # A batch of tiles is loaded as one image spanning all the tiles, which may
+    # exceed the maximum size of a single GetMap request.
+    size_limited = False
+
+
 class GetFeatureInfoParameters(GetParameters):
     def get_product(self, args):
         return get_product_from_arg(args, "query_layers")
@@ -460,29 +470,6 @@ class GetFeatureInfoParameters(GetParameters):
 
 
 # Solar angle correction functions
-def declination_rad(dt):
-    # Estimate solar declination from a datetime.  (value returned in radians).
-    # Formula taken from https://en.wikipedia.org/wiki/Position_of_the_Sun#Declination_of_the_Sun_as_seen_from_Earth
-    timedel = dt - datetime(dt.year, 1, 1, 0, 0, 0, tzinfo=utc)
-    day_count = timedel.days + timedel.seconds / (60.0 * 60.0 * 24.0)
-    return -1.0 * math.radians(23.44) * math.cos(2 * math.pi / 365 * (day_count + 10))
-
-
-def cosine_of_solar_zenith(lat, lon, utc_dt):
-    # Estimate cosine of solar zenith angle
-    # (angle between sun and local zenith) at requested latitude, longitude and datetime.
-    # Formula taken from https://en.wikipedia.org/wiki/Solar_zenith_angle
-    utc_seconds_since_midnight = ((utc_dt.hour * 60) + utc_dt.minute) * 60 + utc_dt.second
-    utc_hour_deg_angle = (utc_seconds_since_midnight / (60 * 60 * 24) * 360.0) - 180.0
-    local_hour_deg_angle = utc_hour_deg_angle + lon
-    local_hour_angle_rad = math.radians(local_hour_deg_angle)
-    latitude_rad = math.radians(lat)
-    solar_decl_rad = declination_rad(utc_dt)
-    result = math.sin(latitude_rad) * math.sin(solar_decl_rad) \
-             + math.cos(latitude_rad) * math.cos(solar_decl_rad) * math.cos(local_hour_angle_rad)
-    return result
-
-
 def solar_correct_data(data, dataset):
     # Apply solar angle correction to the data for a dataset.
     # See for example http://gsp.humboldt.edu/olm_2015/Courses/GSP_216_Online/lesson4-1/radiometric.html
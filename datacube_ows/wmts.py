@@ -6,13 +6,15 @@
 from __future__ import absolute_import, division, print_function
 
 import logging
+from uuid import uuid4
 
 from flask import render_template
 
-from datacube_ows.data import feature_info, get_map
+from datacube_ows.data import feature_info, get_map, get_map_tiles
 from datacube_ows.ogc_exceptions import WMSException, WMTSException
 from datacube_ows.ogc_utils import cache_control_headers, get_service_base_url
 from datacube_ows.ows_configuration import get_config
+from datacube_ows.tile_cache import TileKey
 from datacube_ows.utils import log_call
 
 _LOG = logging.getLogger(__name__)
@@ -35,6 +37,8 @@ def handle_wmts(nocase_args):
         return get_tile(nocase_args)
     elif operation == "GETFEATUREINFO":
         return get_feature_info(nocase_args)
+    elif operation == "GETTILES" and get_config().wmts_max_batch_tiles > 0:
+        return get_tiles_response(nocase_args)
     else:
         raise WMTSException("Unrecognised operation: %s" % operation, WMTSException.OPERATION_NOT_SUPPORTED,
                            "Request parameter")
@@ -168,22 +172,159 @@ def wmts_args_to_wms(args, cfg):
     return wms_args
 
 
+def wms_to_wmts_exception(wmse):
+    first_error = wmse.errors[0]
+    e = WMTSException(first_error["msg"],
+                        code=first_error["code"],
+                        locator=first_error["locator"],
+                        http_response=wmse.http_response)
+    for error in wmse.errors[1:]:
+        e.add_error(error["msg"], code=error["code"], locator=error["locator"])
+    return e
+
+
+def tile_cache_for(args, cfg):
+    # Query profiling requests are never cached.
+    if cfg.tile_cache is None or args.get("ows_stats"):
+        return None
+    return cfg.tile_cache
+
+
 @log_call
 def get_tile(args):
     cfg = get_config()
     wms_args = wmts_args_to_wms(args, cfg)
+    tile_cache = tile_cache_for(args, cfg)
+    if tile_cache:
+        key = TileKey.from_args(args)
+        resp = tile_cache.get(key)
+        if resp is not None:
+            return resp
+
+    try:
+        resp = get_map(wms_args)
+    except WMSException as wmse:
+        raise wms_to_wmts_exception(wmse)
+    if tile_cache:
+        tile_cache.put(key, resp)
+    return resp
+
+
+@log_call
+def get_tiles(args, tiles):
+    """
+    Render a batch of tiles from the same tile matrix, from a single data load.
+
+    The tiles are loaded and styled as one image spanning all the requested tiles, which is then sliced into
+    individual tiles.  If the spanning image exceeds the layer's resource limits, each tile is rendered
+    separately, as for GetTile.
 
+    :param args: GetTile arguments (tilerow and tilecol are ignored)
+    :param tiles: An iterable of (row, col) tuples
+    :return: A dictionary mapping (row, col) tuples to response tuples.
+    """
+    cfg = get_config()
+    tiles = sorted(set((int(row), int(col)) for row, col in tiles))
+    if not tiles:
+        raise WMTSException("No tiles requested")
+    tile_cache = tile_cache_for(args, cfg)
+    cached = {}
+    if tile_cache:
+        keys = {
+            (row, col): TileKey.from_args(dict(args, tilerow=str(row), tilecol=str(col)))
+            for row, col in tiles
+        }
+        for tile, key in keys.items():
+            resp = tile_cache.get(key)
+            if resp is not None:
+                cached[tile] = resp
+        tiles = [tile for tile in tiles if tile not in cached]
+        if not tiles:
+            return cached
+    min_row = min(row for row, col in tiles)
+    max_row = max(row for row, col in tiles)
+    min_col = min(col for row, col in tiles)
+    max_col = max(col for row, col in tiles)
+
+    def tile_args(row, col):
+        targs = dict(args)
+        targs["tilerow"] = str(row)
+        targs["tilecol"] = str(col)
+        return wmts_args_to_wms(targs, cfg)
+
+    # The bounding box coordinates of the top-left and bottom-right tiles
+    # are both in (min, min, max, max) order.
+    first = [float(c) for c in tile_args(min_row, min_col)["bbox"].split(",")]
+    last = [float(c) for c in tile_args(max_row, max_col)["bbox"].split(",")]
+    wms_args = tile_args(min_row, min_col)
+    wms_args["bbox"] = "%f,%f,%f,%f" % (
+        min(first[0], last[0]), min(first[1], last[1]),
+        max(first[2], last[2]), max(first[3], last[3]),
+    )
+    tile_width, tile_height = int(wms_args["width"]), int(wms_args["height"])
+    wms_args["width"] = tile_width * (max_col - min_col + 1)
+    wms_args["height"] = tile_height * (max_row - min_row + 1)
+    windows = {
+        (row, col): (
+            slice((row - min_row) * tile_height, (row - min_row + 1) * tile_height),
+            slice((col - min_col) * tile_width, (col - min_col + 1) * tile_width),
+        )
+        for row, col in tiles
+    }
     try:
-        return get_map(wms_args)
+        responses = get_map_tiles(wms_args, windows)
+        if responses is None:
+            responses = {
+                (row, col): get_map(tile_args(row, col))
+                for row, col in tiles
+            }
     except WMSException as wmse:
-        first_error = wmse.errors[0]
-        e = WMTSException(first_error["msg"],
-                            code=first_error["code"],
-                            locator=first_error["locator"],
-                            http_response=wmse.http_response)
-        for error in wmse.errors[1:]:
-            e.add_error(error["msg"], code=error["code"], locator=error["locator"])
-        raise e
+        raise wms_to_wmts_exception(wmse)
+    if tile_cache:
+        for tile, resp in responses.items():
+            tile_cache.put(keys[tile], resp)
+    responses.update(cached)
+    return responses
+
+
+@log_call
+def get_tiles_response(args):
+    # Non-standard batch GetTile: tiles=row1:col1,row2:col2,...
+    # Returns a multipart/mixed response with one PNG image part per tile.
+    cfg = get_config()
+    try:
+        tiles = [
+            tuple(int(c) for c in tile.split(":"))
+            for tile in args.get("tiles", "").split(",")
+            if tile
+        ]
+    except ValueError:
+        raise WMTSException(f"Invalid Tiles: {args.get('tiles')}", locator="Tiles parameter")
+    if not tiles or any(len(tile) != 2 for tile in tiles):
+        raise WMTSException(f"Invalid Tiles: {args.get('tiles')}", locator="Tiles parameter")
+    span = ((max(r for r, c in tiles) - min(r for r, c in tiles) + 1)
+            * (max(c for r, c in tiles) - min(c for r, c in tiles) + 1))
+    if span > cfg.wmts_max_batch_tiles:
+        raise WMTSException(f"Requested tiles span {span} tiles - maximum is {cfg.wmts_max_batch_tiles}",
+                            locator="Tiles parameter")
+    responses = get_tiles(args, tiles)
+    boundary = f"ows-tiles-{uuid4().hex}"
+    parts = []
+    for (row, col), (body, status, headers) in responses.items():
+        parts.append(
+            (
+                f"--{boundary}\r\n"
+                f"Content-Type: {headers.get('Content-Type', 'image/png')}\r\n"
+                f"X-WMTS-TileRow: {row}\r\n"
+                f"X-WMTS-TileCol: {col}\r\n\r\n"
+            ).encode("utf-8")
+            + body + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+    first_headers = next(iter(responses.values()))[2]
+    headers = {k: v for k, v in first_headers.items() if k != "Content-Type"}
+    headers["Content-Type"] = f"multipart/mixed; boundary={boundary}"
+    return b"".join(parts), 200, headers
 
 
 @log_call
@@ -195,11 +336,4 @@ def get_feature_info(args):
     try:
         return feature_info(wms_args)
     except WMSException as wmse:
-        first_error = wmse.errors[0]
-        e = WMTSException(first_error["msg"],
-                          code=first_error["code"],
-                          locator=first_error["locator"],
-                          http_response=wmse.http_response)
-        for error in wmse.errors[1:]:
-            e.add_error(error["msg"], code=error["code"], locator=error["locator"])
-        raise e
+        raise wms_to_wmts_exception(wmse)
@@ -7,7 +7,9 @@ import pytest
 from datacube.utils.geometry import box
 
 from datacube_ows.cube_pool import cube
-from datacube_ows.mv_index import MVSelectOpts, mv_search
+from datacube_ows.mv_index import (MVSelectOpts, mv_footprint_extent,
+                                   mv_lean_datasets, mv_search,
+                                   mv_search_summary)
 from datacube_ows.ogc_utils import local_solar_date_range
 from datacube_ows.ows_configuration import get_config
 
@@ -80,6 +82,22 @@ def test_count():
         assert len(ids) == count
 
 
+def test_summary():
+    cfg = get_config()
+    lyr = list(cfg.product_index.values())[0]
+    with cube() as dc:
+        count = mv_search(dc.index, MVSelectOpts.COUNT, products=lyr.products)
+        ids = mv_search(dc.index, MVSelectOpts.IDS, products=lyr.products)
+        summary = mv_search_summary(dc.index, products=lyr.products)
+        assert summary.count == count
+        assert set(summary.ids) == set(str(i) for i in ids)
+        assert not summary.has_extent
+        assert summary.extent is None
+        summary = mv_search_summary(dc.index, products=lyr.products, with_extent=True)
+        assert summary.has_extent
+        assert summary.extent is not None
+
+
 def test_datasets():
     cfg = get_config()
     lyr = list(cfg.product_index.values())[0]
@@ -91,6 +109,24 @@ def test_datasets():
             assert str(ds.id) in ids
 
 
+def test_lean_datasets():
+    cfg = get_config()
+    lyr = list(cfg.product_index.values())[0]
+    with cube() as dc:
+        ids = mv_search(dc.index, MVSelectOpts.IDS, products=lyr.products)
+        lean_dss = {str(ds.id): ds for ds in mv_lean_datasets(dc.index, ids, lyr.products)}
+        full_dss = {str(ds.id): ds for ds in dc.index.datasets.bulk_get(ids)}
+        assert set(lean_dss.keys()) == set(full_dss.keys())
+        for dsid, ds in full_dss.items():
+            lean = lean_dss[dsid]
+            assert lean.product.name == ds.product.name
+            assert lean.uris == ds.uris
+            assert lean.crs == ds.crs
+            assert lean.center_time == ds.center_time
+            assert lean.measurements == ds.measurements
+            assert lean.extent == ds.extent
+
+
 def test_extent_and_spatial():
     cfg = get_config()
     lyr = list(cfg.product_index.values())[0]
@@ -131,3 +167,20 @@ def test_extent_and_spatial():
             dc.index, MVSelectOpts.COUNT, geom=small_geom, products=lyr.products
         )
         assert small_count <= all_count
+
+
+def test_footprint_extent():
+    cfg = get_config()
+    lyr = list(cfg.product_index.values())[0]
+    geom = box(
+        lyr.bboxes["EPSG:4326"]["left"],
+        lyr.bboxes["EPSG:4326"]["bottom"],
+        lyr.bboxes["EPSG:4326"]["right"],
+        lyr.bboxes["EPSG:4326"]["top"],
+        "EPSG:4326",
+    )
+    with cube() as dc:
+        found, extent = mv_footprint_extent(dc.index, lyr.products, None, geom)
+        if found:
+            mv_extent = mv_search(dc.index, MVSelectOpts.EXTENT, geom=geom, products=lyr.products)
+            assert extent.area == pytest.approx(mv_extent.area, rel=0.01)
@@ -135,6 +135,25 @@ def test_wmts_gettile(ows_server):
     assert tile
     assert tile.info()["Content-Type"] == "image/png"
 
+def test_wmts_get_tiles(flask_client):
+    from datacube_ows.wmts import get_tiles
+    args = {
+        "layer": "s2_l2a",
+        "style": "simple_rgb",
+        "format": "image/png",
+        "tilematrixset": "WholeWorld_WebMercator",
+        "tilematrix": "13",
+        "requestid": "test",
+    }
+    requested = [(5171, 7458), (5171, 7459), (5172, 7458)]
+    tiles = get_tiles(args, requested)
+    assert set(tiles.keys()) == set(requested)
+    for body, status, headers in tiles.values():
+        assert status == 200
+        assert headers["Content-Type"] == "image/png"
+        assert body[1:4] == b"PNG"
+
+
 def test_wmts_getfeatinfo(ows_server):
     url = ows_server.url + ("/wmts?SERVICE=WMTS&REQUEST=GetFeatureInfo&VERSION=1.0.0&" +
                             "LAYER=s2_l2a&STYLE=simple_rgb&" +
@@ -62,11 +62,15 @@ operational_requirements = [
 ]
 setup_requirements = ['setuptools_scm', 'setuptools']
 
+# Optional WCS output formats
+zarr_requirements = ['zarr']
+
 extras = {
     "dev": dev_requirements + test_requirements + operational_requirements,
     "test": test_requirements,
     "ops": operational_requirements,
     "setup": setup_requirements,
+    "zarr": zarr_requirements,
     "all": dev_requirements + test_requirements + operational_requirements,
 }
 
@@ -118,6 +118,7 @@ def minimal_global_cfg():
     global_cfg.contact_org = None
     global_cfg.contact_position = None
     global_cfg.abstract = "Global Abstract"
+    global_cfg.wms_render_precision = "float64"
     global_cfg.authorities = {
         "auth0": "http://test.url/auth0",
         "auth1": "http://test.url/auth1",
@@ -197,6 +197,21 @@ def test_tiff_stats(minimal_global_raw_cfg, wcs_global_cfg):
     minimal_global_raw_cfg["wcs"]["calculate_tiff_statistics"] = False
     cfg = OWSConfig(cfg=minimal_global_raw_cfg)
     assert not cfg.wcs_tiff_statistics
+    assert cfg.wcs_dask_chunk_size is None
+
+
+def test_wcs_dask_chunk_size(minimal_global_raw_cfg, wcs_global_cfg):
+    OWSConfig._instance = None
+    minimal_global_raw_cfg["global"]["services"] = {"wcs": True}
+    minimal_global_raw_cfg["wcs"] = wcs_global_cfg
+    minimal_global_raw_cfg["wcs"]["dask_chunk_size"] = 1024
+    cfg = OWSConfig(cfg=minimal_global_raw_cfg)
+    assert cfg.wcs_dask_chunk_size == 1024
+    OWSConfig._instance = None
+    minimal_global_raw_cfg["wcs"]["dask_chunk_size"] = 0
+    with pytest.raises(ConfigException) as excinfo:
+        cfg = OWSConfig(cfg=minimal_global_raw_cfg)
+    assert "dask_chunk_size in wcs section must be positive" in str(excinfo.value)
 
 def test_crs_lookup_fail(minimal_global_raw_cfg, minimal_dc):
     OWSConfig._instance = None
@@ -261,3 +276,76 @@ def test_bad_integers_in_wms_section(minimal_global_raw_cfg, minimal_dc):
         cfg = OWSConfig(cfg=minimal_global_raw_cfg)
     assert "caps_cache_maxage in wms section cannot be negative" in str(e.value)
     assert "-100" in str(e.value)
+
+
+def test_wms_render_precision(minimal_global_raw_cfg, minimal_dc):
+    OWSConfig._instance = None
+    cfg = OWSConfig(cfg=minimal_global_raw_cfg)
+    assert cfg.wms_render_precision == "float64"
+    minimal_global_raw_cfg["wms"] = {"render_precision": "float32"}
+    OWSConfig._instance = None
+    cfg = OWSConfig(cfg=minimal_global_raw_cfg)
+    assert cfg.wms_render_precision == "float32"
+    minimal_global_raw_cfg["wms"]["render_precision"] = "double"
+    with pytest.raises(ConfigException) as e:
+        OWSConfig._instance = None
+        cfg = OWSConfig(cfg=minimal_global_raw_cfg)
+    assert "Invalid render_precision double in wms section" in str(e.value)
+
+
+def test_search_cache_cfg(minimal_global_raw_cfg, minimal_dc):
+    from datacube_ows.mv_index import mv_search_cache
+    OWSConfig._instance = None
+    cfg = OWSConfig(cfg=minimal_global_raw_cfg)
+    assert cfg.search_cache_max_entries == 0
+    assert not mv_search_cache.active
+    minimal_global_raw_cfg["global"]["search_cache"] = {
+        "max_entries": 500,
+        "max_age": 60,
+        "grid_size": 0.5,
+    }
+    OWSConfig._instance = None
+    cfg = OWSConfig(cfg=minimal_global_raw_cfg)
+    assert mv_search_cache.active
+    assert mv_search_cache.max_entries == 500
+    assert mv_search_cache.max_age == 60
+    assert mv_search_cache.grid_size == 0.5
+    assert mv_search_cache.max_cells == 4
+    minimal_global_raw_cfg["global"]["search_cache"]["max_entries"] = -1
+    with pytest.raises(ConfigException) as e:
+        OWSConfig._instance = None
+        cfg = OWSConfig(cfg=minimal_global_raw_cfg)
+    assert "max_entries must be a non-negative integer" in str(e.value)
+    minimal_global_raw_cfg["global"]["search_cache"]["max_entries"] = 10
+    minimal_global_raw_cfg["global"]["search_cache"]["grid_size"] = 0
+    with pytest.raises(ConfigException) as e:
+        OWSConfig._instance = None
+        cfg = OWSConfig(cfg=minimal_global_raw_cfg)
+    assert "grid_size must be positive" in str(e.value)
+    minimal_global_raw_cfg["global"]["search_cache"]["grid_size"] = 0.5
+    minimal_global_raw_cfg["global"]["search_cache"]["max_cells"] = 0
+    with pytest.raises(ConfigException) as e:
+        OWSConfig._instance = None
+        cfg = OWSConfig(cfg=minimal_global_raw_cfg)
+    assert "max_cells must be a positive integer" in str(e.value)
+    mv_search_cache.configure()
+
+
+def test_wmts_max_batch_tiles(minimal_global_raw_cfg, minimal_dc):
+    OWSConfig._instance = None
+    cfg = OWSConfig(cfg=minimal_global_raw_cfg)
+    assert cfg.wmts_max_batch_tiles == 0
+    minimal_global_raw_cfg["wmts"] = {"max_batch_tiles": 16}
+    OWSConfig._instance = None
+    cfg = OWSConfig(cfg=minimal_global_raw_cfg)
+    assert cfg.wmts_max_batch_tiles == 16
+    minimal_global_raw_cfg["wmts"]["max_batch_tiles"] = "lots"
+    with pytest.raises(ConfigException) as e:
+        OWSConfig._instance = None
+        cfg = OWSConfig(cfg=minimal_global_raw_cfg)
+    assert "max_batch_tiles in wmts section must be an integer" in str(e.value)
+    minimal_global_raw_cfg["wmts"]["max_batch_tiles"] = -1
+    with pytest.raises(ConfigException) as e:
+        OWSConfig._instance = None
+        cfg = OWSConfig(cfg=minimal_global_raw_cfg)
+    assert "cannot be negative" in str(e.value)
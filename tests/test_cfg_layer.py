@@ -449,6 +449,16 @@ def test_manual_merge(minimal_layer_cfg, minimal_global_cfg):
     lyr = parse_ows_layer(minimal_layer_cfg,
                           global_cfg=minimal_global_cfg)
     assert not lyr.ready
+    assert lyr.manual_merge_threads == 1
+    minimal_layer_cfg["image_processing"]["manual_merge_threads"] = 0
+    minimal_global_cfg.product_index = {}
+    with pytest.raises(ConfigException) as excinfo:
+        parse_ows_layer(minimal_layer_cfg, global_cfg=minimal_global_cfg)
+    assert "manual_merge_threads must be at least 1" in str(excinfo.value)
+    minimal_layer_cfg["image_processing"]["manual_merge_threads"] = 4
+    minimal_global_cfg.product_index = {}
+    lyr = parse_ows_layer(minimal_layer_cfg, global_cfg=minimal_global_cfg)
+    assert lyr.manual_merge_threads == 4
     minimal_layer_cfg["image_processing"]["manual_merge"] = False
     minimal_layer_cfg["image_processing"]["apply_solar_corrections"] = True
     with pytest.raises(ConfigException) as excinfo:
@@ -457,6 +467,59 @@ def test_manual_merge(minimal_layer_cfg, minimal_global_cfg):
     assert "Solar correction requires manual_merge" in str(excinfo.value)
 
 
+def test_png_encoding(minimal_layer_cfg, minimal_global_cfg):
+    import zlib
+    lyr = parse_ows_layer(minimal_layer_cfg,
+                          global_cfg=minimal_global_cfg)
+    assert lyr.png_compress_level is None
+    assert lyr.png_compress_type is None
+    assert not lyr.png_palette
+    minimal_layer_cfg["png_encoding"] = {
+        "compress_level": 1,
+        "strategy": "rle",
+        "palette": True,
+    }
+    minimal_global_cfg.product_index = {}
+    lyr = parse_ows_layer(minimal_layer_cfg,
+                          global_cfg=minimal_global_cfg)
+    assert lyr.png_compress_level == 1
+    assert lyr.png_compress_type == zlib.Z_RLE
+    assert lyr.png_palette
+    minimal_layer_cfg["png_encoding"]["compress_level"] = 10
+    minimal_global_cfg.product_index = {}
+    with pytest.raises(ConfigException) as excinfo:
+        parse_ows_layer(minimal_layer_cfg, global_cfg=minimal_global_cfg)
+    assert "compress_level must be an integer from 0 to 9" in str(excinfo.value)
+    minimal_layer_cfg["png_encoding"]["compress_level"] = 9
+    minimal_layer_cfg["png_encoding"]["strategy"] = "lz4"
+    minimal_global_cfg.product_index = {}
+    with pytest.raises(ConfigException) as excinfo:
+        parse_ows_layer(minimal_layer_cfg, global_cfg=minimal_global_cfg)
+    assert "Invalid png_encoding strategy lz4" in str(excinfo.value)
+
+
+def test_render_precision(minimal_layer_cfg, minimal_global_cfg):
+    import numpy
+    lyr = parse_ows_layer(minimal_layer_cfg,
+                          global_cfg=minimal_global_cfg)
+    assert lyr.render_precision == numpy.float64
+    minimal_global_cfg.wms_render_precision = "float32"
+    minimal_global_cfg.product_index = {}
+    lyr = parse_ows_layer(minimal_layer_cfg,
+                          global_cfg=minimal_global_cfg)
+    assert lyr.render_precision == numpy.float32
+    minimal_layer_cfg["image_processing"]["render_precision"] = "float64"
+    minimal_global_cfg.product_index = {}
+    lyr = parse_ows_layer(minimal_layer_cfg,
+                          global_cfg=minimal_global_cfg)
+    assert lyr.render_precision == numpy.float64
+    minimal_layer_cfg["image_processing"]["render_precision"] = "float16"
+    minimal_global_cfg.product_index = {}
+    with pytest.raises(ConfigException) as excinfo:
+        parse_ows_layer(minimal_layer_cfg, global_cfg=minimal_global_cfg)
+    assert "Invalid render_precision float16" in str(excinfo.value)
+
+
 def test_bad_timeres(minimal_layer_cfg, minimal_global_cfg):
     minimal_layer_cfg["time_resolution"] = "prime_ministers"
     with pytest.raises(ConfigException) as excinfo:
@@ -273,6 +273,51 @@ def test_pbq_ctor_full(product_layer): # noqa: F811
     )
 
 
+def test_query_plan_memoises(monkeypatch):
+    from datacube_ows.data import QueryPlan
+    from datacube_ows.mv_index import MVSearchSummary
+    calls = []
+
+    def fake_summary(index, times=None, geom=None, products=None, with_extent=False, with_ids=True):
+        calls.append((with_extent, with_ids))
+        return MVSearchSummary(["id1", "id2"] if with_ids else None, 2,
+                               extent="ext" if with_extent else None, has_extent=with_extent)
+
+    monkeypatch.setattr(datacube_ows.data, "mv_search_summary", fake_summary)
+    lean_calls = []
+
+    def fake_lean_datasets(index, ids, products):
+        lean_calls.append(ids)
+        return []
+
+    monkeypatch.setattr(datacube_ows.data, "mv_lean_datasets", fake_lean_datasets)
+
+    class FakeProduct:
+        id = 3
+
+    index = MagicMock()
+    plan = QueryPlan()
+    times = [(datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 2))]
+    geom = geometry.box(140, -35, 141, -34, "EPSG:4326")
+    assert plan.summary(index, [FakeProduct()], times, geom, with_ids=False).count == 2
+    assert calls == [(False, False)]
+    assert plan.summary(index, [FakeProduct()], times, geom).ids == ["id1", "id2"]
+    assert plan.summary(index, [FakeProduct()], times, geom).count == 2
+    assert calls == [(False, False), (False, True)]
+    assert plan.summary(index, [FakeProduct()], times, geom, with_extent=True, with_ids=False).extent == "ext"
+    assert plan.summary(index, [FakeProduct()], times, geom).extent == "ext"
+    assert plan.summary(index, [FakeProduct()], times, geom).ids == ["id1", "id2"]
+    assert calls == [(False, False), (False, True), (True, False)]
+    plan.summary(index, [FakeProduct()], None, geom)
+    assert calls[-1] == (False, True)
+    with monkeypatch.context() as m:
+        m.setattr("datacube.Datacube.group_datasets", lambda dss, grpby: "grouped")
+        assert plan.datasets(index, [FakeProduct()], times, geom, None) == "grouped"
+        assert plan.datasets(index, [FakeProduct()], times, geom, None) == "grouped"
+    assert lean_calls == [["id1", "id2"]]
+    assert len(calls) == 4
+
+
 def test_user_date_sorter():
     layer = MagicMock()
     layer.time_resolution.is_subday.return_value = False
@@ -318,3 +363,142 @@ def test_create_nodata(dummy_raw_calc_data):
     with pytest.raises(WMSException) as e:
         data_out = ds.create_nodata_filled_flag_bands(Dataset(), pbq)
     assert "Cannot add default flag data as there is no non-flag data available" in str(e.value)
+
+
+@pytest.mark.parametrize("threads", [1, 3, 8])
+def test_read_datasets_in_order(threads):
+    import threading
+    import time
+
+    from datacube_ows.data import DataStacker
+    stacker = DataStacker.__new__(DataStacker)
+    stacker._product = MagicMock()
+    stacker._product.manual_merge_threads = threads
+    stacker._geobox = None
+    in_flight = []
+    max_in_flight = []
+    lock = threading.Lock()
+
+    def fake_read(ds, measurements, geobox, fuse_func=None):
+        with lock:
+            in_flight.append(ds)
+            max_in_flight.append(len(in_flight))
+        # Later datasets finish first
+        time.sleep(0.002 * (10 - ds))
+        with lock:
+            in_flight.remove(ds)
+        return f"data{ds}"
+
+    stacker.read_data_for_single_dataset = fake_read
+    results = list(stacker.read_datasets_in_order(list(range(10)), ["band"]))
+    assert results == [(i, f"data{i}") for i in range(10)]
+    assert max(max_in_flight) <= threads
+
+
+def test_mosaic_buffer():
+    from datacube_ows.data import MosaicBuffer
+
+    def read(red, flags):
+        return Dataset({
+            "red": (("time", "y", "x"), np.array([red], dtype="float32"), {"nodata": -999.0}),
+            "flags": (("time", "y", "x"), np.array([flags], dtype="uint8"), {"nodata": 0}),
+        }, coords={"time": [0], "y": [0, 1], "x": [0, 1]})
+
+    first = read([[1, np.nan], [-999, np.nan]], [[1, 0], [0, 2]])
+    second = read([[5, 6], [7, 8]], [[4, 4], [4, 4]])
+    third = read([[9, 9], [9, 9]], [[8, 8], [8, 8]])
+    mosaic = MosaicBuffer()
+    mosaic.add(first)
+    merged = mosaic.merged
+    mosaic.add(second, extent_mask=np.array([[[True, True], [True, False]]]))
+    mosaic.add(third)
+    # Filled in place
+    assert mosaic.merged is merged
+    assert mosaic.merged["red"].values.tolist() == [[[1, 6], [7, 9]]]
+    assert mosaic.merged["flags"].values.tolist() == [[[1, 4], [4, 2]]]
+    # Extent mask of the first read is applied to the output
+    mosaic = MosaicBuffer()
+    mosaic.add(second, extent_mask=second["red"] > 6)
+    mosaic.add(third)
+    assert mosaic.merged["red"].values.tolist() == [[[9, 9], [7, 8]]]
+
+
+def test_load_time_slices():
+    import xarray
+
+    from datacube_ows.data import _load_time_slices, _time_sliceable
+    times = [np.datetime64("2020-01-01"), np.datetime64("2020-02-01"), np.datetime64("2020-03-01")]
+    main = ProductBandQuery([MagicMock()], ["red"], main=True)
+    flags = ProductBandQuery([MagicMock()], ["pq"], ignore_time=True)
+    datasets = {
+        main: xarray.DataArray(np.array(["a", "b", "c"], dtype=object), coords={"time": times}, dims=["time"]),
+        flags: xarray.DataArray(np.array(["f"], dtype=object), coords={"time": times[:1]}, dims=["time"]),
+    }
+    assert _time_sliceable(datasets, 3)
+    assert not _time_sliceable(datasets, 2)
+    loaded = []
+
+    def fake_data(slice_datasets):
+        loaded.append({pbq: list(dss.values) for pbq, dss in slice_datasets.items()})
+        return Dataset({
+            "red": (("time", "y", "x"), np.ones((1, 2, 2))),
+        }, coords={"time": slice_datasets[main].time.values, "y": [0, 1], "x": [0, 1]})
+
+    stacker = MagicMock()
+    stacker.data = fake_data
+    stacker.merged_extent_mask = None
+    product = MagicMock()
+    product.data_manual_merge = False
+    product.extent_mask_func = []
+    style = MagicMock()
+    style.needed_bands = ["red"]
+    style.flag_bands = []
+    slices = _load_time_slices(stacker, datasets, [2, 0], product, style)
+    # Loaded lazily
+    assert not loaded
+    data, ext_mask = next(slices)
+    assert loaded == [{main: ["c"], flags: ["f"]}]
+    assert list(data.time.values) == [times[2]]
+    assert ext_mask.all()
+    assert len(list(slices)) == 1
+    assert loaded[1] == {main: ["a"], flags: ["f"]}
+
+
+def test_build_extent_mask():
+    from datacube_ows.data import _build_extent_mask
+    from datacube_ows.ogc_utils import mask_by_val
+    data = Dataset({
+        "red": (("time", "y", "x"), np.array([[[0, 1]], [[2, 0]]]), {"nodata": 0}),
+        "nir": (("time", "y", "x"), np.array([[[3, 3]], [[0, 3]]]), {"nodata": 0}),
+        "pq": (("time", "y", "x"), np.array([[[0, 0]], [[0, 0]]]), {"nodata": 0}),
+    }, coords={"time": [0, 1], "y": [0], "x": [0, 1]})
+    product = MagicMock()
+    product.data_manual_merge = False
+    product.extent_mask_func = [mask_by_val]
+    style = MagicMock()
+    style.needed_bands = ["red", "nir", "pq"]
+    style.flag_bands = ["pq"]
+    mask = _build_extent_mask(data, product, style)
+    assert mask.dims == ("time", "y", "x")
+    assert mask.values.tolist() == [[[False, True]], [[False, False]]]
+
+    merged = mask.copy()
+    assert _build_extent_mask(data, product, style, merged) is merged
+
+    style.needed_bands = ["pq"]
+    mask = _build_extent_mask(data, product, style)
+    assert mask.values.all()
+    assert mask.shape == data["pq"].shape
+
+
+def test_mosaic_buffer_valid():
+    from datacube_ows.data import MosaicBuffer
+    mosaic = MosaicBuffer()
+    mosaic.add(Dataset({
+        "red": (("y", "x"), np.array([[1.0, np.nan]])),
+        "nir": (("y", "x"), np.array([[np.nan, 2.0]])),
+        "pq": (("y", "x"), np.array([[1, 1]], dtype="uint8")),
+    }, coords={"y": [0], "x": [0, 1]}))
+    assert mosaic.valid(["red"]).values.tolist() == [[True, False]]
+    assert mosaic.valid(["red", "nir"]).values.tolist() == [[False, False]]
+    assert mosaic.valid([]) is None
@@ -0,0 +1,102 @@
+# This file is part of datacube-ows, part of the Open Data Cube project.
+# See https://opendatacube.org for more information.
+#
+# Copyright (c) 2017-2021 OWS Contributors
+# SPDX-License-Identifier: Apache-2.0
+from unittest.mock import MagicMock
+
+import lark
+import numpy as np
+import pytest
+import xarray as xr
+
+import datacube_ows.styles.expression
+from datacube_ows.styles.expression import Expression
+
+
+@pytest.fixture
+def style():
+    style = MagicMock()
+    style.user_defined = False
+    style.local_band = lambda b: {"ir": "nir"}.get(b, b)
+    return style
+
+
+def band_data(dtype):
+    rng = np.random.default_rng(42)
+    coords = {"y": [0.0, 1.0, 2.0], "x": [0.0, 1.0, 2.0, 3.0]}
+    return xr.Dataset({
+        band: xr.DataArray(rng.integers(1, 3000, size=(3, 4)).astype(dtype), dims=["y", "x"], coords=coords)
+        for band in ("red", "nir", "green")
+    })
+
+
+def evaluate_tree(expr, data):
+    return expr.eval_cls(data).transform(expr.tree)
+
+
+@pytest.mark.parametrize("dtype", ["int16", "uint16", "float32", "float64"])
+@pytest.mark.parametrize("expr_str", [
+    "(ir - red) / (ir + red)",
+    "red",
+    "-red + 2 * 3",
+    "(nir - red) * (nir - red) // 7 % 5",
+    "2.5 * (nir - red) / (nir + 6.0 * red - 7.5 * green + 1)",
+    "(green / 1000) ** 2",
+])
+def test_plan_matches_tree(style, dtype, expr_str):
+    data = band_data(dtype)
+    expr = Expression(style, expr_str)
+    assert expr.plan is not None
+    result = expr(data)
+    expected = evaluate_tree(expr, data)
+    assert result.dims == expected.dims
+    assert result.dtype == expected.dtype
+    np.testing.assert_allclose(result.values, expected.values, rtol=1e-6)
+
+
+def test_plan_scratch_reuse(style):
+    data = band_data("float32")
+    expr = Expression(style, "(nir - red) / (nir + red)")
+    # Inputs are never written to
+    before = data["red"].values.copy()
+    expr.plan.evaluate_steps({b: data[b].values for b in expr.plan.bands})
+    assert (data["red"].values == before).all()
+    # Literal-only sub-expressions are folded
+    expr = Expression(style, "red * (2 + 3)")
+    assert len(expr.plan.steps) == 1
+    assert expr.plan.steps[0].operands[1] == ("const", 5)
+
+
+def test_plan_unsupported(style):
+    data = band_data("int16")
+    style.user_defined = True
+    expr = Expression(style, "red ** 2")
+    assert expr.plan is None
+    # Evaluated with the expression tree, as before
+    with pytest.raises(lark.exceptions.VisitError) as e:
+        expr(data)
+    assert "Exponent operator not supported" in str(e.value)
+
+
+def test_plan_numexpr(style, monkeypatch):
+    class FakeNumexpr:
+        calls = 0
+
+        @classmethod
+        def evaluate(cls, expr_str, local_dict):
+            cls.calls += 1
+            return eval(expr_str, {}, local_dict).astype("float64")
+
+    monkeypatch.setattr(datacube_ows.styles.expression, "numexpr", FakeNumexpr)
+    expr = Expression(style, "(ir - red) / (ir + red)")
+    assert expr.plan.numexpr_str == "((b0 - b1) / (b0 + b1))"
+    data = band_data("float32")
+    result = expr(data)
+    assert FakeNumexpr.calls == 1
+    assert result.dtype == np.float32
+    # Integer data uses the numpy plan
+    expr(band_data("int16"))
+    assert FakeNumexpr.calls == 1
+    # Floor division is not supported by numexpr
+    assert Expression(style, "red // 2").plan.numexpr_str is None
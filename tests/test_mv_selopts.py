@@ -3,6 +3,8 @@
 #
 # Copyright (c) 2017-2021 OWS Contributors
 # SPDX-License-Identifier: Apache-2.0
+import pytest
+
 from datacube_ows.mv_index import MVSelectOpts
 
 
@@ -38,3 +40,224 @@ def test_count():
     sel = MVSelectOpts.COUNT.sel(stv)
     assert len(sel) == 1
     assert str(sel[0]) == "count(foo)"
+
+
+def test_select_summary_sql():
+    from datacube_ows.mv_index import mv_select, st_view
+
+    class FakeProduct:
+        id = 7
+
+    s = mv_select(MVSelectOpts.COUNT.sel(st_view), products=[FakeProduct()])
+    assert "count(space_time_view.id)" in str(s)
+    assert "space_time_view.dataset_type_ref IN" in str(s)
+
+
+class FakeConn:
+    def __init__(self, rows, calls):
+        self.rows = rows
+        self.calls = calls
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, s, *args):
+        self.calls.append(s)
+        return self.rows
+
+
+class FakeEngine:
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    def connect(self):
+        return FakeConn(self.rows, self.calls)
+
+
+class FakeProduct:
+    def __init__(self, id):
+        self.id = id
+
+
+def test_search_summary_count_only(monkeypatch):
+    import datacube_ows.mv_index
+    from datacube_ows.mv_index import mv_search_summary
+    engine = FakeEngine([(3,)])
+    monkeypatch.setattr(datacube_ows.mv_index, "get_sqlalc_engine", lambda idx: engine)
+    summ = mv_search_summary(None, products=[FakeProduct(1)], with_ids=False)
+    assert summ.count == 3
+    assert not summ.has_ids
+    assert "array_agg" not in str(engine.calls[0])
+    engine.rows = [(2, None, ["a", "b"])]
+    summ = mv_search_summary(None, products=[FakeProduct(1)], with_extent=True)
+    assert summ.count == 2
+    assert summ.ids == ["a", "b"]
+    assert summ.has_extent and summ.extent is None
+    assert "array_agg" in str(engine.calls[1])
+
+
+def test_search_cache_key():
+    from datacube.utils.geometry import box
+
+    from datacube_ows.mv_index import MVSearchCache
+    cache = MVSearchCache(max_entries=10, grid_size=1.0)
+    key1 = cache.key([FakeProduct(2), FakeProduct(1)], None, box(10.2, -5.5, 10.8, -5.1, "EPSG:4326"))
+    key2 = cache.key([FakeProduct(1), FakeProduct(2)], None, box(10.1, -5.9, 10.9, -5.2, "EPSG:4326"))
+    assert key1 == key2
+    assert key1[0] == (1, 2)
+    assert key1[2] == (10, -6, 11, -5)
+    key3 = cache.key([FakeProduct(1), FakeProduct(2)], None, box(10.1, -5.9, 11.1, -5.2, "EPSG:4326"))
+    assert key1 != key3
+    assert cache.applies_to(box(10.1, -5.9, 11.1, -5.2, "EPSG:4326"))
+    assert not cache.applies_to(box(10.1, -5.9, 15.1, -5.2, "EPSG:4326"))
+    assert not cache.applies_to(None)
+    assert not MVSearchCache(max_entries=0).applies_to(box(10.1, -5.9, 10.2, -5.8, "EPSG:4326"))
+
+
+def test_search_cache_filters_and_evicts(monkeypatch):
+    from datacube.utils.geometry import box
+
+    import datacube_ows.mv_index
+    from datacube_ows.mv_index import MVSearchCache
+    engine = FakeEngine([
+        ("a", '{"type": "Polygon", "coordinates": [[[0, 0], [0.4, 0], [0.4, 0.4], [0, 0.4], [0, 0]]]}'),
+        ("b", '{"type": "Polygon", "coordinates": [[[0.6, 0.6], [1, 0.6], [1, 1], [0.6, 1], [0.6, 0.6]]]}'),
+    ])
+    monkeypatch.setattr(datacube_ows.mv_index, "get_sqlalc_engine", lambda idx: engine)
+    cache = MVSearchCache(max_entries=1, grid_size=1.0)
+    prods = [FakeProduct(1)]
+    summ = cache.summary(None, prods, None, box(0.1, 0.1, 0.3, 0.3, "EPSG:4326"), with_extent=True)
+    assert summ.ids == ["a"]
+    assert summ.count == 1
+    assert summ.extent.area == pytest.approx(0.04)
+    summ = cache.summary(None, prods, None, box(0.5, 0.5, 0.9, 0.9, "EPSG:4326"))
+    assert summ.ids == ["b"]
+    assert summ.extent is None
+    assert len(engine.calls) == 1
+    assert cache.hits == 1
+    assert cache.misses == 1
+    # Different grid cell evicts the first entry
+    cache.summary(None, prods, None, box(1.1, 1.1, 1.3, 1.3, "EPSG:4326"))
+    assert len(cache) == 1
+    cache.summary(None, prods, None, box(0.1, 0.1, 0.3, 0.3, "EPSG:4326"))
+    assert len(engine.calls) == 3
+
+
+def test_search_cache_expiry_and_invalidation(monkeypatch):
+    from datacube.utils.geometry import box
+
+    import datacube_ows.mv_index
+    from datacube_ows.mv_index import MVSearchCache
+    engine = FakeEngine([])
+    monkeypatch.setattr(datacube_ows.mv_index, "get_sqlalc_engine", lambda idx: engine)
+    cache = MVSearchCache(max_entries=10, max_age=60, grid_size=1.0)
+    geom = box(0.1, 0.1, 0.3, 0.3, "EPSG:4326")
+    cache.summary(None, [FakeProduct(1)], None, geom)
+    cache.summary(None, [FakeProduct(2)], None, geom)
+    assert len(cache) == 2
+    cache.clear([1])
+    assert len(cache) == 1
+    cache.summary(None, [FakeProduct(2)], None, geom)
+    assert len(engine.calls) == 2
+    now = datacube_ows.mv_index.monotonic()
+    monkeypatch.setattr(datacube_ows.mv_index, "monotonic", lambda: now + 120)
+    cache.summary(None, [FakeProduct(2)], None, geom)
+    assert len(engine.calls) == 3
+    cache.clear()
+    assert len(cache) == 0
+
+
+class FakeMetadataType:
+    definition = {
+        "dataset": {
+            "id": ["id"],
+            "sources": ["lineage", "source_datasets"],
+            "measurements": ["measurements"],
+            "grid_spatial": ["grid_spatial", "projection"],
+            "format": ["properties", "odc:file_format"],
+            "search_fields": {
+                "platform": {"offset": ["properties", "eo:platform"]},
+                "time": {
+                    "min_offset": [["properties", "dtr:start_datetime"]],
+                    "max_offset": [["properties", "dtr:end_datetime"]],
+                },
+                "lat": {
+                    "min_offset": [["extent", "lat", "begin"]],
+                    "max_offset": [["extent", "lat", "end"]],
+                },
+                "sat_path": {"min_offset": [["image", "satellite_ref_point_start", "x"]]},
+            }
+        }
+    }
+
+
+def test_lean_dataset_keys():
+    from datacube_ows.mv_index import lean_dataset_keys
+    prod = FakeProduct(3)
+    prod.metadata_type = FakeMetadataType()
+    keys = lean_dataset_keys([prod])
+    assert "lineage" not in keys
+    for key in ("id", "measurements", "grid_spatial", "properties", "extent", "image", "crs"):
+        assert key in keys
+    assert keys == sorted(keys)
+
+
+def test_lean_datasets_from_rows():
+    from unittest.mock import MagicMock
+
+    from datacube.model import Product
+
+    from datacube_ows.mv_index import lean_datasets_from_rows
+    prod = MagicMock(spec=Product)
+    prod.id = 3
+    rows = [
+        ("ds1", 3, ["s3://bucket/ds1.json", "file:///ds1.json"], "ds1", {"blue": {"path": "blue.tif"}}, None),
+        ("ds2", 3, None, "ds2", {"blue": {"path": "blue.tif"}}, {"datetime": "2020-01-01T00:00:00Z"}),
+    ]
+    dss = lean_datasets_from_rows(rows, ["id", "measurements", "properties"], [prod])
+    assert len(dss) == 2
+    assert dss[0].product is prod
+    assert dss[0].uris == ["s3://bucket/ds1.json", "file:///ds1.json"]
+    assert dss[0].metadata_doc == {"id": "ds1", "measurements": {"blue": {"path": "blue.tif"}}}
+    assert dss[1].uris == []
+    assert dss[1].metadata_doc["properties"]["datetime"] == "2020-01-01T00:00:00Z"
+
+
+def test_footprint_level():
+    from datacube.utils.geometry import box
+
+    from datacube_ows.mv_index import footprint_level
+    assert footprint_level(box(100, -40, 160, -10, "EPSG:4326"), 256, 256) == 3
+    assert footprint_level(box(140, -40, 141, -39, "EPSG:4326"), 256, 256) == 1
+    assert footprint_level(box(140, -40, 140.01, -39.99, "EPSG:4326"), 256, 256) == 0
+
+
+def test_footprint_extent(monkeypatch):
+    from datacube.utils.geometry import box
+
+    import datacube_ows.mv_index
+    from datacube_ows.mv_index import FOOTPRINT_ALL_DATES, mv_footprint_extent
+    fp1 = '{"type": "Polygon", "coordinates": [[[0, 0], [0.4, 0], [0.4, 0.4], [0, 0.4], [0, 0]]]}'
+    fp2 = '{"type": "Polygon", "coordinates": [[[0.6, 0.6], [1, 0.6], [1, 1], [0.6, 1], [0.6, 0.6]]]}'
+    engine = FakeEngine([
+        (1, FOOTPRINT_ALL_DATES, fp1),
+        (1, "2020-01-01", fp1),
+        (1, "2020-01-02", None),
+        (2, FOOTPRINT_ALL_DATES, fp2),
+        (2, "2020-01-01", fp2),
+    ])
+    monkeypatch.setattr(datacube_ows.mv_index, "get_sqlalc_engine", lambda idx: engine)
+    geom = box(0, 0, 1, 1, "EPSG:4326")
+    found, extent = mv_footprint_extent(None, [FakeProduct(1), FakeProduct(2)], ["2020-01-01"], geom)
+    assert found
+    assert extent.area == pytest.approx(0.32)
+    found, extent = mv_footprint_extent(None, [FakeProduct(1), FakeProduct(2)], ["2020-01-02"], geom)
+    assert found
+    assert extent is None
+    # No footprints for product 3
+    found, extent = mv_footprint_extent(None, [FakeProduct(1), FakeProduct(3)], ["2020-01-01"], geom)
+    assert not found
@@ -4,8 +4,10 @@
 # Copyright (c) 2017-2021 OWS Contributors
 # SPDX-License-Identifier: Apache-2.0
 import datetime
+import zlib
 from unittest.mock import MagicMock
 
+import numpy
 import pytest
 import xarray
 from datacube.utils import geometry
@@ -334,6 +336,59 @@ def test_render_frame():
     assert png.shape == (2, 5, 4)
 
 
+def test_rgba_buffer():
+    data = xarray.Dataset({
+        "red": dummy_da(100, "red", xy_coords, dtype="uint8"),
+        "green": dummy_da(70, "green", xy_coords, dtype="uint8"),
+        "blue": dummy_da(150, "blue", xy_coords, dtype="uint8"),
+        "alpha": dummy_da(200, "alpha", xy_coords, dtype="uint8"),
+    })
+    assert datacube_ows.ogc_utils.rgba_buffer(data) is None
+    buffer = numpy.zeros((2, 5, 4), dtype="uint8")
+    buffer[..., 0] = 100
+    buffer[..., 3] = 200
+    data = xarray.Dataset({
+        band: (("y", "x"), buffer[..., i])
+        for i, band in enumerate(("red", "green", "blue", "alpha"))
+    }, coords={"x": [-1.0, -0.5, 0.0, 0.5, 1.0], "y": [-1.0, -0.5]})
+    found = datacube_ows.ogc_utils.rgba_buffer(data)
+    assert found.shape == (2, 5, 4)
+    assert numpy.shares_memory(found, buffer)
+    png = datacube_ows.ogc_utils.xarray_image_as_png(data)
+    assert png.find(b"\x89PNG") == 0
+    # Channels out of order
+    data = data.rename({"red": "blue", "blue": "red"})
+    assert datacube_ows.ogc_utils.rgba_buffer(data) is None
+
+
+def test_png_palette():
+    from io import BytesIO
+
+    from PIL import Image
+    buffer = numpy.zeros((2, 5, 4), dtype="uint8")
+    buffer[0, :] = [255, 0, 0, 255]
+    buffer[1, :2] = [0, 0, 255, 128]
+    # Transparent, but not black
+    buffer[1, 2:] = [10, 20, 30, 0]
+    data = xarray.Dataset({
+        band: (("y", "x"), buffer[..., i])
+        for i, band in enumerate(("red", "green", "blue", "alpha"))
+    }, coords={"x": [-1.0, -0.5, 0.0, 0.5, 1.0], "y": [-1.0, -0.5]})
+    palette = [(0, 0, 255, 128), (255, 0, 0, 255), (0, 255, 0, 0)]
+    png = datacube_ows.ogc_utils.xarray_image_as_png(data, palette=palette, compress_level=9)
+    img = Image.open(BytesIO(png))
+    assert img.mode == "P"
+    rgba = numpy.asarray(img.convert("RGBA"))
+    assert (rgba[0] == [255, 0, 0, 255]).all()
+    assert (rgba[1, :2] == [0, 0, 255, 128]).all()
+    assert (rgba[1, 2:, 3] == 0).all()
+    # Colours not in the palette - RGBA image
+    png = datacube_ows.ogc_utils.xarray_image_as_png(data, palette=palette[1:], compress_type=zlib.Z_RLE)
+    img = Image.open(BytesIO(png))
+    assert img.mode == "RGBA"
+    assert (numpy.asarray(img) == buffer).all()
+
+
 def test_time_call(monkeypatch):
     class FakeLogger:
         _instance = None
@@ -0,0 +1,71 @@
+# This file is part of datacube-ows, part of the Open Data Cube project.
+# See https://opendatacube.org for more information.
+#
+# Copyright (c) 2017-2021 OWS Contributors
+# SPDX-License-Identifier: Apache-2.0
+import datetime
+from unittest.mock import MagicMock
+
+import numpy
+import pytest
+import pytz
+import xarray
+from affine import Affine
+from datacube.utils import geometry
+
+from datacube_ows.solar_correction import (SolarZenithGrid, block_centres,
+                                           cosine_of_solar_zenith)
+
+UTC_DT = datetime.datetime(2020, 3, 1, 1, 30, tzinfo=pytz.utc)
+
+
+@pytest.fixture
+def geobox():
+    return geometry.GeoBox(100, 70, Affine(25.0, 0.0, 1500000.0, 0.0, -25.0, -3900000.0),
+                           geometry.CRS("EPSG:3577"))
+
+
+def test_cosine_of_solar_zenith():
+    lats = numpy.array([-35.0, 0.0, 35.0])
+    lons = numpy.array([149.0, 149.0, 149.0])
+    grid = cosine_of_solar_zenith(lats, lons, UTC_DT)
+    for lat, lon, csz in zip(lats, lons, grid):
+        assert cosine_of_solar_zenith(float(lat), float(lon), UTC_DT) == pytest.approx(csz)
+
+
+def test_block_centres():
+    assert list(block_centres(70, 32)) == [16.0, 48.0, 67.0]
+
+
+def test_solar_grid_cosine(geobox):
+    grid = SolarZenithGrid(geobox)
+    csz = grid.cosine(UTC_DT)
+    assert csz.shape == (70, 100)
+    assert csz.dtype == numpy.float32
+    # Blocks share a single value
+    assert csz[0, 0] == csz[31, 31]
+    assert csz[0, 0] != csz[0, 32]
+    x, y = 1500000.0 + 16 * 25.0, -3900000.0 - 16 * 25.0
+    lon, lat = geobox.crs.transformer_to_crs(geometry.CRS("EPSG:4326"))(x, y)
+    assert csz[0, 0] == pytest.approx(cosine_of_solar_zenith(lat, lon, UTC_DT), rel=1e-6)
+
+
+def test_solar_grid_correct(geobox):
+    grid = SolarZenithGrid(geobox)
+    red = numpy.full((1, 70, 100), 1000.0, dtype="float32")
+    red[0, 0, 0] = -999.0
+    data = xarray.Dataset({
+        "red": (("time", "y", "x"), red, {"nodata": -999.0}),
+        "green": (("time", "y", "x"), numpy.full((1, 70, 100), 1000, dtype="int16"), {"nodata": -999}),
+    })
+    dataset = MagicMock()
+    dataset.center_time = UTC_DT
+    grid.correct(data, dataset, ["red", "green"])
+    csz = grid.cosine(UTC_DT)
+    # Corrected in place
+    assert data["red"].values is red
+    assert data["green"].dtype == numpy.float32
+    assert data["green"].attrs["nodata"] == -999
+    assert data["red"].values[0, 0, 0] == -999.0
+    assert data["red"].values[0, 1, 1] == pytest.approx(1000.0 / csz[1, 1])
+    assert numpy.allclose(data["green"].values[0], 1000.0 / csz)
@@ -115,6 +115,13 @@ def test_prometheus_inactive(monkeypatch):
     initialise_prometheus(None)
 
 
+def test_search_cache_metrics_inactive(monkeypatch):
+    monkeypatch.setenv("prometheus_multiproc_dir", "")
+    from datacube_ows.startup_utils import (initialise_prometheus,
+                                            initialise_search_cache_metrics)
+    assert initialise_search_cache_metrics(initialise_prometheus(None)) is None
+
+
 def test_supported_version():
     from datacube_ows.protocol_versions import SupportedSvcVersion
     ver = SupportedSvcVersion("wts", "1.2.3", "a", "b")
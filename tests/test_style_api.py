@@ -5,7 +5,9 @@
 # SPDX-License-Identifier: Apache-2.0
 from decimal import Decimal
 
+import numpy
 import pytest
+import xarray as xr
 
 from datacube_ows.ogc_utils import ConfigException
 
@@ -74,6 +76,26 @@ def test_perband_component_style(dummy_raw_data, null_mask, simple_rgb_perband_s
         assert channel in result.data_vars.keys()
 
 
+@pytest.mark.parametrize("dtype", ["uint8", "uint16", "int16"])
+def test_component_style_lookup_table(simple_rgb_perband_scaling_style_cfg, dtype):
+    simple_rgb_perband_scaling_style_cfg["components"]["blue"] = {"blue": 0.7}
+    style = StandaloneStyle(simple_rgb_perband_scaling_style_cfg)
+    assert set(style.lut_channels) == {"red", "green", "blue"}
+    info = numpy.iinfo(dtype)
+    values = numpy.linspace(info.min, info.max, 600).astype(dtype).reshape(20, 30)
+    data = xr.Dataset({
+        band: (("y", "x"), numpy.roll(values, i))
+        for i, band in enumerate(("red", "green", "blue"))
+    })
+    result = style.transform_single_date_data(data)
+    expected = style.transform_single_date_data(data.astype("float64"))
+    for channel in ("red", "green", "blue"):
+        assert result[channel].dtype == numpy.uint8
+        assert (result[channel].values == expected[channel].values).all()
+    style.product.render_precision = numpy.dtype("float32")
+    assert style.prepare_render_data(data)["red"].dtype == numpy.dtype(dtype)
+
+
 def test_external_legends(simple_rgb_style_cfg):
     simple_rgb_style_cfg["legend"] = {
         "url": "http://fake.com/not/a/real/image_url.png"
@@ -161,6 +183,27 @@ def test_ramp_style(dummy_raw_calc_data, raw_calc_null_mask, simple_ramp_style_c
     assert result["red"].values[5] > 0
     assert result["red"].values[5] < 255
 
+def test_float32_render_precision(dummy_raw_calc_data, raw_calc_null_mask,
+                                  simple_ramp_style_cfg, simple_rgb_style_cfg, dummy_raw_data, null_mask):
+    for cfg, data, mask in (
+        (simple_ramp_style_cfg, dummy_raw_calc_data, raw_calc_null_mask),
+        (simple_rgb_style_cfg, dummy_raw_data, null_mask),
+    ):
+        style = StandaloneStyle(cfg)
+        expected = apply_ows_style(style, data, valid_data_mask=mask)
+        style.product.render_precision = numpy.dtype("float32")
+        prepared = style.prepare_render_data(data)
+        for band in prepared.data_vars:
+            if "flags_definition" in data[band].attrs:
+                assert prepared[band].dtype == data[band].dtype
+            else:
+                assert prepared[band].dtype == numpy.float32
+        result = apply_ows_style(style, data, valid_data_mask=mask)
+        for channel in ("red", "green", "blue", "alpha"):
+            assert result[channel].dtype == numpy.uint8
+            assert numpy.abs(result[channel].values.astype("int") - expected[channel].values.astype("int")).max() <= 1
+
+
 def test_ramp_expr_style(dummy_raw_calc_data, raw_calc_null_mask, simple_ramp_style_cfg):
     del simple_ramp_style_cfg["index_function"]
     del simple_ramp_style_cfg["needed_bands"]
@@ -749,6 +792,72 @@ def test_enum_colormap_style(dummy_col_map_data, raw_calc_null_mask, enum_colorm
     assert result["green"].values[5] == 0
     assert result["blue"].values[5] == 255
 
+@pytest.mark.parametrize("dtype", ["uint8", "int16", "int64", "float64"])
+def test_colormap_lookup_table(dummy_col_map_data, simple_colormap_style_cfg, enum_colormap_style_cfg, dtype):
+    from datacube_ows.styles.colormap import apply_value_map, value_map_lut_key
+    for cfg in (simple_colormap_style_cfg, enum_colormap_style_cfg):
+        style = StandaloneStyle(cfg)
+        data = dummy_col_map_data.copy()
+        data["pq"] = data["pq"].astype(dtype)
+        data["pq"].attrs = dummy_col_map_data["pq"].attrs
+        luts = {}
+        compiled = apply_value_map(style.value_map, data, style.local_band, luts)
+        looped = apply_value_map(style.value_map, data, style.local_band)
+        for channel in ("red", "green", "blue", "alpha"):
+            assert (compiled[channel].values == looped[channel].values).all()
+        # Float data is converted to int64 and looked up
+        key = value_map_lut_key("pq", numpy.dtype("int64" if dtype == "float64" else dtype),
+                                data["pq"].attrs["flags_definition"])
+        assert luts[key] is not None
+
+
+def test_colormap_png_palette(enum_colormap_style_cfg):
+    style = StandaloneStyle(enum_colormap_style_cfg)
+    palette = style.png_palette()
+    assert (255, 0, 0, 255) in palette
+    assert len(palette) == len(set(palette))
+
+
+def test_colormap_lookup_table_fallback(dummy_col_map_data, enum_colormap_style_cfg):
+    from datacube_ows.styles.colormap import ValueMapLUT, apply_value_map
+    style = StandaloneStyle(enum_colormap_style_cfg)
+    data = dummy_col_map_data.copy()
+    data["pq"] = data["pq"] + 70000
+    rules = style.value_map["pq"]
+    lut = ValueMapLUT.compile(rules, data["pq"].dtype, data["pq"].attrs["flags_definition"])
+    # Outside the range of the lookup table
+    assert lut.lookup(data["pq"]) is None
+    luts = {}
+    result = apply_value_map(style.value_map, data, style.local_band, luts)
+    assert (result["alpha"].values == 0).all()
+    assert ValueMapLUT.compile(rules, numpy.dtype("float32")) is None
+
+
+def test_colormap_lookup_table_flags_definition(dummy_col_map_data, simple_colormap_style_cfg):
+    from datacube_ows.styles.colormap import value_map_lut
+    style = StandaloneStyle(simple_colormap_style_cfg)
+    rules = style.value_map["pq"]
+    dtype = dummy_col_map_data["pq"].dtype
+    flags_def = dummy_col_map_data["pq"].attrs["flags_definition"]
+    luts = {}
+    # No flags definition: not compiled, and not cached.
+    assert value_map_lut(luts, "pq", rules, dtype, None) is None
+    assert not luts
+    lut = value_map_lut(luts, "pq", rules, dtype, flags_def)
+    assert lut is not None
+    # Equal definitions share a table, different definitions do not.
+    assert value_map_lut(luts, "pq", rules, dtype, dict(flags_def)) is lut
+    other_def = {
+        flag: dict(defn, bits=(defn["bits"] + 1) % 8) if isinstance(defn["bits"], int) else defn
+        for flag, defn in flags_def.items()
+    }
+    other = value_map_lut(luts, "pq", rules, dtype, other_def)
+    assert other is not None
+    assert other is not lut
+    assert len(luts) == 2
+    assert not (other.rgba == lut.rgba).all()
+
+
 def test_enum_colormap_multidate(dummy_col_map_time_data, timed_raw_calc_null_mask, enum_colormap_style_cfg):
     result = apply_ows_style_cfg(enum_colormap_style_cfg,
                                  dummy_col_map_time_data,
@@ -781,6 +890,21 @@ def test_enum_colormap_multidate(dummy_col_map_time_data, timed_raw_calc_null_ma
     assert result["alpha"].values[5] == 0
 
 
+def test_multidate_value_map_rule_masks(dummy_col_map_time_data, enum_colormap_style_cfg):
+    style = StandaloneStyle(enum_colormap_style_cfg)
+    rules = style.get_multi_date_handler(2).value_map["pq"]
+    pq = dummy_col_map_time_data["pq"]
+    # Rock and Roll: any value on date 1, 14/19/27 on date 2
+    rnr = rules[0].create_mask(pq)
+    assert "time" not in rnr.dims
+    assert rnr.dims == tuple(d for d in pq.dims if d != "time")
+    assert rnr.values.tolist() == [False, False, False, True, True, False]
+    # Blah Blah: 8/25 on date 1, 17/30/31 on date 2
+    assert rules[1].create_mask(pq).values.tolist() == [True, True, False, False, False, False]
+    # Foo Blah: not 10 on date 1 (inverted), any value on date 2
+    assert rules[2].create_mask(pq).values.tolist() == [True, True, False, True, True, True]
+
+
 @pytest.fixture
 def enum_animated_value_map():
     return {
@@ -1022,6 +1146,44 @@ def test_loopover(xyt_dummydata, multi_date_cfg):
     assert len(image.time) == len(xyt_dummydata.time)
 
 
+def test_multidate_time_sliced(xyt_dummydata, multi_date_cfg):
+    style = StandaloneStyle(multi_date_cfg)
+    mdh = style.get_multi_date_handler(2)
+    assert mdh.time_sliced
+    assert not mdh.per_time_slice
+    expected = style.transform_data(xyt_dummydata, None)
+    slices = (
+        (xyt_dummydata.isel(time=[i]), None)
+        for i in range(len(xyt_dummydata.time))
+    )
+    images = list(mdh.transform_time_slices(slices))
+    assert len(images) == 1
+    for band in ("red", "green", "blue", "alpha"):
+        assert (images[0][band].values == expected[band].values).all()
+
+
+def test_multidate_time_sliced_animation(xyt_dummydata, multi_date_cfg):
+    multi_date_cfg["multi_date"][0] = {
+        "allowed_count_range": [2, 2],
+        "animate": True,
+    }
+    style = StandaloneStyle(multi_date_cfg)
+    mdh = style.get_multi_date_handler(2)
+    assert mdh.time_sliced
+    assert mdh.per_time_slice
+    expected = style.transform_data(xyt_dummydata, None)
+    slices = (
+        (xyt_dummydata.isel(time=[i]), None)
+        for i in range(len(xyt_dummydata.time))
+    )
+    frames = list(mdh.transform_time_slices(slices))
+    assert len(frames) == len(xyt_dummydata.time)
+    for frame, dt in zip(frames, xyt_dummydata.time.values):
+        assert "time" not in frame.dims
+        for band in ("red", "green", "blue", "alpha"):
+            assert (frame[band].values == expected[band].sel(time=dt).values).all()
+
+
 def test_plot_image(dummy_raw_data, simple_rgb_style_cfg):
     image = apply_ows_style_cfg(simple_rgb_style_cfg, dummy_raw_data)
     plot_image(image)
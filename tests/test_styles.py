@@ -502,14 +502,42 @@ def test_correct_style_map(product_layer, style_cfg_map):
     assert isinstance(style_def, datacube_ows.styles.colormap.ColorMapStyleDef)
 
 
+def test_style_map_precompiled(product_layer, style_cfg_map, minimal_dc):
+    from datacube.model import Measurement
+    product_layer.band_idx.measurements = {
+        "red": Measurement(name="red", dtype="uint16", nodata=0, units="1",
+                           flags_definition={
+                               "bar": {"bits": 0, "values": {"0": False, "1": True}},
+                               "baz": {"bits": 1, "values": {"0": False, "1": True}},
+                               "x": {"bits": 2, "values": {"0": False, "1": True}},
+                               "y": {"bits": 3, "values": {"0": False, "1": True}},
+                           }),
+    }
+    style_def = datacube_ows.styles.StyleDef(product_layer, style_cfg_map)
+    style_def.make_ready(minimal_dc)
+    from datacube_ows.styles.colormap import value_map_lut_key
+    lut = style_def.value_map_luts[value_map_lut_key("red", np.dtype("uint16"),
+                                                     product_layer.band_idx.measurements["red"].flags_definition)]
+    assert lut.size == 65536
+    # bar and not baz: black, opaque
+    assert list(lut.rgba[0b0001]) == [0, 0, 0, 255]
+    # x or y: white
+    assert list(lut.rgba[0b0100]) == [255, 255, 255, 255]
+    assert list(lut.rgba[0b1010]) == [255, 255, 255, 255]
+    # First rule has priority
+    assert list(lut.rgba[0b0101]) == [0, 0, 0, 255]
+    assert not lut.matched[0b0010]
+
+
 def test_alpha_style_map(
     product_layer_alpha_map,
     style_cfg_map_alpha_1,
     style_cfg_map_alpha_2,
     style_cfg_map_alpha_3):
 
-    def fake_make_mask(data, **kwargs):
-        return data
+    def fake_create_mask_value(bits_def, **flags):
+        # Every flag matches bit 0 set - i.e. True
+        return 1, 1
 
 
     band = np.array([True, True, True])
@@ -527,7 +555,7 @@ def test_alpha_style_map(
     npmap = np.array([True, True, True])
     damap = DataArray(npmap)
 
-    with patch('datacube_ows.config_utils.make_mask', new_callable=lambda: fake_make_mask) as fmm:
+    with patch('datacube_ows.config_utils.create_mask_value', new_callable=lambda: fake_create_mask_value) as fmm:
         style_def = datacube_ows.styles.StyleDef(product_layer_alpha_map, style_cfg_map_alpha_1)
 
         result = style_def.transform_data(ds, damap)
@@ -679,38 +707,37 @@ def style_cfg_map_mask():
 
 
 def test_RGBAMapped_Masking(product_layer_mask_map, style_cfg_map_mask):
-    def fake_make_mask(data, **kwargs):
-        val = kwargs["bar"]
-        return data == val
-
-
     dim = np.array([0, 1, 2, 3, 4, 5])
     band = np.array([0, 0, 1, 1, 2, 2])
     timarray = [np.datetime64(datetime.date.today())]
     times = DataArray(timarray, coords=[timarray], dims=["time"], name="time")
-    da = DataArray(band, name='foo', coords={"dim": dim}, dims=["dim"])
+    da = DataArray(band, name='foo', coords={"dim": dim}, dims=["dim"],
+                   attrs={
+                       "flags_definition": {
+                           "bar": {"bits": [0, 1], "values": {"0": 0, "1": 1, "2": 2}},
+                       }
+                   })
     dst = Dataset(data_vars={'foo': da})
     ds = concat([dst], times)
 
     npmap = np.array([True, True, True, True, True, True])
     damap = DataArray(npmap, coords={"dim": dim}, dims=["dim"])
 
-    with patch('datacube_ows.config_utils.make_mask', new_callable=lambda: fake_make_mask) as fmm:
-        style_def = datacube_ows.styles.StyleDef(product_layer_mask_map, style_cfg_map_mask)
-        data = style_def.transform_data(ds, damap)
-        r = data["red"]
-        g = data["green"]
-        b = data["blue"]
-        a = data["alpha"]
+    style_def = datacube_ows.styles.StyleDef(product_layer_mask_map, style_cfg_map_mask)
+    data = style_def.transform_data(ds, damap)
+    r = data["red"]
+    g = data["green"]
+    b = data["blue"]
+    a = data["alpha"]
 
-        assert (r.values[2] == 17)
-        assert (g.values[2] == 17)
-        assert (b.values[2] == 17)
-        assert (a.values[2] == 0)
-        assert (r.values[4] == 255)
-        assert (g.values[4] == 255)
-        assert (b.values[4] == 255)
-        assert (a.values[4] == 255)
+    assert (r.values[2] == 17)
+    assert (g.values[2] == 17)
+    assert (b.values[2] == 17)
+    assert (a.values[2] == 0)
+    assert (r.values[4] == 255)
+    assert (g.values[4] == 255)
+    assert (b.values[4] == 255)
+    assert (a.values[4] == 255)
 
 
 def test_reint():
@@ -835,10 +862,6 @@ def style_with_pq_masking():
     return cfg
 
 def test_style_with_pq_masks(product_layer, style_with_pq_masking, minimal_dc):
-    def fake_make_mask(data, **kwargs):
-        val = kwargs["bar"]
-        return data == val
-
     dim = np.array([0, 1, 2, 3, 4, 5])
     band = np.array([0, 1, 2, 3, 4, 5])
     timarray = [np.datetime64(datetime.date.today())]
@@ -855,15 +878,61 @@ def test_style_with_pq_masks(product_layer, style_with_pq_masking, minimal_dc):
     npmap = np.array([True, True, True, True, True, True])
     damap = DataArray(npmap, coords={"dim": dim}, dims=["dim"])
 
-    with patch('datacube_ows.config_utils.make_mask', new_callable=lambda: fake_make_mask) as fmm:
-        style_def = datacube_ows.styles.StyleDef(product_layer, style_with_pq_masking)
+    style_def = datacube_ows.styles.StyleDef(product_layer, style_with_pq_masking)
+    style_def.make_ready(minimal_dc)
+    mask = style_def.to_mask(ds, damap)
+    data = style_def.transform_data(ds, mask)
+    a = data["alpha"]
+
+    assert (a.values[2] == 255)
+    assert (a.values[4] == 0)
+
+def test_style_pq_masks_compiled(product_layer, style_with_pq_masking, minimal_dc):
+    from datacube_ows.config_utils import FlagMaskCache
+    product_layer.flag_bands["pq"].flags_def = {
+        "cloud": {"bits": 0, "values": {"0": False, "1": True}},
+        "shadow": {"bits": 1, "values": {"0": False, "1": True}},
+        "water": {"bits": [2, 3], "values": {"0": "dry", "1": "wet", "2": "flooded"}},
+    }
+    style_with_pq_masking["pq_masks"] = [
+        {"band": "pq", "flags": {"cloud": False, "shadow": False}},
+        {"band": "pq", "flags": {"or": {"water": "wet", "shadow": True}}},
+    ]
+    style_def = datacube_ows.styles.StyleDef(product_layer, style_with_pq_masking)
+    style_def.make_ready(minimal_dc)
+    assert style_def.masks[0].bit_tests == [(0b0011, 0b0000)]
+    assert style_def.masks[1].bit_tests == [(0b1100, 0b0100), (0b0010, 0b0010)]
+
+    vals = np.arange(16)
+    ds = Dataset({"pq": DataArray(vals, coords={"dim": vals}, dims=["dim"])})
+    mask = style_def.to_mask(ds)
+    # No cloud or shadow, and wet.
+    assert mask.values.tolist() == [(v & 0b0011) == 0 and (v & 0b1100) == 0b0100 for v in vals]
+
+    # The shadow test is shared by both masks.
+    cache = FlagMaskCache()
+    raw = ds["pq"].values
+    shared = cache.bit_test(raw, 0b0010, 0b0010)
+    assert cache.bit_test(raw, 0b0010, 0b0010) is shared
+    assert cache.bit_test(raw.copy(), 0b0010, 0b0010) is not shared
+
+    # Data with a different flags_definition does not replace the compiled tests.
+    other_def = {
+        "cloud": {"bits": 4, "values": {"0": False, "1": True}},
+        "shadow": {"bits": 5, "values": {"0": False, "1": True}},
+    }
+    other = DataArray(np.arange(64), dims=["dim"], attrs={"flags_definition": other_def})
+    rule = style_def.masks[0]
+    assert rule.evaluate(other).tolist() == [(v & 0b110000) == 0 for v in range(64)]
+    assert rule.bit_tests == [(0b0011, 0b0000)]
+    assert rule.data_bit_tests(other) is rule.data_bit_tests(other)
+
+    style_with_pq_masking["pq_masks"] = [{"band": "pq", "flags": {"snow": True}}]
+    style_def = datacube_ows.styles.StyleDef(product_layer, style_with_pq_masking)
+    with pytest.raises(ConfigException) as e:
         style_def.make_ready(minimal_dc)
-        mask = style_def.to_mask(ds, damap)
-        data = style_def.transform_data(ds, mask)
-        a = data["alpha"]
+    assert "does not match the band's flags_definition" in str(e.value)
 
-        assert (a.values[2] == 255)
-        assert (a.values[4] == 0)
 
 def test_styles_with_invalid_pq_masks(product_layer, style_with_pq_masking):
     style_with_pq_masking["pq_masks"][0]["band"] = "invalid_band"
@@ -875,3 +944,21 @@ def test_styles_with_invalid_pq_masks(product_layer, style_with_pq_masking):
     with pytest.raises(ConfigException) as e:
         style_def = datacube_ows.styles.StyleDef(product_layer, style_with_pq_masking)
     assert "contains a mask, but the layer has no flag bands" in str(e.value)
+
+
+def test_color_ramp_lut():
+    from datacube_ows.styles.ramp import ColorRamp
+    legend = datacube_ows.styles.ramp.ColorRampDef.Legend(MagicMock(), {})
+    ramp = ColorRamp(MagicMock(), {"range": [0.0, 1.0]}, legend)
+    vals = np.concatenate([np.linspace(-0.5, 1.5, 1001), ramp.values, [np.nan]])
+    data = DataArray(vals.reshape(1, -1), dims=["y", "x"])
+    result = ramp.apply(data)
+    for band in ("red", "green", "blue", "alpha"):
+        expected = ramp.get_8bit_value(vals[:-1], band)
+        diff = np.abs(result[band].values[0, :-1].astype("int") - expected.astype("int"))
+        assert diff.max() <= 1
+        # Ramp values map to an exact table entry.
+        assert (diff[-len(ramp.values):] == 0).all()
+        # NaN is transparent black
+        assert result[band].values[0, -1] == 0
+    assert result["red"].values.base is result["alpha"].values.base
@@ -0,0 +1,162 @@
+# This file is part of datacube-ows, part of the Open Data Cube project.
+# See https://opendatacube.org for more information.
+#
+# Copyright (c) 2017-2021 OWS Contributors
+# SPDX-License-Identifier: Apache-2.0
+import datetime
+
+import pytest
+
+import datacube_ows.tile_cache
+from datacube_ows.ogc_utils import ConfigException
+from datacube_ows.tile_cache import (DiskTileCache, MemoryTileCache,
+                                     TileCache, TileKey)
+
+
+def tile_key(layer="lyr", row=1, col=2, time=""):
+    return TileKey.from_args({
+        "layer": layer,
+        "style": "rgb",
+        "format": "image/png",
+        "tilematrixset": "WholeWorld_WebMercator",
+        "tilematrix": "5",
+        "tilerow": row,
+        "tilecol": col,
+        "time": time,
+    })
+
+
+def test_tile_key():
+    key = tile_key()
+    assert key.time == "default"
+    assert key.row == "1"
+    assert tile_key(time="2020-01-02T10:00:00Z").date_key == "2020-01-02"
+    assert key.digest == tile_key().digest
+    assert key.digest != tile_key(col=3).digest
+
+
+def test_from_cfg(tmp_path):
+    assert TileCache.from_cfg(None) is None
+    cache = TileCache.from_cfg({"backend": "memory"})
+    assert isinstance(cache, MemoryTileCache)
+    assert cache.max_age == 300
+    with pytest.raises(ConfigException) as e:
+        TileCache.from_cfg({"backend": "memory", "max_age": 0})
+    assert "must be positive for the memory backend" in str(e.value)
+    cache = TileCache.from_cfg({"backend": "disk", "path": str(tmp_path), "max_size_mb": 1, "max_age": 60})
+    assert isinstance(cache, DiskTileCache)
+    assert cache.max_bytes == 1024 * 1024
+    assert cache.max_age == 60
+    with pytest.raises(ConfigException) as e:
+        TileCache.from_cfg({"backend": "disk"})
+    assert "requires a path" in str(e.value)
+    with pytest.raises(ConfigException) as e:
+        TileCache.from_cfg({"backend": "redis"})
+    assert "Unknown tile_cache backend" in str(e.value)
+    with pytest.raises(ConfigException) as e:
+        TileCache.from_cfg({"max_size_mb": 0})
+    assert "must be positive" in str(e.value)
+
+
+def test_memory_cache_lru():
+    cache = MemoryTileCache(max_bytes=10)
+    cache.put(tile_key(col=1), (b"aaaa", 200, {"Content-Type": "image/png"}))
+    cache.put(tile_key(col=2), (b"bbbb", 200, {}))
+    cache.put(tile_key(col=3), (b"error", 400, {}))
+    assert cache.get(tile_key(col=3)) is None
+    assert cache.get(tile_key(col=1)) == (b"aaaa", 200, {"Content-Type": "image/png"})
+    cache.put(tile_key(col=4), (b"cccc", 200, {}))
+    # col=2 was least recently used
+    assert cache.get(tile_key(col=2)) is None
+    assert cache.get(tile_key(col=1)) is not None
+    assert cache.size == 8
+    assert cache.hits == 2
+    assert cache.misses == 2
+
+
+def test_memory_cache_invalidate():
+    cache = MemoryTileCache(max_bytes=1000)
+    cache.put(tile_key(time="2020-01-01"), (b"a", 200, {}))
+    cache.put(tile_key(time="2020-01-02"), (b"b", 200, {}))
+    cache.put(tile_key(), (b"c", 200, {}))
+    cache.put(tile_key(layer="other"), (b"d", 200, {}))
+    cache.invalidate("lyr", [datetime.date(2020, 1, 1)])
+    assert cache.get(tile_key(time="2020-01-01")) is None
+    assert cache.get(tile_key()) is None
+    assert cache.get(tile_key(time="2020-01-02")) is not None
+    cache.invalidate("lyr")
+    assert cache.get(tile_key(time="2020-01-02")) is None
+    assert cache.get(tile_key(layer="other")) is not None
+
+
+def test_memory_cache_expiry(monkeypatch):
+    cache = MemoryTileCache(max_bytes=1000, max_age=60)
+    cache.put(tile_key(), (b"a", 200, {}))
+    assert cache.get(tile_key()) is not None
+    now = datacube_ows.tile_cache.time()
+    monkeypatch.setattr(datacube_ows.tile_cache, "time", lambda: now + 120)
+    assert cache.get(tile_key()) is None
+
+
+def test_disk_cache(tmp_path):
+    cache = DiskTileCache(str(tmp_path), max_bytes=1000)
+    cache.put(tile_key(time="2020-01-01"), (b"\x89PNG1", 200, {"Content-Type": "image/png"}))
+    cache.put(tile_key(time="2020-01-02"), (b"\x89PNG2", 200, {"Content-Type": "image/png"}))
+    assert cache.get(tile_key(time="2020-01-01")) == (b"\x89PNG1", 200, {"Content-Type": "image/png"})
+    # A second cache on the same path sees the same tiles
+    other = DiskTileCache(str(tmp_path), max_bytes=1000)
+    assert other.get(tile_key(time="2020-01-02"))[0] == b"\x89PNG2"
+    other.invalidate("lyr", ["2020-01-02"])
+    assert cache.get(tile_key(time="2020-01-02")) is None
+    assert cache.get(tile_key(time="2020-01-01")) is not None
+    cache.clear()
+    assert cache.get(tile_key(time="2020-01-01")) is None
+
+
+def test_disk_cache_eviction(tmp_path):
+    import os
+    cache = DiskTileCache(str(tmp_path), max_bytes=400)
+    for col in range(4):
+        cache.put(tile_key(col=col), (b"x" * 100, 200, {}))
+        fname = cache._file(tile_key(col=col))
+        os.utime(fname, (col, col))
+    cache.put(tile_key(col=9), (b"x" * 100, 200, {}))
+    assert cache.get(tile_key(col=0)) is None
+    assert cache.get(tile_key(col=9)) is not None
+
+
+def test_disk_cache_size_tracking(tmp_path, monkeypatch):
+    import os
+    cache = DiskTileCache(str(tmp_path), max_bytes=10000)
+    cache.put(tile_key(col=0), (b"x" * 100, 200, {}))
+    size = cache._size
+    # Overwriting a tile replaces its size
+    cache.put(tile_key(col=0), (b"x" * 100, 200, {}))
+    assert cache._size == pytest.approx(size, abs=5)
+    # Another process's writes are picked up on rescan
+    other = DiskTileCache(str(tmp_path), max_bytes=10000)
+    other.put(tile_key(col=1), (b"x" * 100, 200, {}))
+    monkeypatch.setattr(datacube_ows.tile_cache, "DISK_RESCAN_PUTS", 1)
+    cache.put(tile_key(col=2), (b"x" * 100, 200, {}))
+    assert cache._size == sum(os.path.getsize(cache._file(tile_key(col=c))) for c in range(3))
+
+
+def test_disk_cache_failed_write(tmp_path, monkeypatch):
+    import os
+    cache = DiskTileCache(str(tmp_path), max_bytes=10000)
+
+    def fail_replace(src, dst):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(datacube_ows.tile_cache.os, "replace", fail_replace)
+    cache.put(tile_key(), (b"x" * 100, 200, {}))
+    monkeypatch.undo()
+    assert cache.get(tile_key()) is None
+    assert [f for _, _, files in os.walk(tmp_path) for f in files] == []
+    # Stale temporary files (e.g. from a crashed process) are removed on rescan
+    stale = os.path.join(str(tmp_path), "orphan.tmp")
+    with open(stale, "wb") as fp:
+        fp.write(b"x")
+    os.utime(stale, (0, 0))
+    cache._rescan()
+    assert not os.path.exists(stale)
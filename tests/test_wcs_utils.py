@@ -0,0 +1,206 @@
+# This file is part of datacube-ows, part of the Open Data Cube project.
+# See https://opendatacube.org for more information.
+#
+# Copyright (c) 2017-2021 OWS Contributors
+# SPDX-License-Identifier: Apache-2.0
+from unittest.mock import MagicMock
+
+import numpy
+import pytest
+import xarray
+from affine import Affine
+from datacube.utils import geometry
+
+from datacube_ows.ogc_utils import ConfigException
+from datacube_ows.wcs_utils import (BandStatistics, CoverageFile,
+                                    aligned_chunk_size, band_blocks,
+                                    clean_coverage_attrs, cog_overview_levels,
+                                    gdal_num_threads, netcdf_encoding,
+                                    netcdf_response, wcs_dask_chunks,
+                                    write_cog, zarr_response)
+
+
+def test_wcs_dask_chunks():
+    geobox = geometry.GeoBox(100, 100, Affine(25.0, 0.0, 1500000.0, 0.0, -25.0, -3900000.0),
+                             geometry.CRS("EPSG:3577"))
+    cfg = MagicMock()
+    cfg.wcs_dask_chunk_size = None
+    assert wcs_dask_chunks(cfg, geobox) is None
+    cfg.wcs_dask_chunk_size = 512
+    assert wcs_dask_chunks(cfg, geobox) == {"time": 1, "y": 512, "x": 512}
+
+
+def test_band_blocks():
+    values = numpy.arange(50 * 70, dtype="int16").reshape(50, 70)
+    band = xarray.DataArray(values, dims=("y", "x"))
+    blocks = list(band_blocks(band))
+    assert len(blocks) == 1
+    assert blocks[0][0] is None
+    lazy = band.chunk({"y": 32, "x": 32})
+    out = numpy.zeros_like(values)
+    n_blocks = 0
+    for window, block in band_blocks(lazy):
+        assert isinstance(block, numpy.ndarray)
+        assert block.shape == (window.height, window.width)
+        out[window.toslices()] = block
+        n_blocks += 1
+    assert n_blocks == 6
+    assert (out == values).all()
+
+
+def test_band_statistics():
+    values = numpy.arange(100, dtype="float32").reshape(10, 10)
+    values[0, 0] = -999
+    values[0, 1] = numpy.nan
+    valid = values.ravel()[2:]
+    stats = BandStatistics(nodata=-999)
+    for y in range(0, 10, 3):
+        for x in range(0, 10, 4):
+            stats.add(values[y:y + 3, x:x + 4])
+    assert stats.count == 98
+    assert stats.tags() == {
+        "STATISTICS_MINIMUM": 2.0,
+        "STATISTICS_MAXIMUM": 99.0,
+        "STATISTICS_MEAN": pytest.approx(valid.mean()),
+        "STATISTICS_STDDEV": pytest.approx(valid.std()),
+    }
+    ints = BandStatistics(nodata=0)
+    ints.add(numpy.array([[0, 0], [0, 0]], dtype="uint8"))
+    assert ints.tags() == {}
+    ints.add(numpy.array([[0, 250], [251, 0]], dtype="uint8"))
+    assert ints.tags()["STATISTICS_MEAN"] == 250.5
+    assert ints.tags()["STATISTICS_STDDEV"] == 0.5
+
+
+def test_gdal_num_threads():
+    assert gdal_num_threads(None) is None
+    assert gdal_num_threads(4) == "4"
+    assert gdal_num_threads("all_cpus") == "ALL_CPUS"
+    with pytest.raises(ConfigException):
+        gdal_num_threads(0)
+    with pytest.raises(ConfigException):
+        gdal_num_threads("lots")
+
+
+def test_coverage_file(monkeypatch):
+    import os
+
+    import datacube_ows.wcs_utils
+    monkeypatch.setattr(datacube_ows.wcs_utils, "COVERAGE_STREAM_CHUNK_SIZE", 4)
+    with CoverageFile(".tif") as covfile:
+        with open(covfile.name, "wb") as fp:
+            fp.write(b"0123456789")
+    assert os.path.exists(covfile.name)
+    resp = covfile.response()
+    assert resp.headers["Content-Length"] == "10"
+    assert list(resp.response) == [b"0123", b"4567", b"89"]
+    assert not os.path.exists(covfile.name)
+    # Failed writes are cleaned up
+    with pytest.raises(ValueError):
+        with CoverageFile() as covfile:
+            raise ValueError("Write failed")
+    assert not os.path.exists(covfile.name)
+
+
+def test_cog_overview_levels():
+    assert cog_overview_levels(500, 400, 512) == []
+    assert cog_overview_levels(1300, 1000, 256) == [2, 4, 8]
+    assert cog_overview_levels(1000, 2048, 512) == [2, 4]
+
+
+def test_write_cog(tmp_path):
+    import rasterio
+
+    values = numpy.arange(600 * 700, dtype="int16").reshape(600, 700)
+
+    def write_tiff(fname, **opts):
+        with rasterio.open(fname, "w", driver="GTiff", width=700, height=600, count=1,
+                           dtype="int16", crs="EPSG:3577",
+                           transform=Affine(25.0, 0.0, 1500000.0, 0.0, -25.0, -3900000.0),
+                           **opts) as dst:
+            dst.write(values, 1)
+
+    fname = str(tmp_path / "cog.tif")
+    write_cog(write_tiff, fname, 700, 600, blocksize=256, compression="zstd")
+    with rasterio.open(fname) as src:
+        assert src.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+        assert src.compression.value == "ZSTD"
+        assert src.block_shapes[0] == (256, 256)
+        assert src.overviews(1) == [2, 4]
+        assert (src.read(1) == values).all()
+    write_cog(write_tiff, fname, 700, 600, overview_levels=[], compression="none")
+    with rasterio.open(fname) as src:
+        assert src.overviews(1) == []
+    with pytest.raises(ConfigException) as excinfo:
+        write_cog(write_tiff, fname, 700, 600, compression="jpeg2000")
+    assert "Unsupported COG compression" in str(excinfo.value)
+
+
+def test_netcdf_encoding():
+    assert aligned_chunk_size(700, 512) == 350
+    assert aligned_chunk_size(100, 512) == 100
+    assert aligned_chunk_size(1025, 512) == 342
+    data = xarray.Dataset({
+        "red": (("time", "y", "x"), numpy.zeros((3, 700, 100), dtype="int16")),
+    })
+    assert netcdf_encoding(data) == {
+        "red": {"zlib": True, "shuffle": True, "complevel": 4, "chunksizes": (1, 350, 100)}
+    }
+    assert netcdf_encoding(data, complevel=0)["red"]["zlib"] is False
+    with pytest.raises(ConfigException) as excinfo:
+        netcdf_encoding(data, complevel=11)
+    assert "complevel must be between 0 and 9" in str(excinfo.value)
+
+
+def test_netcdf_response(tmp_path):
+    values = numpy.arange(2 * 70 * 60, dtype="float32").reshape(2, 70, 60)
+    data = xarray.Dataset({
+        "red": (("time", "y", "x"), values, {"nodata": -999.0}),
+    }, coords={"time": [0, 1], "y": numpy.arange(70.0), "x": numpy.arange(60.0)})
+    resp = netcdf_response(data.chunk({"time": 1, "y": 32, "x": 32}), chunk_size=32)
+    fname = tmp_path / "coverage.nc"
+    fname.write_bytes(b"".join(resp.response))
+    with xarray.open_dataset(fname) as back:
+        assert back["red"].encoding["zlib"]
+        assert back["red"].encoding["chunksizes"] == (1, 24, 30)
+        assert (back["red"].values == values).all()
+
+
+def test_clean_coverage_attrs():
+    data = xarray.Dataset({
+        "red": (("time", "y", "x"), numpy.zeros((1, 2, 2)),
+                {"spectral_definition": {"wavelength": [1]}, "flags_definition": {}, "nodata": 0}),
+    }, coords={"time": ("time", [0], {"units": "seconds"})})
+    clean_coverage_attrs(data, "EPSG:3577")
+    assert data.attrs["crs"] == "EPSG:3577"
+    assert data["red"].attrs == {"nodata": 0, "crs": "EPSG:3577"}
+    assert "units" not in data["time"].attrs
+
+
+def test_zarr_response_no_zarr(monkeypatch):
+    import datacube_ows.wcs_utils
+    monkeypatch.setattr(datacube_ows.wcs_utils, "zarr", None)
+    with pytest.raises(ConfigException) as excinfo:
+        zarr_response(xarray.Dataset())
+    assert "requires the zarr package" in str(excinfo.value)
+
+
+def test_zarr_response(tmp_path):
+    zarr = pytest.importorskip("zarr")
+    import zipfile
+    values = numpy.arange(3 * 70 * 60, dtype="float32").reshape(3, 70, 60)
+    data = xarray.Dataset({
+        "red": (("time", "y", "x"), values, {"nodata": -999.0}),
+    }, coords={"time": numpy.array(["2020-01-01", "2020-01-02", "2020-01-03"], dtype="datetime64[ns]"),
+               "y": numpy.arange(70.0), "x": numpy.arange(60.0)})
+    for coverage, chunks in ((data, (1, 24, 30)), (data.chunk({"time": 1, "y": 40, "x": 40}), (1, 40, 40))):
+        resp = zarr_response(coverage, chunk_size=32)
+        fname = tmp_path / "coverage.zarr.zip"
+        fname.write_bytes(b"".join(resp.response))
+        assert zipfile.is_zipfile(fname)
+        store = zarr.storage.ZipStore(str(fname), mode="r")
+        with xarray.open_zarr(store) as back:
+            assert back["red"].encoding["chunks"] == chunks
+            assert (back["red"].values == values).all()
+            assert (back["time"].values == data["time"].values).all()
+        store.close()